@@ -0,0 +1,287 @@
+"""
+Precompiled bytecode files (.cspb).
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+A .cspb file holds the parser output for a whole program, so that it
+can be loaded without any string parsing. After MAGIC and the KEY_SIZE
+byte key of the source it was compiled from, the file is a sequence
+of signed 64-bit little-endian words:
+
+    VERSION
+    SHARED if the code boxes share their pools, otherwise 0
+    number of strings, integers, bools, targets and functions
+    the integer pool
+    the bool pool, as 0 or 1
+    the target pool
+    the string pool: each string as its length, then its bytes
+        padded with zeros to a whole number of words
+    for each function:
+        its name, as a string
+        the length of its bytecode and of each of its literal pools
+        its bytecode
+        indices into the program-wide pools of its strings,
+        integers, bools and targets
+
+The program-wide pools hold each literal once, and the literal pools
+of each CodeBox are rebuilt from them, so the bytecode itself is the
+same as the parser output. If the pools are shared they are written
+as they are, and the functions have empty pools of their own.
+"""
+
+import struct
+
+from rcsp.box import CodeBox, ProgramBox
+from rcsp.parser import DEBUG, FunctionSource
+
+try:
+    from rpython.rlib.listsort import TimSort
+    from rpython.rlib.rmd5 import RMD5
+except ImportError:
+    pass
+
+__date__ = 'August 2013'
+__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
+
+MAGIC = 'CSPB\r\n\x1a\n'
+VERSION = 3  # Bump whenever the parser output changes.
+SHARED = 1   # Flag for programs whose code boxes share their pools.
+KEY_SIZE = 16  # Bytes in the key of a source file.
+WORD = 8       # Bytes in a word.
+
+
+def source_key(text):
+    """Return the key of the text of a source file: its MD5 digest.
+    """
+    if DEBUG:
+        import hashlib
+        return hashlib.md5(text).digest()
+    return RMD5(text).digest()
+
+
+def dump_program(program, key):
+    """Return the .cspb encoding of a ProgramBox, as a str.
+
+    key should be the source_key of the source of program.
+    """
+    names = program.get_functions()
+    if DEBUG:
+        names.sort()
+    else:
+        TimSort(names).sort()
+    strings, integers, bools, targets = [], [], [False, True], []
+    string_index, integer_index, target_index = {}, {}, {}
+    flags = 0
+    if program.shared_pools and len(names) > 0:
+        flags = SHARED
+        first = program.get(names[0])
+        strings, integers = first.strings, first.integers
+        bools, targets = first.bools, first.targets
+    functions = []
+    for name in names:
+        code = program.get(name)
+        function = [_pack_string(name)]
+        if flags == SHARED:
+            sizes = [len(code.bytecode), 0, 0, 0, 0]
+            function.append(_pack(sizes + code.bytecode))
+            functions.append(''.join(function))
+            continue
+        words = [len(code.bytecode), len(code.strings), len(code.integers),
+                 len(code.bools), len(code.targets)]
+        words.extend(code.bytecode)
+        for string in code.strings:
+            words.append(_intern_string(strings, string_index, string))
+        for integer in code.integers:
+            words.append(_intern_int(integers, integer_index, integer))
+        for boolean in code.bools:
+            words.append(int(boolean))
+        for target in code.targets:
+            words.append(_intern_int(targets, target_index, target))
+        function.append(_pack(words))
+        functions.append(''.join(function))
+    words = [VERSION, flags, len(strings), len(integers), len(bools),
+             len(targets), len(functions)]
+    words.extend(integers)
+    words.extend([int(boolean) for boolean in bools])
+    words.extend(targets)
+    pieces = [MAGIC, key, _pack(words)]
+    for string in strings:
+        pieces.append(_pack_string(string))
+    pieces.extend(functions)
+    return ''.join(pieces)
+
+
+def load_program(data, key):
+    """Return the ProgramBox encoded in data, a str or mmap.
+
+    If key is not the empty string it must match the key stored in
+    data, or None is returned. TypeError is raised if data is not a
+    .cspb file of this VERSION.
+
+    Only the pools and the names of the functions are read here. The
+    bytecode of each function is read by ProgramBox.get, the first
+    time the function is asked for.
+    """
+    header = len(MAGIC) + KEY_SIZE
+    if len(data) < header or data[:len(MAGIC)] != MAGIC:
+        raise TypeError('Not a .cspb file')
+    if key != '' and data[len(MAGIC):header] != key:
+        return None
+    pos = header
+    counts = _unpack(data, pos, 7)
+    pos += 7 * WORD
+    if counts[0] != VERSION:
+        raise TypeError('Unsupported .cspb version: ' + str(counts[0]))
+    shared = counts[1] == SHARED
+    nstrings, nintegers, nbools = counts[2], counts[3], counts[4]
+    ntargets, nfunctions = counts[5], counts[6]
+    integers = _unpack(data, pos, nintegers)
+    pos += nintegers * WORD
+    bools = [value != 0 for value in _unpack(data, pos, nbools)]
+    pos += nbools * WORD
+    targets = _unpack(data, pos, ntargets)
+    pos += ntargets * WORD
+    strings = []
+    for _ in range(nstrings):
+        string, pos = _unpack_string(data, pos)
+        strings.append(string)
+    source = BinarySource(data, strings, integers, bools, targets, shared)
+    for _ in range(nfunctions):
+        name, pos = _unpack_string(data, pos)
+        sizes = _unpack(data, pos, 5)
+        end = pos + (5 + sizes[0]) * WORD
+        if not shared:
+            end += (sizes[1] + sizes[2] + sizes[3] + sizes[4]) * WORD
+        if end > len(data):
+            raise TypeError('Truncated .cspb file')
+        source.index[name] = (pos, end)
+        pos = end
+    program = ProgramBox({}, source)
+    program.shared_pools = shared
+    return program
+
+
+class BinarySource(FunctionSource):
+    """Functions in a .cspb file.
+
+    The range of each function starts at its sizes, after its name.
+    """
+
+    def __init__(self, data, strings, integers, bools, targets, shared):
+        FunctionSource.__init__(self)
+        self.data = data
+        self.strings = strings
+        self.integers = integers
+        self.bools = bools
+        self.targets = targets
+        self.shared = shared
+
+    def parse(self, start, end):
+        data = self.data
+        sizes = _unpack(data, start, 5)
+        pos = start + 5 * WORD
+        bytecode = _unpack(data, pos, sizes[0])
+        pos += sizes[0] * WORD
+        if self.shared:
+            return CodeBox(bytecode, self.strings, self.integers, self.bools,
+                           self.targets)
+        indices = _unpack(data, pos, (end - pos) // WORD)
+        for i in range(1, 5):
+            if sizes[i] < 0:
+                raise TypeError('Malformed .cspb file')
+        # Where the indices of each pool end.
+        strings_end = sizes[1]
+        integers_end = strings_end + sizes[2]
+        bools_end = integers_end + sizes[3]
+        targets_end = bools_end + sizes[4]
+        assert strings_end >= 0 and integers_end >= 0
+        assert bools_end >= 0 and targets_end >= 0
+        return CodeBox(
+            bytecode,
+            [self.strings[i] for i in indices[:strings_end]],
+            [self.integers[i] for i in indices[strings_end:integers_end]],
+            [self.bools[i] for i in indices[integers_end:bools_end]],
+            [self.targets[i] for i in indices[bools_end:targets_end]])
+
+
+# Return the index of value in pool, adding it if need be. Strings and
+# ints have a function each, as RPython gives each argument one type.
+def _intern_string(pool, index, value):
+    if value not in index:
+        index[value] = len(pool)
+        pool.append(value)
+    return index[value]
+
+
+def _intern_int(pool, index, value):
+    if value not in index:
+        index[value] = len(pool)
+        pool.append(value)
+    return index[value]
+
+
+def _pack_string(string):
+    """Encode a string as its length and its bytes, padded to words.
+    """
+    return _pack([len(string)]) + string + '\0' * (-len(string) % WORD)
+
+
+def _unpack_string(data, pos):
+    """Decode a string starting at byte pos.
+
+    Returns the string and the position after it.
+    """
+    length = _unpack(data, pos, 1)[0]
+    pos += WORD
+    end = pos + length
+    if length < 0 or end > len(data):
+        raise TypeError('Truncated .cspb file')
+    assert pos >= 0 and end >= 0
+    string = data[pos:end]
+    return string, end + (-length % WORD)
+
+
+def _pack(words):
+    """Encode a list of ints as words.
+    """
+    if DEBUG:
+        return struct.pack('<%dq' % len(words), *words)
+    chars = []
+    for word in words:
+        for i in range(WORD):
+            chars.append(chr((word >> (8 * i)) & 0xFF))
+    return ''.join(chars)
+
+
+def _unpack(data, pos, count):
+    """Decode count words of data, starting at byte pos.
+    """
+    if pos + count * WORD > len(data):
+        raise TypeError('Truncated .cspb file')
+    if DEBUG:
+        return list(struct.unpack('<%dq' % count,
+                                  data[pos:pos + count * WORD]))
+    words = []
+    for j in range(count):
+        start = pos + j * WORD
+        top = ord(data[start + WORD - 1])
+        if top >= 128:
+            top -= 256
+        word = top
+        for i in range(WORD - 2, -1, -1):
+            word = (word << 8) | ord(data[start + i])
+        words.append(word)
+    return words
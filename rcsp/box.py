@@ -19,14 +19,32 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # pylint: disable=W0613
 # pylint: disable=W0231
 
-from rcsp.parser import opcode
+from rcsp.parser import is_source_opcode, opcode_mnemonic
+from rcsp.parser import opcode_has_arg, opcode_has_name_arg
+from rcsp.parser import opcode_has_target_arg
+
+try:
+    from rpython.rlib.jit import elidable
+except ImportError:
+    def elidable(func):
+        return func
 
 
 __date__ = 'August 2013'
 __author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
 
+# Integers in the range SMALL_INT_MIN..SMALL_INT_MAX (inclusive) are
+# boxed once, when this module is loaded, and shared by every
+# computation which produces them. Edit these to change the range.
+SMALL_INT_MIN = -5
+SMALL_INT_MAX = 1024
+
 
-class Box:
+class Box(object):
+    __slots__ = ()
+    # Fields which are read from values popped off a stack, whose
+    # subclass rpython does not know.
+    _attrs_ = ('integer', 'boolean', 'string', 'shared')
 
     def __init__(self):
         raise NotImplementedError
@@ -37,81 +55,64 @@ class Box:
 
 class IntBox(Box):
     # TODO: Some of these could be collapsed and refactored.
+    __slots__ = ('integer',)
 
     def __init__(self, integer):
         self.integer = integer
 
     def add(self, integer):
         if isinstance(integer, IntBox):
-            return IntBox(self.integer + integer.integer)
+            return box_int(self.integer + integer.integer)
         raise TypeError("Was expecting an IntBox")
 
     def minus(self, integer):
         if isinstance(integer, IntBox):
-            return IntBox(self.integer - integer.integer)
+            return box_int(self.integer - integer.integer)
         raise TypeError
 
     def times(self, integer):
         if isinstance(integer, IntBox):
-            return IntBox(self.integer * integer.integer)
+            return box_int(self.integer * integer.integer)
         raise TypeError
 
     def div(self, integer):
         if isinstance(integer, IntBox):
-            return IntBox(self.integer / integer.integer)
+            return box_int(self.integer / integer.integer)
         raise TypeError
 
     def mod(self, integer):
         if isinstance(integer, IntBox):
-            return IntBox(self.integer % integer.integer)
+            return box_int(self.integer % integer.integer)
         raise TypeError
 
     def gt(self, integer):
         if isinstance(integer, IntBox):
-            if self.integer > integer.integer:
-                return BoolBox(True)
-            else:
-                return BoolBox(False)
+            return box_bool(self.integer > integer.integer)
         raise TypeError
 
     def lt(self, integer):
         if isinstance(integer, IntBox):
-            if self.integer < integer.integer:
-                return BoolBox(True)
-            else:
-                return BoolBox(False)
+            return box_bool(self.integer < integer.integer)
         raise TypeError
 
     def geq(self, integer):
         if isinstance(integer, IntBox):
-            if self.integer >= integer.integer:
-                return BoolBox(True)
-            else:
-                return BoolBox(False)
+            return box_bool(self.integer >= integer.integer)
         raise TypeError
 
     def leq(self, integer):
         if isinstance(integer, IntBox):
-            if self.integer <= integer.integer:
-                return BoolBox(True)
-            else:
-                return BoolBox(False)
+            return box_bool(self.integer <= integer.integer)
         raise TypeError
 
     def eq(self, integer):
         if isinstance(integer, IntBox):
-            if self.integer == integer.integer:
-                return BoolBox(True)
-            else:
-                return BoolBox(False)
+            return box_bool(self.integer == integer.integer)
         raise TypeError
 
     def neq(self, integer):
         if isinstance(integer, IntBox):
-            if self.integer != integer.integer:
-                return BoolBox(True)
-            else:
-                return BoolBox(False)
+            return box_bool(self.integer != integer.integer)
         raise TypeError
 
     def __repr__(self):
@@ -128,6 +129,7 @@ class IntBox(Box):
 
 
 class StringBox(Box):
+    __slots__ = ('string',)
 
     def __init__(self, string):
         self.string = string
@@ -146,6 +148,7 @@ class StringBox(Box):
 
 
 class BoolBox(Box):
+    __slots__ = ('boolean',)
 
     def __init__(self, boolean):
         self.boolean = boolean
@@ -163,13 +166,171 @@ class BoolBox(Box):
         return False
 
 
-class CodeBox(Box):
+class Waiter(object):
+    """An entry in the queue of a ChannelBox.
+
+    A process blocked on CHAN_SEND or CHAN_RECV waits on one channel
+    through its own Waiter. A process blocked on an ALT waits on each
+    of its enabled channels at once, through one Waiter per guard,
+    and index is the number of the guard. For CHAN_SEND and
+    CHAN_RECV index is -1.
+    """
+    __slots__ = ('process', 'index', 'channel', 'prev', 'next')
+
+    def __init__(self, process, index):
+        self.process = process
+        self.index = index
+        self.channel = None  # The channel waited on, if any.
+        self.prev = None
+        self.next = None
+
+
+class ChannelBox(Box):
+    """A synchronous channel between processes.
+
+    Processes which are blocked on the channel wait in a FIFO queue
+    of Waiter objects. The queue only ever holds senders or only
+    receivers, as a sender and a receiver which meet are both
+    released. The queue is doubly linked, so that a process which is
+    woken up by one channel of an ALT can leave the queues of the
+    others in O(1) each.
+
+    A channel which links processes on different workers of a
+    rcsp.multicore pool is shared, and its values go through the
+    shared object instead of the queue.
+    """
+    __slots__ = ('head', 'tail', 'senders', 'shared')
+
+    def __init__(self):
+        self.head = None      # First Waiter.
+        self.tail = None      # Last Waiter.
+        self.senders = False  # True if the waiting processes are sending.
+        self.shared = None    # rcsp.multicore.SharedChannel, if any.
+
+    def has_senders(self):
+        return self.head is not None and self.senders
+
+    def has_receivers(self):
+        return self.head is not None and not self.senders
+
+    def wait(self, waiter, sending):
+        """Add a Waiter to the end of the queue.
+        """
+        waiter.channel = self
+        waiter.next = None
+        waiter.prev = self.tail
+        if self.tail is None:
+            self.head = waiter
+        else:
+            self.tail.next = waiter
+        self.tail = waiter
+        self.senders = sending
+
+    def remove(self, waiter):
+        """Remove a Waiter from anywhere in the queue.
+        """
+        if waiter.prev is None:
+            self.head = waiter.next
+        else:
+            waiter.prev.next = waiter.next
+        if waiter.next is None:
+            self.tail = waiter.prev
+        else:
+            waiter.next.prev = waiter.prev
+        waiter.channel = None
+        waiter.prev = None
+        waiter.next = None
+
+    def release(self):
+        """Remove and return the first Waiter.
+        """
+        waiter = self.head
+        self.remove(waiter)
+        return waiter
+
+    def __repr__(self):
+        return 'CHANNEL'
+
+    def __str__(self):
+        return 'CHANNEL'
+
+
+# There are exactly two BoolBox objects.
+TRUE = BoolBox(True)
+FALSE = BoolBox(False)
+
+SMALL_INTS = [IntBox(i)
+              for i in range(SMALL_INT_MIN, SMALL_INT_MAX + 1)]
+
+
+def box_int(integer):
+    """Return an IntBox holding integer.
+
+    Small integers are taken from a cache rather than allocated.
+    """
+    if integer >= SMALL_INT_MIN and integer <= SMALL_INT_MAX:
+        return small_int(integer)
+    return IntBox(integer)
 
-    def __init__(self, bytecode, strings, integers, bools):
+
+@elidable
+def small_int(integer):
+    """Return the cached IntBox of a small integer.
+
+    The cache never changes, so the JIT can fold this for a constant.
+    """
+    return SMALL_INTS[integer - SMALL_INT_MIN]
+
+
+def box_bool(boolean):
+    """Return TRUE or FALSE.
+    """
+    if boolean:
+        return TRUE
+    return FALSE
+
+
+class CodeBox(Box):
+    __slots__ = ('bytecode', 'strings', 'integers', 'bools', 'targets',
+                 'ops', 'args', 'offsets', 'decoded',
+                 'quick_ops', 'quick_args',
+                 'stack_types', 'max_depth', 'unboxed',
+                 'params', 'param_types', 'return_type', 'free_frames')
+    # The decoded code is replaced while it is linked and optimized,
+    # but each list is built elsewhere and a copy stored here, so these
+    # lists are never changed once stored, and the JIT can treat the
+    # code of a trace as constant.
+    _immutable_fields_ = ['ops?[*]', 'args?[*]', 'stack_types?[*]']
+
+    def __init__(self, bytecode, strings, integers, bools, targets=None):
         self.bytecode = bytecode
         self.strings = strings
         self.integers = integers
         self.bools = bools
+        if targets is None:
+            targets = []
+        self.targets = targets  # Operands of jumps.
+        # Pre-decoded instructions, filled in by rcsp.decoder.
+        self.ops = []
+        self.args = []
+        self.offsets = []
+        self.decoded = False
+        # A copy of ops and args which rcsp.interpreter quickens as it
+        # runs, made by rcsp.linker. Unlike ops and args, these lists
+        # are changed in place, and the JIT never reads them.
+        self.quick_ops = []
+        self.quick_args = []
+        # Stack slot types, filled in by rcsp.verifier.
+        self.stack_types = []
+        self.max_depth = 0
+        self.unboxed = False
+        # Function signature, filled in by rcsp.linker and
+        # rcsp.verifier.
+        self.params = []
+        self.param_types = None
+        self.return_type = -1  # rcsp.verifier.TYPE_UNKNOWN
+        # Frames which can be reused by calls to this function.
+        self.free_frames = []
 
     def __repr__(self):
         """Return a string representation of a list of numeric opcodes
@@ -182,122 +343,35 @@ class CodeBox(Box):
         pc = 0
         output = ['CODE']
         while pc < len(self.bytecode):
-            # Arithmetic operation bytecodes.
-            if self.bytecode[pc] == opcode('ADD'):
-                new_bc('ADD', pc, output)
-            elif self.bytecode[pc] == opcode('MINUS'):
-                new_bc('MINUS', pc, output)
-            elif self.bytecode[pc] == opcode('TIMES'):
-                new_bc('TIMES', pc, output)
-            elif self.bytecode[pc] == opcode('DIV'):
-                new_bc('DIV', pc, output)
-            elif self.bytecode[pc] == opcode('MOD'):
-                new_bc('MOD', pc, output)
-            # Comparative operation bytecodes.
-            elif self.bytecode[pc] == opcode('GT'):
-                new_bc('GT', pc, output)
-            elif self.bytecode[pc] == opcode('LT'):
-                new_bc('LT', pc, output)
-            elif self.bytecode[pc] == opcode('GEQ'):
-                new_bc('GEQ', pc, output)
-            elif self.bytecode[pc] == opcode('LEQ'):
-                new_bc('LEQ', pc, output)
-            elif self.bytecode[pc] == opcode('EQ'):
-                new_bc('EQ', pc, output)
-            elif self.bytecode[pc] == opcode('NEQ'):
-                new_bc('NEQ', pc, output)
-            # I/O bytecodes.
-            elif self.bytecode[pc] == opcode('PRINT_ITEM'):
-                new_bc('PRINT_ITEM', pc, output)
-            elif self.bytecode[pc] == opcode('PRINT_NEWLINE'):
-                new_bc('PRINT_NEWLINE', pc, output)
-            # Global variable bytecodes.
-            elif self.bytecode[pc] == opcode('STORE'):
-                new_bc('STORE', pc, output)
-            elif self.bytecode[pc] == opcode('LOAD_GLOBAL'):
-                new_bc('LOAD_GLOBAL ' +
-                       str(self.bytecode[pc + 1]) + '\t(' +
-                       self.strings[self.bytecode[pc + 1]] + ')',
-                       pc,
-                       output)
-                pc += 1
-            elif self.bytecode[pc] == opcode('LOAD_CONST'):
-                new_bc('LOAD_CONST ' +
-                       str(self.bytecode[pc + 1]) + '\t(' +
-                       str(self.integers[self.bytecode[pc + 1]]) + ')',
-                       pc,
-                       output)
-                pc += 1
-            elif self.bytecode[pc] == opcode('LOAD_NAME'):
-                new_bc('LOAD_NAME ' +
-                       str(self.bytecode[pc + 1]) + '\t(' +
-                       self.strings[self.bytecode[pc + 1]] + ')',
-                       pc,
-                       output)
-                pc += 1
-            # Control flow.
-            elif self.bytecode[pc] == opcode('JUMP_FORWARD'):
-                new_bc('JUMP_FORWARD ' +
-                       str(self.bytecode[pc + 1]) + '\t(' +
-                       str(self.integers[self.bytecode[pc + 1]]) + ')',
-                       pc,
-                       output)
-                pc = pc + 1
-            elif self.bytecode[pc] == opcode('POP_JUMP_IF_TRUE'):
-                new_bc('POP_JUMP_IF_TRUE ' +
-                       str(self.bytecode[pc + 1]) + '\t(' +
-                       str(self.integers[self.bytecode[pc + 1]]) + ')',
-                       pc,
-                       output)
-                pc += 1
-            elif self.bytecode[pc] == opcode('POP_JUMP_IF_FALSE'):
-                new_bc('POP_JUMP_IF_FALSE ' +
-                       str(self.bytecode[pc + 1]) + '\t(' +
-                       str(self.integers[self.bytecode[pc + 1]]) + ')',
-                       pc,
-                       output)
-                pc += 1
-            elif self.bytecode[pc] == opcode('JUMP_ABSOLUTE'):
-                new_bc('POP_JUMP_IF_FALSE ' +
-                       str(self.bytecode[pc + 1]) + '\t(' +
-                       str(self.integers[self.bytecode[pc + 1]]) + ')',
-                       pc,
-                       output)
-                pc += 1
-            # Function creation and calls.
-            elif self.bytecode[pc] == opcode('CALL_FUNCTION'):
-                new_bc('CALL_FUNCTION ' +
-                       str(self.bytecode[pc + 1]) + '\t(' +
-                       str(self.strings[self.bytecode[pc + 1]]) + ')',
-                       pc,
-                       output)
-                pc += 1
-            elif self.bytecode[pc] == opcode('LOAD_ARG'):
-                new_bc('LOAD_ARG ' +
-                       str(self.bytecode[pc + 1]) + '\t(' +
-                       str(self.strings[self.bytecode[pc + 1]]) + ')',
-                       pc,
-                       output)
-                pc += 1
-            elif self.bytecode[pc] == opcode('MAKE_FUNCTION'):
-                new_bc('MAKE_FUNCTION', pc, output)
-            elif self.bytecode[pc] == opcode('RETURN'):
-                new_bc('RETURN ',
+            op = self.bytecode[pc]
+            if not is_source_opcode(op):
+                raise TypeError('No such opcode: ' + str(op))
+            if opcode_has_arg(op):
+                arg = self.bytecode[pc + 1]
+                if opcode_has_name_arg(op):
+                    literal = self.strings[arg]
+                elif opcode_has_target_arg(op):
+                    literal = str(self.targets[arg])
+                else:
+                    literal = str(self.integers[arg])
+                new_bc(opcode_mnemonic(op) + ' ' + str(arg) +
+                       '\t(' + literal + ')',
                        pc,
                        output)
                 pc += 1
-            # Unknown bytecode.
             else:
-                raise TypeError('No such opcode: ' + str(self.bytecode[pc]))
+                new_bc(opcode_mnemonic(op), pc, output)
             pc += 1
         output.append('\n')
         output.append('DATA:')
         i_s = self.int_list_to_str(self.integers)
         s_s = self.str_list_to_str(self.strings)
         b_s = self.bool_list_to_str(self.bools)
+        t_s = self.int_list_to_str(self.targets)
         output.append('\tIntegers: ' + i_s)
         output.append('\tStrings: ' + s_s)
         output.append('\tBools: ' + b_s)
+        output.append('\tTargets: ' + t_s)
         output.append('\n')
         return '\n'.join(output)
 
@@ -314,21 +388,45 @@ class CodeBox(Box):
 
 
 class ProgramBox(Box):
+    __slots__ = ('functions', 'source', 'shared_pools', 'globals', 'slots',
+                 'linked', 'code_table', 'function_index', 'unboxed')
 
-    def __init__(self, cb_dict):
+    def __init__(self, cb_dict, source=None):
         self.functions = cb_dict  # dict of code boxes
+        # Functions which are only parsed when they are first got.
+        self.source = source  # rcsp.parser.FunctionSource or None
+        self.shared_pools = False  # True if code boxes share pools.
+        # Global heap slots, filled in by rcsp.linker.
+        self.globals = []  # list of names, indexed by slot
+        self.slots = {}    # dict of names -> slots
+        # Function table, filled in by rcsp.linker.
+        self.code_table = []      # list of code boxes
+        self.function_index = {}  # dict of names -> code_table indices
+        self.unboxed = False
+        self.linked = False
+
+    def has(self, name):
+        if name in self.functions:
+            return True
+        return self.source is not None and name in self.source.index
 
     def get(self, name):
+        if name not in self.functions and self.source is not None:
+            if name in self.source.index:
+                self.functions[name] = self.source.load(name)
         return self.functions[name]
 
     def get_functions(self):
-        return self.functions.keys()
+        names = self.functions.keys()
+        if self.source is not None:
+            names.extend(self.source.index.keys())
+        return names
 
     def __repr__(self):
         output = ['\n', '...pretty printing parser output...']
-        for name in self.functions:
+        for name in self.get_functions():
             output.append('DEF ' + name + '\n')
-            output.append(self.functions[name].__repr__())
+            output.append(self.get(name).__repr__())
             output.append('ENDDEF')
         output.append('...pretty printer done...')
         output.append('\n')
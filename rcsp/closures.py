@@ -0,0 +1,421 @@
+"""
+Closure-compiling execution engine for a simple CSP bytecode language.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+This engine runs under CPython only, where it replaces the dispatch
+loop of rcsp.interpreter. Each basic block of linked and verified
+code is compiled, the first time it runs, into one Python closure
+which runs the whole block and returns the pc of the next block, or
+SWITCH.
+
+Within a block the operand stack is only simulated while compiling:
+arithmetic, comparisons and loads build a tree of closures over plain
+ints and bools, with operands, global slots and jump targets bound
+as constants. Values are boxed onto frame.stack only where they
+outlive the block or meet an instruction which needs the real stack
+(calls, processes, channels and ALT), which runs through its handler
+in rcsp.interpreter. Scheduling, frames and channels are therefore
+exactly those of the interpreter, and so are the stack and globals
+which a program leaves behind.
+
+Values are computed in the same order as the interpreter computes
+them, so a program which fails (reading an unset global or dividing
+by zero) fails after the same output.
+"""
+
+import operator
+
+from rcsp.box import StringBox, box_bool, box_int
+from rcsp.interpreter import (DeadlockError, Frame, HANDLERS, Heap, SWITCH,
+                              Scheduler, end_process)
+from rcsp.linker import link_program
+from rcsp.optimizer import jump_targets
+from rcsp.output import stdout
+from rcsp.parser import opcode, opcode_mnemonic
+from rcsp.verifier import TYPE_BOOL, TYPE_INT
+
+__date__ = 'August 2013'
+__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
+
+# Python operators for the arithmetic and comparison instructions.
+# Integer division rounds down, as / does on ints in the interpreter.
+ARITHMETIC = {'ADD': operator.add, 'MINUS': operator.sub,
+              'TIMES': operator.mul, 'DIV': operator.floordiv,
+              'MOD': operator.mod}
+COMPARISONS = {'GT': operator.gt, 'LT': operator.lt, 'EQ': operator.eq,
+               'NEQ': operator.ne, 'GEQ': operator.ge, 'LEQ': operator.le}
+
+# Instructions which run through their interpreter handler and may
+# leave the frame, so they end a block.
+SWITCHING = frozenset(['CALL_FUNCTION', 'RETURN', 'CHAN_SEND', 'CHAN_RECV',
+                       'ALT', 'PRI_ALT'])
+
+
+class Value(object):
+    """A value on the simulated stack of a block being compiled.
+
+    kind is the rcsp.verifier type of the value. raw(frame) computes
+    it as an int or a bool for TYPE_INT and TYPE_BOOL, and as a box
+    for any other type. box(frame), if given, fetches a value which is
+    already boxed. const holds the value of an int constant, and slot
+    the index in frame.stack of a value which is already there. safe
+    is False if computing the value may fail or reads a global.
+    """
+
+    def __init__(self, kind, raw, box=None, const=None, slot=-1,
+                 safe=True):
+        self.kind = kind
+        self.raw = raw
+        self.box = box
+        self.const = const
+        self.slot = slot
+        self.safe = safe
+
+    def boxed(self):
+        """Return a closure which computes this value as a box.
+        """
+        raw = self.raw
+        if self.box is not None:
+            return self.box
+        if self.kind == TYPE_INT:
+            if self.const is not None:
+                box = box_int(self.const)
+                return lambda frame: box
+            return lambda frame: box_int(raw(frame))
+        if self.kind == TYPE_BOOL:
+            return lambda frame: box_bool(raw(frame))
+        return raw
+
+
+class Compiler(object):
+    """Compiles the blocks of each code box of a running program.
+
+    blocks(code) returns a list with an entry for each instruction of
+    code, and one for its end, which is None until a block starting
+    at that instruction has been compiled by compile_block.
+    """
+
+    def __init__(self, heap):
+        self.heap = heap
+        self.compiled = {}  # dict of code boxes -> lists of blocks
+        self.targets = {}   # dict of code boxes -> jump_targets
+
+    def blocks(self, code):
+        if code not in self.compiled:
+            self.compiled[code] = [None] * (len(code.ops) + 1)
+            self.targets[code] = jump_targets(code)
+        return self.compiled[code]
+
+    def compile_block(self, code, start):
+        """Compile the block of code starting at start.
+        """
+        block = Block(self, code, start)
+        pc = start
+        while True:
+            if pc == len(code.ops):
+                block.spill()
+                block.finish(_end(pc))
+                break
+            if pc > start and self.targets[code][pc]:
+                block.spill()
+                block.finish(_goto(pc))
+                break
+            if block.instruction(pc):
+                break
+            pc += 1
+        self.compiled[code][start] = block.closure()
+        return self.compiled[code][start]
+
+
+class Block(object):
+    """A block being compiled: its statements, each a closure which
+    takes a frame, and the simulated stack after them.
+    """
+
+    def __init__(self, compiler, code, start):
+        self.compiler = compiler
+        self.code = code
+        self.statements = []
+        self.stack = []
+        self.depth = len(code.stack_types[start])  # Of frame.stack.
+        self.terminator = None
+        for i in range(self.depth):
+            self.stack.append(_slot(i, code.stack_types[start][i]))
+
+    def instruction(self, pc):
+        """Compile the instruction at pc.
+
+        Returns True if it ends the block.
+        """
+        code = self.code
+        # The first instruction of a superinstruction is still run on
+        # its own, since the rest of the sequence is left in place.
+        name = opcode_mnemonic(code.ops[pc]).split(';')[0]
+        arg = code.args[pc]
+        heap = self.compiler.heap
+        if name == 'LOAD_CONST':
+            self.stack.append(_const(arg))
+        elif name == 'LOAD_GLOBAL':
+            self.stack.append(_load_global(heap, arg))
+        elif name == 'LOAD_ARG':
+            self.stack.append(_load_arg(arg, code.stack_types[pc + 1][-1]))
+        elif name == 'LOAD_NAME':
+            string = code.strings[arg]
+            self.stack.append(Value(code.stack_types[pc + 1][-1],
+                                    lambda frame: StringBox(string)))
+        elif name in ARITHMETIC:
+            right = self.stack.pop()
+            left = self.stack.pop()
+            self.stack.append(_binary(TYPE_INT, ARITHMETIC[name], left,
+                                      right, name == 'DIV' or name == 'MOD'))
+        elif name in COMPARISONS:
+            right = self.stack.pop()
+            left = self.stack.pop()
+            self.stack.append(_binary(TYPE_BOOL, COMPARISONS[name], left,
+                                      right, False))
+        elif name == 'STORE_GLOBAL':
+            value = self.pop_effect(1)[0]
+            self.statements.append(_store_global(heap, arg, value.raw))
+        elif name == 'PRINT_ITEM':
+            value = self.pop_effect(1)[0]
+            self.statements.append(_print_item(value))
+        elif name == 'PRINT_NEWLINE':
+            self.pop_effect(0)
+            self.statements.append(lambda frame: stdout.write_newline())
+        elif name == 'JUMP_ABSOLUTE' or name == 'JUMP_FORWARD':
+            self.spill()
+            self.finish(_goto(arg))
+            return True
+        elif name == 'POP_JUMP_IF_TRUE' or name == 'POP_JUMP_IF_FALSE':
+            condition = self.pop_effect(1)[0]
+            self.spill()
+            self.finish(_branch(condition.raw, arg, pc + 1,
+                                name == 'POP_JUMP_IF_TRUE'))
+            return True
+        elif name.startswith('JUMP_IF_NOT_'):
+            left, right = self.pop_effect(2)
+            compare = COMPARISONS[name[len('JUMP_IF_NOT_'):]]
+            condition = _binary(TYPE_BOOL, compare, left, right, False)
+            self.spill()
+            self.finish(_branch(condition.raw, arg, pc + 1, False))
+            return True
+        else:
+            # Calls, processes, channels, ALT and STORE by name work on
+            # frame.stack, through the interpreter's handler.
+            self.spill()
+            handler = HANDLERS[opcode(name)]
+            if name in SWITCHING:
+                self.finish(_handler(handler, arg, pc))
+                return True
+            self.statements.append(_handler(handler, arg, pc))
+            types = code.stack_types[pc + 1]
+            self.depth = len(types)
+            self.stack = [_slot(i, types[i]) for i in range(len(types))]
+        return False
+
+    def pop_effect(self, count):
+        """Pop the count operands of an instruction with side effects.
+
+        Anything below them which could fail or read a global is
+        computed first, as the interpreter would have done.
+        """
+        operands = self.stack[len(self.stack) - count:]
+        del self.stack[len(self.stack) - count:]
+        for value in self.stack:
+            if not value.safe:
+                self.spill()
+                break
+        return operands
+
+    def spill(self):
+        """Box every value on the simulated stack onto frame.stack.
+        """
+        moves = []
+        for i in range(len(self.stack)):
+            value = self.stack[i]
+            if value.slot != i:
+                moves.append((i, value.boxed()))
+                self.stack[i] = _slot(i, value.kind)
+        depth = len(self.stack)
+        if len(moves) > 0 or depth != self.depth:
+            self.statements.append(_store_stack(moves, depth))
+            self.depth = depth
+
+    def finish(self, terminator):
+        self.terminator = terminator
+
+    def closure(self):
+        """Return a closure which runs the block.
+        """
+        statements = tuple(self.statements)
+        terminator = self.terminator
+        if len(statements) == 0:
+            return terminator
+        if len(statements) == 1:
+            statement = statements[0]
+
+            def block(frame):
+                statement(frame)
+                return terminator(frame)
+            return block
+
+        def block(frame):
+            for statement in statements:
+                statement(frame)
+            return terminator(frame)
+        return block
+
+
+def _slot(i, kind):
+    def box(frame):
+        return frame.stack[i]
+    if kind == TYPE_INT:
+        return Value(kind, lambda frame: frame.stack[i].integer, box, slot=i)
+    elif kind == TYPE_BOOL:
+        return Value(kind, lambda frame: frame.stack[i].boolean, box, slot=i)
+    return Value(kind, box, box, slot=i)
+
+
+def _const(integer):
+    return Value(TYPE_INT, lambda frame: integer, const=integer)
+
+
+def _load_global(heap, slot):
+    values, bound = heap.values, heap.bound
+
+    def load_global(frame):
+        if not bound[slot]:
+            raise KeyError('Global not defined: ' + heap.names[slot])
+        return values[slot]
+    return Value(TYPE_INT, load_global, safe=False)
+
+
+def _load_arg(i, kind):
+    def box(frame):
+        return frame.args[i]
+    if kind == TYPE_INT:
+        return Value(kind, lambda frame: frame.args[i].integer, box)
+    elif kind == TYPE_BOOL:
+        return Value(kind, lambda frame: frame.args[i].boolean, box)
+    return Value(kind, box, box)
+
+
+def _binary(kind, op, left, right, may_fail):
+    """Return the Value of op applied to two int Values.
+
+    Constants are folded, unless op may fail on them.
+    """
+    safe = left.safe and right.safe and not may_fail
+    lraw, rraw = left.raw, right.raw
+    lconst, rconst = left.const, right.const
+    if lconst is not None and rconst is not None and not may_fail:
+        result = op(lconst, rconst)
+        if kind == TYPE_INT:
+            return _const(result)
+        return Value(kind, lambda frame: result)
+    if rconst is not None:
+        return Value(kind, lambda frame: op(lraw(frame), rconst), safe=safe)
+    elif lconst is not None:
+        return Value(kind, lambda frame: op(lconst, rraw(frame)), safe=safe)
+    return Value(kind, lambda frame: op(lraw(frame), rraw(frame)),
+                 safe=safe)
+
+
+def _store_global(heap, slot, raw):
+    values, bound = heap.values, heap.bound
+
+    def store_global(frame):
+        values[slot] = raw(frame)
+        bound[slot] = True
+    return store_global
+
+
+def _print_item(value):
+    raw = value.raw
+    if value.kind == TYPE_INT or value.kind == TYPE_BOOL:
+        return lambda frame: stdout.write_item(str(raw(frame)))
+    return lambda frame: stdout.write_item(raw(frame).__repr__())
+
+
+def _store_stack(moves, depth):
+    moves = tuple(moves)
+
+    def store_stack(frame):
+        stack = frame.stack
+        for i, boxed in moves:
+            stack[i] = boxed(frame)
+        frame.sp = depth
+    return store_stack
+
+
+def _goto(target):
+    return lambda frame: target
+
+
+def _branch(condition, target, following, if_true):
+    if if_true:
+        return lambda frame: target if condition(frame) else following
+    return lambda frame: following if condition(frame) else target
+
+
+def _handler(handler, arg, pc):
+    return lambda frame: handler(frame, arg, pc)
+
+
+def _end(pc):
+    return lambda frame: end_process(frame, pc)
+
+
+def execute(frame, compiler):
+    """Run compiled blocks until no process can run.
+
+    frame should be the frame of main, as for
+    rcsp.interpreter.execute.
+    """
+    blocks = compiler.blocks(frame.code)
+    pc = frame.pc
+    while True:
+        block = blocks[pc]
+        if block is None:
+            block = compiler.compile_block(frame.code, pc)
+        pc = block(frame)
+        if pc == SWITCH:
+            frame = frame.next_frame
+            if frame is None:
+                return
+            blocks = compiler.blocks(frame.code)
+            pc = frame.pc
+
+
+def mainloop(program):
+    """Run a program with this engine.
+
+    Returns the stack of main and a dict of the global variables, as
+    rcsp.interpreter.mainloop does.
+    """
+    link_program(program)
+    heap = Heap(program.globals, program.slots)
+    scheduler = Scheduler()
+    frame = Frame(program.get('main'), heap, program.code_table,
+                  scheduler.main)
+    try:
+        execute(frame, Compiler(heap))
+    finally:
+        stdout.flush()
+    if not scheduler.main.done:
+        raise DeadlockError('main is blocked and no process can run')
+    return frame.live_stack(), heap.as_dict()
@@ -0,0 +1,117 @@
+"""
+Decoder for a simple CSP bytecode language.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from rcsp.parser import is_source_opcode, opcode
+from rcsp.parser import opcode_has_arg, opcode_has_name_arg
+
+
+__date__ = 'August 2013'
+__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
+
+
+def decode_code(code):
+    """Decode the bytecode of a rcsp.box.CodeBox object.
+
+    The parser produces a flat list of opcodes, each of which may be
+    followed by an index into one of the literal pools of the
+    CodeBox. The decoder turns this into two parallel lists,
+    code.ops and code.args, with one entry per instruction:
+
+      * LOAD_CONST holds the integer constant itself,
+      * ALT and PRI_ALT hold their number of guards,
+      * jumps hold the absolute index of their target instruction,
+      * instructions with a name operand hold their index into
+        code.strings,
+      * instructions without an operand hold 0.
+
+    code.offsets maps each instruction back to its position in the
+    original bytecode. Decoding a CodeBox twice has no effect.
+    """
+    if code.decoded:
+        return
+    bytecode = code.bytecode
+    ops, args, offsets = [], [], []
+    # Map bytecode offsets to instruction indices. Offsets which
+    # hold operands map to -1 and cannot be jumped to.
+    index = [-1] * (len(bytecode) + 1)
+    pc = 0
+    while pc < len(bytecode):
+        op = bytecode[pc]
+        if not is_source_opcode(op):
+            raise TypeError('No such CSPC opcode: ' + str(op))
+        index[pc] = len(ops)
+        ops.append(op)
+        offsets.append(pc)
+        if opcode_has_arg(op):
+            if pc + 1 >= len(bytecode):
+                raise TypeError('Missing operand at ' + str(pc))
+            args.append(bytecode[pc + 1])
+            pc += 2
+        else:
+            args.append(0)
+            pc += 1
+    index[len(bytecode)] = len(ops)
+    # Resolve operands now that every instruction has an index.
+    for i in range(len(ops)):
+        op = ops[i]
+        if op == opcode('LOAD_CONST'):
+            _check_operand(len(code.integers), args[i], offsets[i])
+            args[i] = code.integers[args[i]]
+        elif op == opcode('ALT') or op == opcode('PRI_ALT'):
+            _check_operand(len(code.integers), args[i], offsets[i])
+            args[i] = code.integers[args[i]]
+            if args[i] < 1:
+                raise TypeError('ALT needs a guard at ' + str(offsets[i]))
+        elif op == opcode('JUMP_FORWARD'):
+            _check_operand(len(code.targets), args[i], offsets[i])
+            delta = code.targets[args[i]]
+            args[i] = _jump_target(index, offsets[i] + delta + 1)
+        elif (op == opcode('JUMP_ABSOLUTE') or
+              op == opcode('POP_JUMP_IF_TRUE') or
+              op == opcode('POP_JUMP_IF_FALSE')):
+            _check_operand(len(code.targets), args[i], offsets[i])
+            args[i] = _jump_target(index, code.targets[args[i]])
+        elif opcode_has_name_arg(op):
+            _check_operand(len(code.strings), args[i], offsets[i])
+    code.ops = ops[:]
+    code.args = args[:]
+    code.offsets = offsets
+    code.decoded = True
+
+
+def _check_operand(pool_size, arg, pc):
+    """Check that arg is a valid index into a literal pool.
+    """
+    if arg < 0 or arg >= pool_size:
+        raise TypeError('Bad operand at ' + str(pc) + ': ' + str(arg))
+
+
+def _jump_target(index, offset):
+    """Return the instruction index of a bytecode offset.
+    """
+    if offset < 0 or offset >= len(index) or index[offset] < 0:
+        raise TypeError('Bad jump target: ' + str(offset))
+    return index[offset]
+
+
+def decode_program(program):
+    """Decode every function in a rcsp.box.ProgramBox object.
+    """
+    for name in program.get_functions():
+        decode_code(program.get(name))
@@ -22,16 +22,21 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function
 
-import os
 import sys
 
-from rcsp.box import IntBox
-from rcsp.box import StringBox
+from rcsp.box import ChannelBox, StringBox, Waiter
+from rcsp.box import box_bool, box_int
 
-from rcsp.parser import opcode, opcode_values, parse_bytecode_file, DEBUG
+from rcsp.linker import link_program, unquicken
+from rcsp.loader import load_file
+from rcsp.optimizer import MAX_LEVEL, NEGATED
+from rcsp.output import MODES, default_mode, stdout
+from rcsp.parser import opcode, opcode_mnemonic, NUM_OPCODES, DEBUG
+from rcsp.parser import SUPERINSTRUCTIONS
+from rcsp.verifier import TYPE_BOOL
 
 try:
-    from rpython.rlib.jit import JitDriver
+    from rpython.rlib.jit import JitDriver, promote, we_are_jitted
 except ImportError:
     class JitDriver(object):
         def __init__(self, **kw):
@@ -43,165 +48,1369 @@ except ImportError:
         def can_enter_jit(self, **kw):
             pass
 
+    def promote(value):
+        return value
+
+    def we_are_jitted():
+        return False
+
+try:
+    from rpython.rlib.unroll import unrolling_iterable
+except ImportError:
+    unrolling_iterable = tuple
+
+try:
+    from rpython.rlib.objectmodel import we_are_translated
+except ImportError:
+    def we_are_translated():
+        return False
+
+
+def get_printable_location(pc, code):
+    """Describe a position in the code, for the jit-log-opt output.
+    """
+    if pc < len(code.ops):
+        return str(pc) + ': ' + opcode_mnemonic(code.ops[pc])
+    return str(pc) + ': <end>'
+
+
 # In the mainloop function green variables are read from, and
-# red variables are written to.
+# red variables are written to. A loop starts wherever a jump goes
+# backwards, and execute tells the JIT so with can_enter_jit. A
+# program has two drivers, one for each stack representation, and
+# RPython then needs both marked as recursive.
 jitdriver = JitDriver(greens=['pc', 'code'],
-                      reds=['heap', 'stack'])
+                      reds=['frame'],
+                      get_printable_location=get_printable_location,
+                      is_recursive=True)
+unboxed_jitdriver = JitDriver(greens=['pc', 'code'],
+                              reds=['frame'],
+                              get_printable_location=get_printable_location,
+                              is_recursive=True)
 
 __date__ = 'August 2013'
 __author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
 
 
-def mainloop(program):
-    """Main loop of the interpreter.
+class Heap(object):
+    """Global variables, held in the slots assigned by rcsp.linker.
     """
-    pc = 0     # Program counter is the 'top' of the stack.
-    fp = {}    # Fn pointer tracks where on the stack each fn was pushed.
-    # TODO: pre-compute heap size and allocate at start.
-    heap = {}  # Only have a global heap for now.
-    stack = []
-    code = program.get('main')
-    fp['main'] = 0  # main always goes on an empty stack.
-    while pc < len(code.bytecode):
-        # Greens = pc, code. Reds = stack, heap.
-        jitdriver.jit_merge_point(pc=pc, code=code,
-                                  stack=stack, heap=heap)
-        if DEBUG:
-            print('LEN:', len(code.bytecode), 'PC:', pc,
-                  '\tSTACK:', stack, '\tHEAP:', heap)
-        # Arithmetic operation code.bytecodes.
-        if code.bytecode[pc] == opcode('ADD'):
-            r = stack.pop()
-            l = stack.pop()
-            stack.append(l.add(r))
-        elif code.bytecode[pc] == opcode('MINUS'):
-            r = stack.pop()
-            l = stack.pop()
-            stack.append(l.minus(r))
-        elif code.bytecode[pc] == opcode('TIMES'):
-            r = stack.pop()
-            l = stack.pop()
-            stack.append(l.times(r))
-        elif code.bytecode[pc] == opcode('DIV'):
-            r = stack.pop()
-            l = stack.pop()
-            stack.append(l.div(r))
-        elif code.bytecode[pc] == opcode('MOD'):
-            r = stack.pop()
-            l = stack.pop()
-            stack.append(l.mod(r))
-        # Comparative operation code.bytecodes.
-        elif code.bytecode[pc] == opcode('GT'):
-            r = stack.pop()
-            l = stack.pop()
-            stack.append(l.gt(r))
-        elif code.bytecode[pc] == opcode('LT'):
-            r = stack.pop()
-            l = stack.pop()
-            stack.append(l.lt(r))
-        elif code.bytecode[pc] == opcode('GEQ'):
-            r = stack.pop()
-            l = stack.pop()
-            stack.append(l.geq(r))
-        elif code.bytecode[pc] == opcode('LEQ'):
-            r = stack.pop()
-            l = stack.pop()
-            stack.append(l.leq(r))
-        elif code.bytecode[pc] == opcode('EQ'):
-            r = stack.pop()
-            l = stack.pop()
-            stack.append(l.eq(r))
-        elif code.bytecode[pc] == opcode('NEQ'):
-            r = stack.pop()
-            l = stack.pop()
-            stack.append(l.neq(r))
-        # I/O code.bytecodes.
-        elif code.bytecode[pc] == opcode('PRINT_ITEM'):
-            value = stack.pop()
-            print(value.__repr__())
-        elif code.bytecode[pc] == opcode('PRINT_NEWLINE'):
-            print()
-        # Global variable code.bytecodes.
-        elif code.bytecode[pc] == opcode('STORE'):
-            # TODO: A bit of error checking here would be nice.
-            name = stack.pop().string
-            lit = stack.pop().integer
-            heap[name] = lit
-        elif code.bytecode[pc] == opcode('LOAD_GLOBAL'):
-            # TODO: Should the heap really hold raw string / int types?
-            # TODO: Probably not.
-            g = heap[code.strings[code.bytecode[pc + 1]]]
-            stack.append(IntBox(g))
-            pc += 1
-        elif code.bytecode[pc] == opcode('LOAD_CONST'):
-            const = code.integers[code.bytecode[pc + 1]]
-            stack.append(IntBox(const))
-            pc += 1
-        elif code.bytecode[pc] == opcode('LOAD_NAME'):
-            name = code.strings[code.bytecode[pc + 1]]
-            stack.append(StringBox(name))
-            pc += 1
-        # Control flow.
-        elif code.bytecode[pc] == opcode('JUMP_FORWARD'):
-            delta = code.integers[code.bytecode[pc + 1]]
-            pc += delta
-        elif code.bytecode[pc] == opcode('POP_JUMP_IF_TRUE'):
-            boolean = stack.pop()
-            if boolean.boolean:
-                new_pc = code.integers[code.bytecode[pc + 1]]
-                pc = new_pc - 1
+
+    def __init__(self, names, slots):
+        self.names = names  # list of names, indexed by slot
+        self.slots = slots  # dict of names -> slots
+        self.values = [0] * len(names)
+        self.bound = [False] * len(names)
+
+    def load(self, slot):
+        if not self.bound[slot]:
+            raise KeyError('Global not defined: ' + self.names[slot])
+        return self.values[slot]
+
+    def store(self, slot, value):
+        self.values[slot] = value
+        self.bound[slot] = True
+
+    def slot(self, name):
+        return self.slots[name]
+
+    def as_dict(self):
+        """Return a dict of names -> values of all bound globals.
+        """
+        view = {}
+        for slot in range(len(self.names)):
+            if self.bound[slot]:
+                view[self.names[slot]] = self.values[slot]
+        return view
+
+    def __repr__(self):
+        return self.as_dict().__repr__()
+
+
+class DeadlockError(Exception):
+    """Raised when main is blocked and no process can run.
+    """
+
+
+class Process(object):
+    """A CSP process: one chain of frames, run by a Scheduler.
+
+    frame is the innermost frame of the process, saved whenever the
+    process stops running. next links runnable processes in the run
+    queue of the scheduler. waiter queues the process on a channel
+    for CHAN_SEND and CHAN_RECV, and alt_waiters, one per guard, on
+    every enabled channel of an ALT. value holds an int which the
+    process is waiting to send. alt_next is the guard which a fair
+    ALT looks at first, and alt_serial counts the ALTs at which the
+    process has blocked.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.frame = None
+        self.next = None
+        self.waiter = Waiter(self, -1)
+        self.alt_waiters = []
+        self.alt_count = 0
+        self.alt_next = 0
+        self.alt_serial = 0
+        self.value = 0
+        self.done = False
+
+
+class Scheduler(object):
+    """Cooperative scheduler for the processes of a program.
+
+    Processes run on one OS thread, each until it blocks on a channel
+    or finishes. The run queue is a FIFO linked through Process.next,
+    so adding and removing a process are both O(1).
+
+    pool is the rcsp.multicore pool which this scheduler is a worker
+    of, or None.
+    """
+
+    def __init__(self):
+        self.main = Process(self)
+        self.head = None  # Next process to run.
+        self.tail = None  # Last process to run.
+        self.pool = None
+
+    def ready(self, process):
+        """Add a process to the end of the run queue.
+        """
+        process.next = None
+        if self.tail is None:
+            self.head = process
+        else:
+            self.tail.next = process
+        self.tail = process
+
+    def next_frame(self):
+        """Remove the next process from the run queue.
+
+        Returns the frame to resume that process at, or None if no
+        process is runnable.
+        """
+        process = self.head
+        if process is None:
+            return None
+        self.head = process.next
+        if self.head is None:
+            self.tail = None
+        process.next = None
+        return process.frame
+
+
+class Frame(object):
+    """Execution state of one call to a function.
+
+    The operand stack is preallocated to the maximum depth found by
+    rcsp.verifier and sp is the index of the first free slot. Frames
+    are linked to their caller through parent, rather than by
+    recursion in the interpreter, and are recycled through the
+    free_frames list of their code (see new_frame and free_frame).
+    """
+
+    # Set once, so the JIT can read them without guards.
+    _immutable_fields_ = ['code', 'stack', 'ints', 'args', 'int_args']
+
+    def __init__(self, code, heap, functions, process):
+        self.code = code
+        self.stack = [None] * code.max_depth
+        self.ints = [0] * code.max_depth  # Used by the unboxed handlers.
+        self.sp = 0
+        self.args = [None] * len(code.params)
+        self.int_args = [0] * len(code.params)
+        self.heap = heap
+        self.functions = functions  # list of code boxes
+        self.process = process      # Process running this frame.
+        self.parent = None          # Calling frame, None at the top.
+        self.pc = 0                 # Where to resume this frame.
+        self.next_frame = None      # Frame to switch to, see SWITCH.
+
+    def push(self, value):
+        self.stack[self.sp] = value
+        self.sp += 1
+
+    def pop(self):
+        self.sp -= 1
+        return self.stack[self.sp]
+
+    def push_int(self, value):
+        self.ints[self.sp] = value
+        self.sp += 1
+
+    def pop_int(self):
+        self.sp -= 1
+        return self.ints[self.sp]
+
+    def live_stack(self):
+        """Return the boxed values currently on the stack.
+        """
+        sp = self.sp
+        assert sp >= 0
+        return self.stack[:sp]
+
+
+# Opcode handlers. Each handler takes the current frame, the decoded
+# operand and the pc of the instruction being executed and returns the
+# pc of the next instruction. All handlers must have the same
+# signature so that rpython can call them through the HANDLERS table.
+#
+# Handlers only ever run code which has passed rcsp.verifier, so they
+# do not check the types of their operands or for stack underflow.
+
+# Arithmetic operation bytecodes. Binary operations overwrite their
+# left operand with the result, rather than popping it and pushing.
+def op_add(frame, arg, pc):
+    sp = frame.sp - 1
+    stack = frame.stack
+    stack[sp - 1] = box_int(stack[sp - 1].integer + stack[sp].integer)
+    frame.sp = sp
+    return pc + 1
+
+
+def op_minus(frame, arg, pc):
+    sp = frame.sp - 1
+    stack = frame.stack
+    stack[sp - 1] = box_int(stack[sp - 1].integer - stack[sp].integer)
+    frame.sp = sp
+    return pc + 1
+
+
+def op_times(frame, arg, pc):
+    sp = frame.sp - 1
+    stack = frame.stack
+    stack[sp - 1] = box_int(stack[sp - 1].integer * stack[sp].integer)
+    frame.sp = sp
+    return pc + 1
+
+
+def op_div(frame, arg, pc):
+    sp = frame.sp - 1
+    stack = frame.stack
+    stack[sp - 1] = box_int(stack[sp - 1].integer / stack[sp].integer)
+    frame.sp = sp
+    return pc + 1
+
+
+def op_mod(frame, arg, pc):
+    sp = frame.sp - 1
+    stack = frame.stack
+    stack[sp - 1] = box_int(stack[sp - 1].integer % stack[sp].integer)
+    frame.sp = sp
+    return pc + 1
+
+
+# Comparative operation bytecodes.
+def op_gt(frame, arg, pc):
+    sp = frame.sp - 1
+    stack = frame.stack
+    stack[sp - 1] = box_bool(stack[sp - 1].integer > stack[sp].integer)
+    frame.sp = sp
+    return pc + 1
+
+
+def op_lt(frame, arg, pc):
+    sp = frame.sp - 1
+    stack = frame.stack
+    stack[sp - 1] = box_bool(stack[sp - 1].integer < stack[sp].integer)
+    frame.sp = sp
+    return pc + 1
+
+
+def op_geq(frame, arg, pc):
+    sp = frame.sp - 1
+    stack = frame.stack
+    stack[sp - 1] = box_bool(stack[sp - 1].integer >= stack[sp].integer)
+    frame.sp = sp
+    return pc + 1
+
+
+def op_leq(frame, arg, pc):
+    sp = frame.sp - 1
+    stack = frame.stack
+    stack[sp - 1] = box_bool(stack[sp - 1].integer <= stack[sp].integer)
+    frame.sp = sp
+    return pc + 1
+
+
+def op_eq(frame, arg, pc):
+    sp = frame.sp - 1
+    stack = frame.stack
+    stack[sp - 1] = box_bool(stack[sp - 1].integer == stack[sp].integer)
+    frame.sp = sp
+    return pc + 1
+
+
+def op_neq(frame, arg, pc):
+    sp = frame.sp - 1
+    stack = frame.stack
+    stack[sp - 1] = box_bool(stack[sp - 1].integer != stack[sp].integer)
+    frame.sp = sp
+    return pc + 1
+
+
+# I/O bytecodes.
+def op_print_item(frame, arg, pc):
+    value = frame.pop()
+    stdout.write_item(value.__repr__())
+    return pc + 1
+
+
+def op_print_newline(frame, arg, pc):
+    stdout.write_newline()
+    return pc + 1
+
+
+# Global variable bytecodes.
+def op_store(frame, arg, pc):
+    name = frame.pop().string
+    lit = frame.pop().integer
+    frame.heap.store(frame.heap.slot(name), lit)
+    return pc + 1
+
+
+def op_store_global(frame, arg, pc):
+    lit = frame.pop().integer
+    frame.heap.store(arg, lit)
+    return pc + 1
+
+
+def op_load_global(frame, arg, pc):
+    # TODO: Should the heap really hold raw string / int types?
+    # TODO: Probably not.
+    frame.push(box_int(frame.heap.load(arg)))
+    return pc + 1
+
+
+def op_load_const(frame, arg, pc):
+    frame.push(box_int(arg))
+    return pc + 1
+
+
+def op_load_name(frame, arg, pc):
+    frame.push(StringBox(frame.code.strings[arg]))
+    return pc + 1
+
+
+# Control flow. The decoder has already turned every jump operand
+# into the absolute index of the target instruction.
+def op_pop_jump_if_true(frame, arg, pc):
+    boolean = frame.pop()
+    if boolean.boolean:
+        return arg
+    return pc + 1
+
+
+def op_pop_jump_if_false(frame, arg, pc):
+    boolean = frame.pop()
+    if not boolean.boolean:
+        return arg
+    return pc + 1
+
+
+def op_jump_absolute(frame, arg, pc):
+    return arg
+
+
+# Comparisons fused with a branch by rcsp.optimizer. Each jumps if its
+# comparison is false, without building a bool.
+def op_jump_if_not_gt(frame, arg, pc):
+    sp = frame.sp - 2
+    stack = frame.stack
+    frame.sp = sp
+    if stack[sp].integer > stack[sp + 1].integer:
+        return pc + 1
+    return arg
+
+
+def op_jump_if_not_lt(frame, arg, pc):
+    sp = frame.sp - 2
+    stack = frame.stack
+    frame.sp = sp
+    if stack[sp].integer < stack[sp + 1].integer:
+        return pc + 1
+    return arg
+
+
+def op_jump_if_not_eq(frame, arg, pc):
+    sp = frame.sp - 2
+    stack = frame.stack
+    frame.sp = sp
+    if stack[sp].integer == stack[sp + 1].integer:
+        return pc + 1
+    return arg
+
+
+def op_jump_if_not_neq(frame, arg, pc):
+    sp = frame.sp - 2
+    stack = frame.stack
+    frame.sp = sp
+    if stack[sp].integer != stack[sp + 1].integer:
+        return pc + 1
+    return arg
+
+
+def op_jump_if_not_geq(frame, arg, pc):
+    sp = frame.sp - 2
+    stack = frame.stack
+    frame.sp = sp
+    if stack[sp].integer >= stack[sp + 1].integer:
+        return pc + 1
+    return arg
+
+
+def op_jump_if_not_leq(frame, arg, pc):
+    sp = frame.sp - 2
+    stack = frame.stack
+    frame.sp = sp
+    if stack[sp].integer <= stack[sp + 1].integer:
+        return pc + 1
+    return arg
+
+
+# Function creation and calls. A handler which leaves the current
+# frame stores the frame to run next in frame.next_frame, and the pc
+# to resume at in that frame's pc, then returns SWITCH. When main
+# returns, next_frame is None and the program halts, leaving the
+# return value on the stack of main.
+SWITCH = -1
+
+
+def new_frame(code, caller):
+    """Return a frame for a call to code, reusing a free one if possible.
+    """
+    if len(code.free_frames) > 0:
+        frame = code.free_frames.pop()
+        frame.sp = 0
+        frame.heap = caller.heap
+        frame.functions = caller.functions
+        frame.process = caller.process
+    else:
+        frame = Frame(code, caller.heap, caller.functions, caller.process)
+    frame.parent = caller
+    frame.pc = 0
+    return frame
+
+
+def free_frame(frame):
+    """Return a frame to the free list of its code.
+    """
+    frame.parent = None
+    frame.code.free_frames.append(frame)
+
+
+def op_call_function(frame, arg, pc):
+    callee = new_frame(frame.functions[arg], frame)
+    for i in range(len(callee.args) - 1, -1, -1):
+        callee.args[i] = frame.pop()
+    frame.pc = pc + 1
+    frame.next_frame = callee
+    return SWITCH
+
+
+def op_load_arg(frame, arg, pc):
+    frame.push(frame.args[arg])
+    return pc + 1
+
+
+# TODO: 'MAKE_FUNCTION'
+def op_make_function(frame, arg, pc):
+    return pc + 1
+
+
+def end_process(frame, pc):
+    """Finish the process whose outermost frame is frame.
+
+    The process which runs next is stored in frame.next_frame. The
+    frame of main is kept, so that its stack can be inspected.
+    """
+    frame.pc = pc
+    process = frame.process
+    process.done = True
+    if process is not process.scheduler.main:
+        free_frame(frame)
+    frame.next_frame = process.scheduler.next_frame()
+    return SWITCH
+
+
+def op_return(frame, arg, pc):
+    caller = frame.parent
+    if caller is None:
+        return end_process(frame, pc)
+    caller.push(frame.pop())
+    frame.next_frame = caller
+    free_frame(frame)
+    return SWITCH
+
+
+# Processes and channels. A process which blocks saves its frame, to
+# be resumed at the next instruction, and switches to the next
+# runnable process. A process which blocks on CHAN_RECV or ALT is handed
+# its value by the sender which releases it.
+def block(frame, pc):
+    frame.pc = pc + 1
+    frame.process.frame = frame
+    frame.next_frame = frame.process.scheduler.next_frame()
+    return SWITCH
+
+
+def op_par(frame, arg, pc):
+    pool = frame.process.scheduler.pool
+    if pool is not None and pool.spawn(frame, arg):
+        return pc + 1
+    process = Process(frame.process.scheduler)
+    child = new_frame(frame.functions[arg], frame)
+    child.parent = None
+    child.process = process
+    for i in range(len(child.args) - 1, -1, -1):
+        child.args[i] = frame.pop()
+    process.frame = child
+    process.scheduler.ready(process)
+    return pc + 1
+
+
+def op_chan_new(frame, arg, pc):
+    frame.push(ChannelBox())
+    return pc + 1
+
+
+def op_chan_send(frame, arg, pc):
+    value = frame.pop().integer
+    channel = frame.pop()
+    if channel.shared is not None:
+        return channel.shared.send(frame, value, pc)
+    if channel.has_receivers():
+        receiver = channel.release()
+        deliver(receiver, value)
+        frame.process.scheduler.ready(receiver.process)
+        return pc + 1
+    frame.process.value = value
+    channel.wait(frame.process.waiter, True)
+    return block(frame, pc)
+
+
+def op_chan_recv(frame, arg, pc):
+    channel = frame.pop()
+    if channel.shared is not None:
+        return channel.shared.recv(frame, pc)
+    if channel.has_senders():
+        sender = channel.release().process
+        frame.push(box_int(sender.value))
+        frame.process.scheduler.ready(sender)
+        return pc + 1
+    channel.wait(frame.process.waiter, False)
+    return block(frame, pc)
+
+
+def deliver(waiter, value):
+    """Hand value to the blocked receiver waiting through waiter.
+
+    If the receiver is blocked on an ALT it leaves the queues of its
+    other channels and is also handed the number of its chosen guard.
+    """
+    process = waiter.process
+    process.frame.push(box_int(value))
+    if waiter.index >= 0:
+        end_alt(process, waiter.index)
+
+
+def end_alt(process, index):
+    """Finish the ALT which process is blocked on, choosing guard index.
+
+    The value received must already have been pushed.
+    """
+    for i in range(process.alt_count):
+        other = process.alt_waiters[i]
+        if other.channel is not None:
+            other.channel.remove(other)
+    process.alt_count = 0
+    process.alt_next = index + 1
+    process.frame.push(box_int(index))
+
+
+def alt(frame, count, pc, first):
+    """Receive from whichever enabled guard of an ALT is ready.
+
+    The stack holds count pairs of a guard and a channel. Guards are
+    tried in order starting from first. If none is ready the process
+    waits on every enabled channel at once and the first sender to
+    arrive wakes it up, so a blocked ALT is never polled. An ALT
+    whose guards are all false blocks forever, like STOP.
+    """
+    stack = frame.stack
+    base = frame.sp - 2 * count
+    frame.sp = base
+    process = frame.process
+    for j in range(count):
+        i = (first + j) % count
+        if stack[base + 2 * i].boolean:
+            channel = stack[base + 2 * i + 1]
+            if channel.shared is not None:
+                if channel.shared.take_into(frame):
+                    frame.push(box_int(i))
+                    process.alt_next = i + 1
+                    return pc + 1
+            elif channel.has_senders():
+                sender = channel.release().process
+                frame.push(box_int(sender.value))
+                frame.push(box_int(i))
+                process.alt_next = i + 1
+                process.scheduler.ready(sender)
+                return pc + 1
+    while len(process.alt_waiters) < count:
+        process.alt_waiters.append(Waiter(process,
+                                          len(process.alt_waiters)))
+    process.alt_count = count
+    process.alt_serial += 1
+    for i in range(count):
+        if stack[base + 2 * i].boolean:
+            channel = stack[base + 2 * i + 1]
+            if channel.shared is not None:
+                channel.shared.wait_alt(process, i)
             else:
-                pc += 1
-        elif code.bytecode[pc] == opcode('POP_JUMP_IF_FALSE'):
-            boolean = stack.pop()
-            if not boolean.boolean:
-                new_pc = code.integers[code.bytecode[pc + 1]]
-                pc = new_pc - 1
+                channel.wait(process.alt_waiters[i], False)
+    return block(frame, pc)
+
+
+def op_alt(frame, arg, pc):
+    # Fair: start after the guard chosen last time.
+    return alt(frame, arg, pc, frame.process.alt_next % arg)
+
+
+def op_pri_alt(frame, arg, pc):
+    return alt(frame, arg, pc, 0)
+
+
+def op_unknown(frame, arg, pc):
+    raise TypeError('No such CSPC opcode: ' + str(frame.code.ops[pc]))
+
+
+def make_handler_table(handlers):
+    """Build a dense list of handlers, indexed by numeric opcode.
+
+    handlers should be a dict of mnemonics -> handler functions.
+    Opcodes without a handler are mapped to op_unknown.
+    """
+    table = [op_unknown] * NUM_OPCODES
+    for name in handlers:
+        table[opcode(name)] = handlers[name]
+    return table
+
+
+HANDLERS = make_handler_table({
+    'ADD': op_add, 'MINUS': op_minus, 'TIMES': op_times,
+    'DIV': op_div, 'MOD': op_mod,
+    'GT': op_gt, 'LT': op_lt, 'GEQ': op_geq, 'LEQ': op_leq,
+    'EQ': op_eq, 'NEQ': op_neq,
+    'PRINT_ITEM': op_print_item, 'PRINT_NEWLINE': op_print_newline,
+    'STORE': op_store, 'STORE_GLOBAL': op_store_global,
+    'LOAD_GLOBAL': op_load_global,
+    'LOAD_CONST': op_load_const, 'LOAD_NAME': op_load_name,
+    'JUMP_FORWARD': op_jump_absolute,
+    'POP_JUMP_IF_TRUE': op_pop_jump_if_true,
+    'POP_JUMP_IF_FALSE': op_pop_jump_if_false,
+    'JUMP_ABSOLUTE': op_jump_absolute,
+    'JUMP_IF_NOT_GT': op_jump_if_not_gt, 'JUMP_IF_NOT_LT': op_jump_if_not_lt,
+    'JUMP_IF_NOT_EQ': op_jump_if_not_eq,
+    'JUMP_IF_NOT_NEQ': op_jump_if_not_neq,
+    'JUMP_IF_NOT_GEQ': op_jump_if_not_geq,
+    'JUMP_IF_NOT_LEQ': op_jump_if_not_leq,
+    'CALL_FUNCTION': op_call_function,
+    'LOAD_ARG': op_load_arg,
+    'MAKE_FUNCTION': op_make_function,
+    'RETURN': op_return,
+    'PAR': op_par,
+    'CHAN_NEW': op_chan_new, 'CHAN_SEND': op_chan_send,
+    'CHAN_RECV': op_chan_recv,
+    'ALT': op_alt, 'PRI_ALT': op_pri_alt,
+})
+
+
+# Unboxed opcode handlers. These are only used for code which
+# rcsp.verifier has proved to hold nothing but ints and bools on the
+# stack. They work on frame.ints rather than frame.stack, and bools
+# are held as 0 or 1.
+def uop_add(frame, arg, pc):
+    sp = frame.sp - 1
+    ints = frame.ints
+    ints[sp - 1] = ints[sp - 1] + ints[sp]
+    frame.sp = sp
+    return pc + 1
+
+
+def uop_minus(frame, arg, pc):
+    sp = frame.sp - 1
+    ints = frame.ints
+    ints[sp - 1] = ints[sp - 1] - ints[sp]
+    frame.sp = sp
+    return pc + 1
+
+
+def uop_times(frame, arg, pc):
+    sp = frame.sp - 1
+    ints = frame.ints
+    ints[sp - 1] = ints[sp - 1] * ints[sp]
+    frame.sp = sp
+    return pc + 1
+
+
+def uop_div(frame, arg, pc):
+    sp = frame.sp - 1
+    ints = frame.ints
+    ints[sp - 1] = ints[sp - 1] / ints[sp]
+    frame.sp = sp
+    return pc + 1
+
+
+def uop_mod(frame, arg, pc):
+    sp = frame.sp - 1
+    ints = frame.ints
+    ints[sp - 1] = ints[sp - 1] % ints[sp]
+    frame.sp = sp
+    return pc + 1
+
+
+def uop_gt(frame, arg, pc):
+    sp = frame.sp - 1
+    ints = frame.ints
+    ints[sp - 1] = int(ints[sp - 1] > ints[sp])
+    frame.sp = sp
+    return pc + 1
+
+
+def uop_lt(frame, arg, pc):
+    sp = frame.sp - 1
+    ints = frame.ints
+    ints[sp - 1] = int(ints[sp - 1] < ints[sp])
+    frame.sp = sp
+    return pc + 1
+
+
+def uop_geq(frame, arg, pc):
+    sp = frame.sp - 1
+    ints = frame.ints
+    ints[sp - 1] = int(ints[sp - 1] >= ints[sp])
+    frame.sp = sp
+    return pc + 1
+
+
+def uop_leq(frame, arg, pc):
+    sp = frame.sp - 1
+    ints = frame.ints
+    ints[sp - 1] = int(ints[sp - 1] <= ints[sp])
+    frame.sp = sp
+    return pc + 1
+
+
+def uop_eq(frame, arg, pc):
+    sp = frame.sp - 1
+    ints = frame.ints
+    ints[sp - 1] = int(ints[sp - 1] == ints[sp])
+    frame.sp = sp
+    return pc + 1
+
+
+def uop_neq(frame, arg, pc):
+    sp = frame.sp - 1
+    ints = frame.ints
+    ints[sp - 1] = int(ints[sp - 1] != ints[sp])
+    frame.sp = sp
+    return pc + 1
+
+
+def uop_print_item(frame, arg, pc):
+    # Values are boxed when they escape, so that bools print as bools.
+    slot_type = promote(frame.code).stack_types[pc][-1]
+    value = box_value(frame.pop_int(), slot_type)
+    stdout.write_item(value.__repr__())
+    return pc + 1
+
+
+def uop_store_global(frame, arg, pc):
+    frame.heap.store(arg, frame.pop_int())
+    return pc + 1
+
+
+def uop_load_global(frame, arg, pc):
+    frame.push_int(frame.heap.load(arg))
+    return pc + 1
+
+
+def uop_load_const(frame, arg, pc):
+    frame.push_int(arg)
+    return pc + 1
+
+
+def uop_pop_jump_if_true(frame, arg, pc):
+    if frame.pop_int():
+        return arg
+    return pc + 1
+
+
+def uop_pop_jump_if_false(frame, arg, pc):
+    if not frame.pop_int():
+        return arg
+    return pc + 1
+
+
+def uop_jump_if_not_gt(frame, arg, pc):
+    sp = frame.sp - 2
+    ints = frame.ints
+    frame.sp = sp
+    if ints[sp] > ints[sp + 1]:
+        return pc + 1
+    return arg
+
+
+def uop_jump_if_not_lt(frame, arg, pc):
+    sp = frame.sp - 2
+    ints = frame.ints
+    frame.sp = sp
+    if ints[sp] < ints[sp + 1]:
+        return pc + 1
+    return arg
+
+
+def uop_jump_if_not_eq(frame, arg, pc):
+    sp = frame.sp - 2
+    ints = frame.ints
+    frame.sp = sp
+    if ints[sp] == ints[sp + 1]:
+        return pc + 1
+    return arg
+
+
+def uop_jump_if_not_neq(frame, arg, pc):
+    sp = frame.sp - 2
+    ints = frame.ints
+    frame.sp = sp
+    if ints[sp] != ints[sp + 1]:
+        return pc + 1
+    return arg
+
+
+def uop_jump_if_not_geq(frame, arg, pc):
+    sp = frame.sp - 2
+    ints = frame.ints
+    frame.sp = sp
+    if ints[sp] >= ints[sp + 1]:
+        return pc + 1
+    return arg
+
+
+def uop_jump_if_not_leq(frame, arg, pc):
+    sp = frame.sp - 2
+    ints = frame.ints
+    frame.sp = sp
+    if ints[sp] <= ints[sp + 1]:
+        return pc + 1
+    return arg
+
+
+def uop_call_function(frame, arg, pc):
+    callee = new_frame(frame.functions[arg], frame)
+    for i in range(len(callee.int_args) - 1, -1, -1):
+        callee.int_args[i] = frame.pop_int()
+    frame.pc = pc + 1
+    frame.next_frame = callee
+    return SWITCH
+
+
+def uop_load_arg(frame, arg, pc):
+    frame.push_int(frame.int_args[arg])
+    return pc + 1
+
+
+def uop_return(frame, arg, pc):
+    caller = frame.parent
+    if caller is None:
+        return end_process(frame, pc)
+    caller.push_int(frame.pop_int())
+    frame.next_frame = caller
+    free_frame(frame)
+    return SWITCH
+
+
+UNBOXED_HANDLERS = make_handler_table({
+    'ADD': uop_add, 'MINUS': uop_minus, 'TIMES': uop_times,
+    'DIV': uop_div, 'MOD': uop_mod,
+    'GT': uop_gt, 'LT': uop_lt, 'GEQ': uop_geq, 'LEQ': uop_leq,
+    'EQ': uop_eq, 'NEQ': uop_neq,
+    'PRINT_ITEM': uop_print_item, 'PRINT_NEWLINE': op_print_newline,
+    'STORE_GLOBAL': uop_store_global, 'LOAD_GLOBAL': uop_load_global,
+    'LOAD_CONST': uop_load_const,
+    'JUMP_FORWARD': op_jump_absolute,
+    'POP_JUMP_IF_TRUE': uop_pop_jump_if_true,
+    'POP_JUMP_IF_FALSE': uop_pop_jump_if_false,
+    'JUMP_ABSOLUTE': op_jump_absolute,
+    'JUMP_IF_NOT_GT': uop_jump_if_not_gt,
+    'JUMP_IF_NOT_LT': uop_jump_if_not_lt,
+    'JUMP_IF_NOT_EQ': uop_jump_if_not_eq,
+    'JUMP_IF_NOT_NEQ': uop_jump_if_not_neq,
+    'JUMP_IF_NOT_GEQ': uop_jump_if_not_geq,
+    'JUMP_IF_NOT_LEQ': uop_jump_if_not_leq,
+    'CALL_FUNCTION': uop_call_function,
+    'LOAD_ARG': uop_load_arg,
+    'MAKE_FUNCTION': op_make_function,
+    'RETURN': uop_return,
+})
+
+
+def make_superinstruction(table, names):
+    """Return a handler which runs the handlers in table for a
+    sequence of mnemonics, one after another.
+
+    Every instruction of the sequence but the last must carry on at
+    the next instruction. The operand of each is read from the
+    instruction's own slot in code.args (see
+    rcsp.optimizer.combine_superinstructions).
+    """
+    handlers = unrolling_iterable([table[opcode(name)]
+                                   for name in names[:-1]])
+    last = table[opcode(names[-1])]
+    size = len(names) - 1
+
+    def op_superinstruction(frame, arg, pc):
+        args = promote(frame.code).args
+        i = 0
+        for handler in handlers:
+            handler(frame, args[pc + i], pc + i)
+            i += 1
+        return last(frame, args[pc + size], pc + size)
+    return op_superinstruction
+
+
+for _names in SUPERINSTRUCTIONS:
+    _op = opcode(';'.join(_names))
+    HANDLERS[_op] = make_superinstruction(HANDLERS, _names)
+    UNBOXED_HANDLERS[_op] = make_superinstruction(UNBOXED_HANDLERS, _names)
+
+
+# Quickening. The interpreter runs each function from code.quick_ops
+# and code.quick_args, a copy of its instructions made by
+# rcsp.linker. The first time some generic instructions run, they
+# rewrite themselves in that copy to a quickened instruction (see
+# rcsp.parser.QUICK_OPCODES), which skips work whose result can not
+# change while the program runs. Quickened instructions which may
+# find that they were wrong undo their rewrite. Types need no such
+# checks, as rcsp.verifier has already proved them.
+NO_QUICKENING = -1  # Operand of an instruction which was unquickened.
+
+OP_STORE = opcode('STORE')
+OP_STORE_SLOT = opcode('STORE_SLOT')
+OP_LOAD_GLOBAL_BOUND = opcode('LOAD_GLOBAL_BOUND')
+OP_POP_JUMP_IF_TRUE = opcode('POP_JUMP_IF_TRUE')
+OP_POP_JUMP_IF_FALSE = opcode('POP_JUMP_IF_FALSE')
+
+
+def quicken(code, pc, op, arg):
+    code.quick_ops[pc] = op
+    code.quick_args[pc] = arg
+
+
+def qop_store(frame, arg, pc):
+    name = frame.pop().string
+    lit = frame.pop().integer
+    heap = frame.heap
+    slot = heap.slot(name)
+    heap.store(slot, lit)
+    if arg != NO_QUICKENING:
+        quicken(frame.code, pc, OP_STORE_SLOT, slot)
+    return pc + 1
+
+
+def op_store_slot(frame, arg, pc):
+    name = frame.pop().string
+    lit = frame.pop().integer
+    heap = frame.heap
+    if name == heap.names[arg]:
+        heap.store(arg, lit)
+    else:
+        # This STORE stores more than one name, so it goes back to
+        # looking up each name, for the rest of the run.
+        quicken(frame.code, pc, OP_STORE, NO_QUICKENING)
+        heap.store(heap.slot(name), lit)
+    return pc + 1
+
+
+# A global is never unbound once it has been stored to, so it need
+# only be checked until it has been loaded once.
+def qop_load_global(frame, arg, pc):
+    pc = op_load_global(frame, arg, pc)
+    quicken(frame.code, pc - 1, OP_LOAD_GLOBAL_BOUND, arg)
+    return pc
+
+
+def op_load_global_bound(frame, arg, pc):
+    frame.push(box_int(frame.heap.values[arg]))
+    return pc + 1
+
+
+def uqop_load_global(frame, arg, pc):
+    pc = uop_load_global(frame, arg, pc)
+    quicken(frame.code, pc - 1, OP_LOAD_GLOBAL_BOUND, arg)
+    return pc
+
+
+def uop_load_global_bound(frame, arg, pc):
+    frame.push_int(frame.heap.values[arg])
+    return pc + 1
+
+
+def make_quickening_comparison(handler, name):
+    """Return a handler which runs the comparison handler for name,
+    and quickens it if it is followed by a branch.
+
+    rcsp.optimizer fuses most such pairs when the code is linked at
+    level 2 or above, but leaves any pair whose branch can be jumped
+    to. Quickening the comparison leaves the branch in place for
+    those jumps.
+    """
+    if_false = opcode(name + '_BRANCH')
+    if_true = opcode(NEGATED[name] + '_BRANCH')
+
+    def qop_comparison(frame, arg, pc):
+        code = frame.code
+        if pc + 1 < len(code.ops):
+            branch = code.ops[pc + 1]
+            if branch == OP_POP_JUMP_IF_FALSE:
+                quicken(code, pc, if_false, code.args[pc + 1])
+            elif branch == OP_POP_JUMP_IF_TRUE:
+                quicken(code, pc, if_true, code.args[pc + 1])
+        return handler(frame, arg, pc)
+    return qop_comparison
+
+
+def make_branching_comparison(handler):
+    """Return a handler for a comparison quickened together with the
+    branch which follows it, given the handler of the JUMP_IF_NOT_
+    instruction for the comparison.
+    """
+
+    def op_branching_comparison(frame, arg, pc):
+        # Run as if fused into the branch, so as to skip it.
+        return handler(frame, arg, pc + 1)
+    return op_branching_comparison
+
+
+# The handlers which the interpreter dispatches to from
+# code.quick_ops. HANDLERS and UNBOXED_HANDLERS are left generic, for
+# the JIT and for the engines which run code.ops.
+QUICK_HANDLERS = HANDLERS[:]
+UNBOXED_QUICK_HANDLERS = UNBOXED_HANDLERS[:]
+QUICK_HANDLERS[OP_STORE] = qop_store
+QUICK_HANDLERS[OP_STORE_SLOT] = op_store_slot
+QUICK_HANDLERS[opcode('LOAD_GLOBAL')] = qop_load_global
+QUICK_HANDLERS[OP_LOAD_GLOBAL_BOUND] = op_load_global_bound
+UNBOXED_QUICK_HANDLERS[opcode('LOAD_GLOBAL')] = uqop_load_global
+UNBOXED_QUICK_HANDLERS[OP_LOAD_GLOBAL_BOUND] = uop_load_global_bound
+for _name in NEGATED:
+    for _table, _generic in [(QUICK_HANDLERS, HANDLERS),
+                             (UNBOXED_QUICK_HANDLERS, UNBOXED_HANDLERS)]:
+        _table[opcode(_name)] = make_quickening_comparison(
+            _generic[opcode(_name)], _name)
+        _table[opcode(_name + '_BRANCH')] = make_branching_comparison(
+            _generic[opcode('JUMP_IF_NOT_' + _name)])
+
+
+def box_value(value, slot_type):
+    """Box an unboxed value, given the type of its stack slot.
+    """
+    if slot_type == TYPE_BOOL:
+        return box_bool(value != 0)
+    return box_int(value)
+
+
+def execute(frame, monitor=None):
+    """Run a program on boxed values, until no process can run.
+
+    frame should be the frame of main. Afterwards frame.pc is the pc
+    at which main stopped.
+
+    Under CPython, a monitor may watch the program (see rcsp.tracer
+    and rcsp.tiers). monitor.enter is called with each frame which
+    the interpreter is about to run, from main on, and returns the
+    frame to run instead, or None if no process can run.
+    monitor.loop_head is called at every backward jump and returns
+    the pc at which to carry on, or SWITCH, with frame.next_frame set.
+    """
+    if not we_are_translated() and monitor is not None:
+        frame = monitor.enter(frame)
+        if frame is None:
+            return
+    pc = frame.pc
+    code = frame.code
+    while True:
+        # Greens = pc, code. Reds = frame.
+        jitdriver.jit_merge_point(pc=pc, code=code, frame=frame)
+        if DEBUG:
+            print('LEN:', len(code.ops), 'PC:', pc,
+                  '\tSTACK:', frame.live_stack(), '\tHEAP:', frame.heap)
+        old_pc = pc
+        if pc < len(code.ops):
+            # The JIT traces the linked code, which never changes,
+            # and leaves quickening to the interpreter.
+            if we_are_jitted():
+                pc = HANDLERS[code.ops[pc]](frame, code.args[pc], pc)
             else:
-                pc += 1
-        elif code.bytecode[pc] == opcode('JUMP_ABSOLUTE'):
-            new_pc = code.integers[code.bytecode[pc + 1]]
-            pc = new_pc - 1
-        # Function creation and calls.
-        # TODO: 'CALL_FUNCTION'
-        # TODO: 'LOAD_ARG'
-        # TODO: 'MAKE_FUNCTION'
-        # 'RETURN'
-        elif code.bytecode[pc] == opcode('RETURN'):
-            ret_value = stack.pop()
-            stack.append(ret_value)
-            pc += 1
-        # Handle unknown opcodes.
-        elif code.bytecode[pc] not in opcode_values():
-            raise TypeError('No such CSPC opcode: ' + str(code.bytecode[pc]))
-        pc += 1
-    if DEBUG:
-        print('LEN:', len(code.bytecode), 'PC:', pc,
-              '\tSTACK:', stack, '\tHEAP:', heap)
-    return stack, heap
+                pc = QUICK_HANDLERS[code.quick_ops[pc]](
+                    frame, code.quick_args[pc], pc)
+        else:
+            # Only main can run off the end of its code.
+            pc = end_process(frame, pc)
+        if pc == SWITCH:
+            frame = frame.next_frame
+            if not we_are_translated() and monitor is not None:
+                if frame is not None:
+                    frame = monitor.enter(frame)
+            if frame is None:
+                return
+            code = frame.code
+            pc = frame.pc
+        elif pc < old_pc:
+            # A backward jump, so pc is the head of a loop.
+            jitdriver.can_enter_jit(pc=pc, code=code, frame=frame)
+            if not we_are_translated() and monitor is not None:
+                pc = monitor.loop_head(frame, pc, False)
+                if pc == SWITCH:
+                    # The monitor has run frame on, to another frame.
+                    frame = frame.next_frame
+                    if frame is None:
+                        return
+                    code = frame.code
+                    pc = frame.pc
+
 
+def execute_unboxed(frame, monitor=None):
+    """Run a program on unboxed values, until main stops.
+
+    The program must have been proved safe by rcsp.verifier, so it
+    can not start other processes. When main stops, the values left
+    on its stack are boxed into frame.stack. A monitor is called as
+    for execute, but must leave every frame to the interpreter.
+    """
+    main = frame
+    _run_unboxed(frame, monitor)
+    exit_types = main.code.stack_types[main.pc]
+    for i in range(main.sp):
+        main.stack[i] = box_value(main.ints[i], exit_types[i])
 
-def run(fp):
-    program_contents = ""
+
+def _run_unboxed(frame, monitor):
+    # Only pc, code and frame may be live at the merge point, so main
+    # is kept by the caller.
+    if not we_are_translated() and monitor is not None:
+        frame = monitor.enter(frame)
+    pc = frame.pc
+    code = frame.code
     while True:
-        read = os.read(fp, 4096)
-        if len(read) == 0:
-            break
-        program_contents += read
-    os.close(fp)
-    program = parse_bytecode_file(program_contents)
+        # Greens = pc, code. Reds = frame.
+        unboxed_jitdriver.jit_merge_point(pc=pc, code=code, frame=frame)
+        if DEBUG:
+            print('LEN:', len(code.ops), 'PC:', pc,
+                  '\tINTS:', frame.ints[:frame.sp], '\tHEAP:', frame.heap)
+        old_pc = pc
+        if pc < len(code.ops):
+            if we_are_jitted():
+                pc = UNBOXED_HANDLERS[code.ops[pc]](frame, code.args[pc], pc)
+            else:
+                pc = UNBOXED_QUICK_HANDLERS[code.quick_ops[pc]](
+                    frame, code.quick_args[pc], pc)
+        else:
+            pc = end_process(frame, pc)
+        if pc == SWITCH:
+            frame = frame.next_frame
+            if not we_are_translated() and monitor is not None:
+                if frame is not None:
+                    frame = monitor.enter(frame)
+            if frame is None:
+                return
+            code = frame.code
+            pc = frame.pc
+        elif pc < old_pc:
+            unboxed_jitdriver.can_enter_jit(pc=pc, code=code, frame=frame)
+            if not we_are_translated() and monitor is not None:
+                pc = monitor.loop_head(frame, pc, True)
+
+
+def mainloop(program, unboxed=True, monitor=None):
+    """Main loop of the interpreter.
+
+    The program is decoded and linked first (see rcsp.decoder and
+    rcsp.linker), so the loop executes one pre-decoded instruction
+    per iteration: the handler for each opcode is found by indexing
+    the HANDLERS table and its operand is already resolved. pc
+    indexes instructions, not words of the original bytecode. Outside
+    the JIT, the instructions are quickened as they run, starting
+    afresh for each run (see QUICK_HANDLERS).
+
+    main runs as the first process of a Scheduler. PAR starts other
+    processes, which run until they finish or block on a channel; the
+    program stops when no process can run. DeadlockError is raised if
+    main is blocked at that point.
+
+    If unboxed is True and rcsp.verifier has proved that the stacks
+    of every function which can be called only ever hold ints and
+    bools, the program is run with those values unboxed.
+
+    monitor, if given, watches the program under CPython (see
+    execute).
+
+    Output is flushed when the program stops (see rcsp.output).
+
+    Returns the stack of main and a dict of the global variables.
+    """
+    link_program(program)
+    unquicken(program)
+    heap = Heap(program.globals, program.slots)
+    scheduler = Scheduler()
+    code = program.get('main')
+    frame = Frame(code, heap, program.code_table, scheduler.main)
+    try:
+        if unboxed and program.unboxed:
+            execute_unboxed(frame, monitor)
+        else:
+            execute(frame, monitor)
+    finally:
+        stdout.flush()
+    if not scheduler.main.done:
+        raise DeadlockError('main is blocked and no process can run')
     if DEBUG:
-        print(program)
-    _, _ = mainloop(program)
+        print('LEN:', len(code.ops), 'PC:', frame.pc,
+              '\tSTACK:', frame.live_stack(), '\tHEAP:', heap)
+    return frame.live_stack(), heap.as_dict()
+
+
+# Execution engines. The closures engine (see rcsp.closures), the
+# python engine (see rcsp.transpiler), the interpreter with traced
+# loops (see rcsp.tracer), the tiered engine (see rcsp.tiers) and the
+# pool of workers (see rcsp.multicore) can only run under CPython.
+ENGINES = ['interpreter', 'closures', 'python', 'tracing', 'tiered',
+           'multicore']
+
+# Worker processes of the multicore engine, including the first.
+WORKERS = 2
+
+# Calls of a function, and loop iterations in it, before the tiered
+# engine compiles it.
+CALL_THRESHOLD = 20
+LOOP_THRESHOLD = 100
+
+
+def run(filename, use_cache=True, level=0, engine='interpreter',
+        call_threshold=CALL_THRESHOLD, loop_threshold=LOOP_THRESHOLD,
+        workers=WORKERS):
+    if not we_are_translated() and engine == 'python':
+        from rcsp import transpiler
+        _, _ = transpiler.run(filename, use_cache, level)
+    else:
+        program = load_file(filename, use_cache)
+        if DEBUG:
+            print(program)
+        link_program(program, level)
+        if not we_are_translated() and engine == 'closures':
+            from rcsp import closures
+            _, _ = closures.mainloop(program)
+        elif not we_are_translated() and engine == 'tracing':
+            from rcsp.tracer import Tracer
+            _, _ = mainloop(program, monitor=Tracer())
+        elif not we_are_translated() and engine == 'tiered':
+            from rcsp.tiers import Tiers
+            # Compiled code runs frames with a boxed stack.
+            tiers = Tiers(program, call_threshold, loop_threshold)
+            try:
+                _, _ = mainloop(program, False, tiers)
+            finally:
+                tiers.report(sys.stderr)
+        elif not we_are_translated() and engine == 'multicore':
+            from rcsp import multicore
+            _, _ = multicore.mainloop(program, workers)
+        else:
+            _, _ = mainloop(program)
+    stdout.flush()
+
+
+USAGE = ('Usage: rcsp [-O<level>] [--buffer=line|block|unbuffered] '
+         '[--engine=interpreter|closures|python|tracing|tiered|multicore] '
+         '[--call-threshold=N] [--loop-threshold=N] [--workers=N] '
+         '[--no-cache] FILE')
+
+
+def parse_count(text):
+    """Return the int written in text, or -1 if text is not a
+    non-empty string of decimal digits.
+    """
+    if len(text) == 0:
+        return -1
+    value = 0
+    for char in text:
+        if char < '0' or char > '9':
+            return -1
+        value = value * 10 + (ord(char) - ord('0'))
+    return value
+
+
+def fail(message):
+    """Print message and return the exit status of entry_point.
+    """
+    stdout.write(message + '\n')
+    stdout.flush()
+    return 1
 
 
 def entry_point(argv):
-    try:
-        filename = argv[1]
-    except IndexError:
-        print('You must supply a filename')
-        return 1
-    run(os.open(filename, os.O_RDONLY, 0777))
+    filename = ''
+    use_cache = True
+    level = 0
+    engine = 'interpreter'
+    call_threshold = CALL_THRESHOLD
+    loop_threshold = LOOP_THRESHOLD
+    workers = WORKERS
+    stdout.mode = default_mode(stdout.fd)
+    for arg in argv[1:]:
+        if arg == '--no-cache':
+            use_cache = False
+        elif arg.startswith('-O'):
+            # -O on its own is -O1, as with a C compiler.
+            digits = arg[len('-O'):]
+            if digits == '':
+                digits = '1'
+            level = parse_count(digits)
+            if level < 0 or level > MAX_LEVEL:
+                return fail(USAGE)
+        elif arg.startswith('--buffer='):
+            mode = arg[len('--buffer='):]
+            if mode not in MODES:
+                return fail(USAGE)
+            stdout.mode = MODES[mode]
+        elif arg.startswith('--engine='):
+            engine = arg[len('--engine='):]
+            if engine not in ENGINES:
+                return fail(USAGE)
+            if engine != 'interpreter' and we_are_translated():
+                return fail('The ' + engine + ' engine needs CPython')
+        elif arg.startswith('--call-threshold='):
+            call_threshold = parse_count(arg[len('--call-threshold='):])
+            if call_threshold < 0:
+                return fail(USAGE)
+        elif arg.startswith('--loop-threshold='):
+            loop_threshold = parse_count(arg[len('--loop-threshold='):])
+            if loop_threshold < 0:
+                return fail(USAGE)
+        elif arg.startswith('--workers='):
+            workers = parse_count(arg[len('--workers='):])
+            if workers < 1:
+                return fail(USAGE)
+        elif filename == '':
+            filename = arg
+        else:
+            return fail(USAGE)
+    if filename == '':
+        return fail('You must supply a filename')
+    run(filename, use_cache, level, engine, call_threshold, loop_threshold,
+        workers)
     return 0
 
 
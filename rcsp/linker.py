@@ -0,0 +1,175 @@
+"""
+Linker for a simple CSP bytecode language.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from rcsp.decoder import decode_code
+from rcsp.optimizer import combine_superinstructions, optimize_code
+from rcsp.parser import opcode, opcode_has_target_arg
+from rcsp.verifier import TYPE_UNKNOWN, verify_program
+
+
+__date__ = 'August 2013'
+__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
+
+
+def global_slot(program, name):
+    """Return the heap slot of a global name, allocating one if needed.
+    """
+    if name not in program.slots:
+        program.slots[name] = len(program.globals)
+        program.globals.append(name)
+    return program.slots[name]
+
+
+def function_slot(program, name):
+    """Return the index of a function in program.code_table, adding it
+    to the table if needed.
+    """
+    if name not in program.function_index:
+        if not program.has(name):
+            raise TypeError('No such function: ' + name)
+        program.function_index[name] = len(program.code_table)
+        program.code_table.append(program.get(name))
+    return program.function_index[name]
+
+
+def link_code(program, code):
+    """Link a decoded rcsp.box.CodeBox against its program.
+
+    Every global name used by the code is given a fixed heap slot in
+    the program and the instructions are rewritten to use slots:
+
+      * LOAD_GLOBAL holds the slot of its name,
+      * LOAD_NAME x immediately followed by STORE becomes a single
+        STORE_GLOBAL instruction which holds the slot of x,
+      * any other LOAD_NAME still pushes a StringBox, so that STORE
+        can find the slot by name at runtime.
+
+    Calls are linked too. CALL_FUNCTION and PAR hold the index of
+    their callee in program.code_table, which is added to the table
+    if it is not there yet. The parameters of a function
+    are the names given to LOAD_ARG, in the order in which they first
+    appear; they are listed in code.params and LOAD_ARG holds the
+    index of its parameter.
+    """
+    ops, args, offsets = code.ops, code.args, code.offsets
+    # Find instructions which are the target of a jump. A STORE which
+    # is a jump target can not be merged with the preceding LOAD_NAME.
+    targets = [False] * (len(ops) + 1)
+    for i in range(len(ops)):
+        if opcode_has_target_arg(ops[i]):
+            targets[args[i]] = True
+    new_ops, new_args, new_offsets = [], [], []
+    # Map old instruction indices to new ones, to fix jump targets.
+    index = [0] * (len(ops) + 1)
+    i = 0
+    while i < len(ops):
+        op, arg = ops[i], args[i]
+        index[i] = len(new_ops)
+        if op == opcode('LOAD_GLOBAL'):
+            arg = global_slot(program, code.strings[arg])
+        elif op == opcode('LOAD_ARG'):
+            name = code.strings[arg]
+            if name not in code.params:
+                code.params.append(name)
+            arg = code.params.index(name)
+        elif op == opcode('CALL_FUNCTION') or op == opcode('PAR'):
+            arg = function_slot(program, code.strings[arg])
+        elif op == opcode('LOAD_NAME'):
+            slot = global_slot(program, code.strings[arg])
+            if (i + 1 < len(ops) and ops[i + 1] == opcode('STORE') and
+                    not targets[i + 1]):
+                index[i + 1] = len(new_ops)
+                new_ops.append(opcode('STORE_GLOBAL'))
+                new_args.append(slot)
+                new_offsets.append(offsets[i])
+                i += 2
+                continue
+        new_ops.append(op)
+        new_args.append(arg)
+        new_offsets.append(offsets[i])
+        i += 1
+    index[len(ops)] = len(new_ops)
+    for i in range(len(new_ops)):
+        if opcode_has_target_arg(new_ops[i]):
+            new_args[i] = index[new_args[i]]
+    code.ops = new_ops[:]
+    code.args = new_args[:]
+    code.offsets = new_offsets
+
+
+def link_program(program, level=0):
+    """Decode, link and optimize the functions of a rcsp.box.ProgramBox
+    object. level is the optimization level (see rcsp.optimizer).
+
+    Linking starts from main and follows calls, so only functions
+    which can be called from main are got from the program (and so
+    parsed, if the program is parsed lazily). A program without main
+    has every function linked.
+
+    Afterwards program.globals lists the name held in each heap slot
+    and program.slots maps names back to slots, and program.code_table
+    lists every linked function. Each function which can be called
+    from main is then checked by rcsp.verifier, which raises TypeError
+    if it is malformed. The code is verified before it is optimized,
+    so every level accepts the same programs, and again afterwards to
+    infer the stack types of the optimized code. Linking a program
+    twice has no effect.
+
+    Each function is then given a copy of its instructions to quicken
+    (see unquicken).
+    """
+    if program.linked:
+        return
+    if program.has('main'):
+        function_slot(program, 'main')
+    else:
+        for name in program.get_functions():
+            function_slot(program, name)
+    # code_table grows as calls are linked.
+    i = 0
+    while i < len(program.code_table):
+        code = program.code_table[i]
+        decode_code(code)
+        link_code(program, code)
+        i += 1
+    if program.has('main'):
+        verify_program(program)
+    if level >= 1:
+        for code in program.code_table:
+            optimize_code(code, level)
+        if program.has('main'):
+            # The stack types are inferred again for the optimized code.
+            for code in program.code_table:
+                code.param_types = None
+                code.return_type = TYPE_UNKNOWN
+            verify_program(program)
+    if level >= 3:
+        for code in program.code_table:
+            combine_superinstructions(code)
+    unquicken(program)
+    program.linked = True
+
+
+def unquicken(program):
+    """Give every function of a linked program a fresh copy of its
+    instructions, for rcsp.interpreter to quicken as it runs.
+    """
+    for code in program.code_table:
+        code.quick_ops = code.ops[:]
+        code.quick_args = code.args[:]
@@ -0,0 +1,125 @@
+"""
+Read program files into memory, and cache their parser output.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import mmap
+import os
+
+from rcsp.binary import dump_program, load_program, source_key
+from rcsp.parser import DEBUG, parse_bytecode_file
+
+__date__ = 'August 2013'
+__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
+
+MIN_READ = 4096  # Bytes asked for once the expected size is read.
+
+
+def read_fd(fd):
+    """Return the contents of the open file fd.
+
+    Under CPython a regular file is memory-mapped, so that the text is
+    not copied at all. Otherwise the file is read with one os.read of
+    its size, and any data after that (from a pipe, say) is read in
+    chunks which are joined once at the end.
+    """
+    size = os.fstat(fd).st_size
+    if DEBUG and size > 0:
+        try:
+            return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            pass
+    pieces = []
+    remaining = size
+    while True:
+        data = os.read(fd, max(remaining, MIN_READ))
+        if len(data) == 0:
+            break
+        pieces.append(data)
+        remaining -= len(data)
+    if len(pieces) == 1:
+        return pieces[0]
+    return ''.join(pieces)
+
+
+def read_file(filename):
+    """Return the contents of the file called filename.
+    """
+    fd = os.open(filename, os.O_RDONLY, 0777)
+    try:
+        return read_fd(fd)
+    finally:
+        os.close(fd)
+
+
+def cache_name(filename):
+    """Return the name of the .cspb file which caches a source file.
+    """
+    if filename.endswith('.cspc'):
+        end = len(filename) - len('.cspc')
+        assert end >= 0
+        return filename[:end] + '.cspb'
+    return filename + '.cspb'
+
+
+def load_file(filename, use_cache=True):
+    """Return the rcsp.box.ProgramBox in a .cspc or .cspb file.
+
+    A source file is compiled to a .cspb file next to it, like
+    CPython does with .pyc files. The .cspb file is used instead of
+    the source for as long as the source has the same content hash.
+    If the cache can not be written the source is simply parsed.
+    """
+    if filename.endswith('.cspb'):
+        return load_program(read_file(filename), '')
+    text = read_file(filename)
+    if not use_cache:
+        return parse_bytecode_file(text)
+    key = source_key(text)
+    cache = cache_name(filename)
+    try:
+        program = load_program(read_file(cache), key)
+        if program is not None:
+            return program
+    except (OSError, TypeError):
+        pass
+    program = parse_bytecode_file(text)
+    write_cache(cache, dump_program(program, key))
+    return program
+
+
+def write_cache(cache, data):
+    """Write data to the file cache, or do nothing if it can not be.
+
+    The data goes to a temporary file first, so that a .cspb file is
+    never seen half written.
+    """
+    temp = cache + '.' + str(os.getpid())
+    try:
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            while len(data) > 0:
+                written = os.write(fd, data)
+                data = data[written:]
+        finally:
+            os.close(fd)
+        os.rename(temp, cache)
+    except OSError:
+        try:
+            os.unlink(temp)
+        except OSError:
+            pass
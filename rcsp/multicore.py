@@ -0,0 +1,561 @@
+"""
+Run a CSP process network on a pool of worker OS processes.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Worker 0 is the OS process which calls mainloop and runs main. The
+other workers are forked before main starts and sit idle until
+worker 0 places a process on them. Each worker runs its processes
+with the usual cooperative Scheduler, so channels between processes
+on the same worker are unchanged. A channel which is passed to a
+process on another worker becomes shared: its values then go through
+a ring buffer in memory shared by all workers. Global variables live
+in shared memory too.
+
+Placement is static: every PAR executed on worker 0 goes to the next
+worker in turn, starting with worker 1 and including worker 0.
+Processes started by PAR on the other workers stay on the worker
+which started them. A PAR falls back to running locally if the new
+process takes a string argument, or if the pool has run out of rings.
+
+This module uses fork, mmap and multiprocessing locks, so it only
+runs under CPython, not in the translated interpreter.
+"""
+
+from __future__ import print_function
+
+import ctypes
+import mmap
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import traceback
+
+from rcsp.box import ChannelBox, box_bool, box_int
+from rcsp.interpreter import DeadlockError, Frame, Heap, Process
+from rcsp.interpreter import Scheduler, block, end_alt, execute
+from rcsp.linker import link_program, unquicken
+from rcsp.output import stdout
+from rcsp.verifier import TYPE_BOOL, TYPE_CHANNEL, TYPE_INT, TYPE_STRING
+
+__date__ = 'August 2013'
+__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
+
+RING_SIZE = 256  # Words in each ring buffer.
+NUM_RINGS = 256  # Rings available for shared channels.
+
+# Kinds of RemoteWait.
+WAIT_SEND = 0
+WAIT_RECV = 1
+WAIT_ALT = 2
+
+# Longest sleep of an idle worker, in seconds.
+MAX_BACKOFF = 0.001
+
+# Words of shared status for each worker: whether it is idle, how
+# many values it has moved between workers, and how many times it
+# has polled without finding any work.
+STATUS_WORDS = 3
+IDLE = 0
+PROGRESS = 1
+ROUNDS = 2
+
+
+class Ring(object):
+    """A bounded FIFO of ints in shared memory.
+
+    words is a ctypes array of longs: the count of words ever taken,
+    the count of words ever put, then the buffer itself. Every
+    worker may put and take, under the lock of the ring.
+    """
+
+    def __init__(self, number, words, lock):
+        self.number = number
+        self.words = words
+        self.lock = lock
+
+    def ready(self):
+        """Return True if the ring may hold a value.
+
+        This does not take the lock, so it is only a hint.
+        """
+        return self.words[0] < self.words[1]
+
+    def taken(self, ticket):
+        """Return True if the word put at ticket has been taken.
+        """
+        return self.words[0] > ticket
+
+    def put(self, values):
+        """Append a list of ints to the ring, all at once.
+
+        Returns the ticket of the last value, or -1 if the ring does
+        not have room for all of them.
+        """
+        words = self.words
+        with self.lock:
+            head, tail = words[0], words[1]
+            if tail - head + len(values) > RING_SIZE:
+                return -1
+            for i in range(len(values)):
+                words[2 + (tail + i) % RING_SIZE] = values[i]
+            words[1] = tail + len(values)
+        return tail + len(values) - 1
+
+    def take(self, count):
+        """Remove and return the first count values, or None.
+        """
+        words = self.words
+        with self.lock:
+            head = words[0]
+            if words[1] - head < count:
+                return None
+            values = [words[2 + (head + i) % RING_SIZE]
+                      for i in range(count)]
+            words[0] = head + count
+        return values
+
+    def take_message(self):
+        """Remove and return the first message, or None.
+
+        A message is a word holding its length, then that many words.
+        """
+        words = self.words
+        with self.lock:
+            head = words[0]
+            if head == words[1]:
+                return None
+            count = words[2 + head % RING_SIZE]
+            values = [words[2 + (head + 1 + i) % RING_SIZE]
+                      for i in range(count)]
+            words[0] = head + 1 + count
+        return values
+
+
+class RemoteWait(object):
+    """A process blocked on a shared channel.
+
+    Sends are synchronous, so a sender waits until the receiver has
+    taken its value from the ring: ticket is where the value was put,
+    or -1 if the ring was full. An ALT waits on one RemoteWait per
+    enabled shared guard; serial tells whether the ALT it belongs to
+    is still the one the process is blocked on.
+    """
+
+    def __init__(self, process, ring, kind, value, index):
+        self.process = process
+        self.ring = ring
+        self.kind = kind
+        self.value = value
+        self.index = index
+        self.ticket = -1
+        self.serial = process.alt_serial
+
+
+class SharedChannel(object):
+    """The shared side of a ChannelBox, used by the handlers for
+    CHAN_SEND, CHAN_RECV and ALT.
+    """
+
+    def __init__(self, pool, ring):
+        self.pool = pool
+        self.ring = ring
+
+    def send(self, frame, value, pc):
+        wait = RemoteWait(frame.process, self.ring, WAIT_SEND, value, -1)
+        wait.ticket = self.ring.put([value])
+        if wait.ticket >= 0:
+            self.pool.progress()
+        self.pool.waiting.append(wait)
+        return block(frame, pc)
+
+    def recv(self, frame, pc):
+        if self.take_into(frame):
+            return pc + 1
+        self.pool.waiting.append(RemoteWait(frame.process, self.ring,
+                                            WAIT_RECV, 0, -1))
+        return block(frame, pc)
+
+    def take_into(self, frame):
+        """Push the next value onto the stack of frame, if there is one.
+        """
+        if not self.ring.ready():
+            return False
+        values = self.ring.take(1)
+        if values is None:
+            return False
+        self.pool.progress()
+        frame.push(box_int(values[0]))
+        return True
+
+    def wait_alt(self, process, index):
+        self.pool.waiting.append(RemoteWait(process, self.ring,
+                                            WAIT_ALT, 0, index))
+
+
+class Pool(object):
+    """The shared state of a pool of workers, as seen by one worker.
+    """
+
+    def __init__(self, program, workers):
+        self.program = program
+        self.workers = workers
+        self.number = 0           # Number of this worker.
+        self.pids = []            # Of the other workers, in worker 0.
+        self.next_worker = 1 % workers  # Where the next PAR goes.
+        self.next_ring = workers  # First ring which is not in use.
+        self.waiting = []         # RemoteWait objects.
+        self.channels = {}        # Ring numbers -> shared ChannelBoxes.
+        self.scheduler = None
+        self.heap = None
+        nglobals = len(program.globals)
+        nrings = workers + NUM_RINGS
+        ring_words = 2 + RING_SIZE
+        # Layout: the STATUS_WORDS of each worker, values and bound
+        # flags of globals, then the rings. Rings 0..workers-1 carry
+        # the processes placed on each worker.
+        nstatus = STATUS_WORDS * workers
+        nwords = nstatus + 2 * nglobals + nrings * ring_words
+        size = nwords * ctypes.sizeof(ctypes.c_long)
+        self.memory = mmap.mmap(-1, size)
+        self.status = self._words(0, nstatus)
+        self.values = self._words(nstatus, nglobals)
+        self.bound = self._words(nstatus + nglobals, nglobals)
+        self.rings = []
+        base = nstatus + 2 * nglobals
+        for i in range(nrings):
+            words = self._words(base + i * ring_words, ring_words)
+            self.rings.append(Ring(i, words, multiprocessing.Lock()))
+
+    def _words(self, start, count):
+        offset = start * ctypes.sizeof(ctypes.c_long)
+        return (ctypes.c_long * count).from_buffer(self.memory, offset)
+
+    def progress(self):
+        """Record that this worker has moved a value between workers.
+        """
+        self.status[STATUS_WORDS * self.number + PROGRESS] += 1
+
+    def make_heap(self):
+        heap = Heap(self.program.globals, self.program.slots)
+        heap.values = self.values
+        heap.bound = self.bound
+        return heap
+
+    def channel(self, number):
+        """Return the ChannelBox of this worker for a shared ring.
+        """
+        if number not in self.channels:
+            channel = ChannelBox()
+            channel.shared = SharedChannel(self, self.rings[number])
+            self.channels[number] = channel
+        return self.channels[number]
+
+    def share(self, channel):
+        """Give channel a ring, so that other workers can use it.
+
+        Processes which are already blocked on the channel move over
+        to the ring.
+        """
+        ring = self.rings[self.next_ring]
+        self.next_ring += 1
+        channel.shared = SharedChannel(self, ring)
+        self.channels[ring.number] = channel
+        while channel.head is not None:
+            waiter = channel.release()
+            process = waiter.process
+            if waiter.index >= 0:
+                wait = RemoteWait(process, ring, WAIT_ALT, 0, waiter.index)
+            elif channel.senders:
+                wait = RemoteWait(process, ring, WAIT_SEND,
+                                  process.value, -1)
+                wait.ticket = ring.put([process.value])
+            else:
+                wait = RemoteWait(process, ring, WAIT_RECV, 0, -1)
+            self.waiting.append(wait)
+
+    def spawn(self, frame, arg):
+        """Try to place the process started by PAR on another worker.
+
+        Returns False if the process should run on this worker.
+        """
+        if self.number != 0:
+            return False
+        worker = self.next_worker
+        self.next_worker = (worker + 1) % self.workers
+        if worker == 0:
+            return False
+        callee = self.program.code_table[arg]
+        nargs = len(callee.params)
+        args = frame.stack[frame.sp - nargs:frame.sp]
+        unshared = 0
+        for i in range(nargs):
+            slot_type = callee.param_types[i]
+            if slot_type == TYPE_STRING:
+                return False
+            if slot_type == TYPE_CHANNEL and args[i].shared is None:
+                unshared += 1
+        if self.next_ring + unshared > len(self.rings):
+            return False
+        message = [nargs + 1, arg]
+        for i in range(nargs):
+            slot_type = callee.param_types[i]
+            if slot_type == TYPE_CHANNEL:
+                if args[i].shared is None:
+                    self.share(args[i])
+                message.append(args[i].shared.ring.number)
+            elif slot_type == TYPE_BOOL:
+                message.append(int(args[i].boolean))
+            else:
+                message.append(args[i].integer)
+        if self.rings[worker].put(message) < 0:
+            # The channels stay shared, which is harmless.
+            return False
+        self.progress()
+        frame.sp -= nargs
+        return True
+
+    def start(self, fields):
+        """Start a process which was placed on this worker.
+        """
+        code = self.program.code_table[fields[0]]
+        process = Process(self.scheduler)
+        frame = Frame(code, self.heap, self.program.code_table, process)
+        for i in range(len(code.params)):
+            slot_type = code.param_types[i]
+            if slot_type == TYPE_CHANNEL:
+                frame.args[i] = self.channel(fields[i + 1])
+            elif slot_type == TYPE_INT:
+                frame.args[i] = box_int(fields[i + 1])
+            else:
+                frame.args[i] = box_bool(fields[i + 1] != 0)
+        process.frame = frame
+        self.scheduler.ready(process)
+        self.progress()
+
+    def poll(self):
+        """Wake up every blocked process whose shared channel is ready.
+
+        Returns True if any process was woken or started.
+        """
+        woken = False
+        if self.number != 0:
+            control = self.rings[self.number]
+            while control.ready():
+                fields = control.take_message()
+                if fields is None:
+                    break
+                self.start(fields)
+                woken = True
+        i = 0
+        while i < len(self.waiting):
+            wait = self.waiting[i]
+            process = wait.process
+            if wait.kind == WAIT_ALT and (process.alt_count == 0 or
+                                          wait.serial != process.alt_serial):
+                # The ALT has been finished through another channel.
+                finished = True
+            elif self._try(wait):
+                finished = True
+                woken = True
+            else:
+                finished = False
+            if finished:
+                self.waiting[i] = self.waiting[-1]
+                self.waiting.pop()
+            else:
+                i += 1
+        return woken
+
+    def _try(self, wait):
+        """Try to finish a RemoteWait and wake its process.
+        """
+        process = wait.process
+        ring = wait.ring
+        if wait.kind == WAIT_SEND:
+            if wait.ticket < 0:
+                wait.ticket = ring.put([wait.value])
+                if wait.ticket < 0:
+                    return False
+                self.progress()
+            if not ring.taken(wait.ticket):
+                return False
+            self.scheduler.ready(process)
+            return True
+        if not ring.ready():
+            return False
+        values = ring.take(1)
+        if values is None:
+            return False
+        self.progress()
+        process.frame.push(box_int(values[0]))
+        if wait.kind == WAIT_ALT:
+            end_alt(process, wait.index)
+        self.scheduler.ready(process)
+        return True
+
+    def wait(self):
+        """Wait until some process of this worker can run.
+
+        Returns False if none ever will: in worker 0 that is when every
+        other worker is idle and none has moved a value while each of
+        them polled at least once more, as processes on other workers
+        may still be running after main has finished. Other workers
+        wait until they are killed.
+        """
+        status = self.status
+        mine = STATUS_WORDS * self.number
+        backoff = 0.0
+        last = None
+        stdout.flush()
+        sys.stdout.flush()
+        status[mine + IDLE] = 1
+        try:
+            while not self.poll():
+                if self.number == 0:
+                    if self.workers == 1 and len(self.waiting) == 0:
+                        # Nothing is left which could wake a process.
+                        return False
+                    if backoff == MAX_BACKOFF:
+                        now = self._snapshot()
+                        if self._stalled(last, now):
+                            return False
+                        last = now
+                else:
+                    status[mine + ROUNDS] += 1
+                time.sleep(backoff)
+                backoff = min(MAX_BACKOFF, backoff * 2 + 0.00001)
+        finally:
+            status[mine + IDLE] = 0
+        return True
+
+    def _snapshot(self):
+        """Return the total progress and the poll rounds of every
+        worker, or None if some live worker is busy.
+        """
+        status = self.status
+        total = 0
+        rounds = []
+        for i in range(self.workers):
+            total += status[STATUS_WORDS * i + PROGRESS]
+            if i == 0:
+                rounds.append(0)
+                continue
+            pid = self.pids[i - 1]
+            if pid != 0 and os.waitpid(pid, os.WNOHANG)[0] == pid:
+                self.pids[i - 1] = 0
+            if self.pids[i - 1] == 0:
+                rounds.append(-1)  # Dead workers stay stalled.
+            elif not status[STATUS_WORDS * i + IDLE]:
+                return None
+            else:
+                rounds.append(status[STATUS_WORDS * i + ROUNDS])
+        return (total, rounds)
+
+    def _stalled(self, last, now):
+        if last is None or now is None or last[0] != now[0]:
+            return False
+        for i in range(1, self.workers):
+            if now[1][i] >= 0 and now[1][i] <= last[1][i]:
+                return False
+        return True
+
+
+class SharedScheduler(Scheduler):
+    """A Scheduler which is one worker of a Pool.
+    """
+
+    def __init__(self, pool):
+        Scheduler.__init__(self)
+        self.pool = pool
+
+    def next_frame(self):
+        pool = self.pool
+        if len(pool.waiting) > 0 or pool.number != 0:
+            pool.poll()
+        frame = Scheduler.next_frame(self)
+        while frame is None:
+            if not pool.wait():
+                return None
+            frame = Scheduler.next_frame(self)
+        return frame
+
+
+def _worker(pool, number):
+    """Body of a forked worker. Never returns.
+    """
+    def stop(signum, stack):
+        stdout.flush()
+        sys.stdout.flush()
+        os._exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    status = 0
+    try:
+        pool.number = number
+        pool.scheduler = SharedScheduler(pool)
+        pool.heap = pool.make_heap()
+        frame = pool.scheduler.next_frame()
+        if frame is not None:
+            execute(frame)
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    stdout.flush()
+    sys.stdout.flush()
+    os._exit(status)
+
+
+def mainloop(program, workers=2):
+    """Run program on a pool of workers.
+
+    workers is the number of OS processes to use, including this
+    one. Otherwise this behaves like rcsp.interpreter.mainloop with
+    unboxed set to False: it returns the stack of main and a dict of
+    the global variables, and raises DeadlockError if main can never
+    finish. The pool stops once no process on any worker can run,
+    which may be some time after main has finished.
+    """
+    if workers < 1:
+        raise ValueError('A pool needs at least one worker')
+    link_program(program)
+    unquicken(program)
+    pool = Pool(program, workers)
+    # Otherwise every worker would write out what is buffered.
+    stdout.flush()
+    sys.stdout.flush()
+    for number in range(1, workers):
+        pid = os.fork()
+        if pid == 0:
+            _worker(pool, number)
+        pool.pids.append(pid)
+    try:
+        pool.scheduler = SharedScheduler(pool)
+        pool.heap = pool.make_heap()
+        code = program.get('main')
+        frame = Frame(code, pool.heap, program.code_table,
+                      pool.scheduler.main)
+        execute(frame)
+        if not pool.scheduler.main.done:
+            raise DeadlockError('main is blocked and no process can run')
+        return frame.live_stack(), pool.heap.as_dict()
+    finally:
+        stdout.flush()
+        for pid in pool.pids:
+            if pid != 0:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
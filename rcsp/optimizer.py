@@ -0,0 +1,350 @@
+"""
+Optimizer for a simple CSP bytecode language.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+The optimizer rewrites code once it has been linked (see rcsp.linker)
+and verified, so that every level accepts the same programs.
+Superinstructions are put in last, once the optimized code has been
+verified again. Optimization levels are cumulative:
+
+  0. no optimization,
+  1. constant folding, branches on constant conditions and removal
+     of unreachable code,
+  2. peephole optimization: jump threading, removal of jumps to the
+     next instruction and fusion of comparisons with branches,
+  3. superinstructions (see rcsp.superinstructions).
+
+LOAD_NAME followed by STORE is always fused into STORE_GLOBAL, at
+every level, by rcsp.linker.
+"""
+
+from rcsp.parser import opcode, opcode_has_target_arg, opcode_mnemonic
+from rcsp.superinstructions import SUPERINSTRUCTIONS
+
+
+__date__ = 'August 2013'
+__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
+
+MAX_LEVEL = 3
+
+# The comparison which holds exactly when another does not.
+NEGATED = {'GT': 'LEQ', 'LT': 'GEQ', 'EQ': 'NEQ',
+           'NEQ': 'EQ', 'GEQ': 'LT', 'LEQ': 'GT'}
+
+# The opcodes of each superinstruction and the opcode which runs them,
+# longest first.
+SEQUENCES = [([opcode(name) for name in names], opcode(';'.join(names)))
+             for names in SUPERINSTRUCTIONS]
+SEQUENCES.sort(key=lambda sequence: -len(sequence[0]))
+
+
+def optimize_code(code, level):
+    """Optimize a linked rcsp.box.CodeBox in place.
+
+    Each pass can make more work for the others (folding can make
+    code unreachable, and removing code can bring constants or jumps
+    together), so they are repeated until none changes the code.
+    """
+    if level < 1:
+        return
+    changed = True
+    while changed:
+        changed = fold_constants(code)
+        if remove_unreachable(code):
+            changed = True
+        if level >= 2:
+            if thread_jumps(code):
+                changed = True
+            if fuse_branches(code):
+                changed = True
+
+
+def fold_constants(code):
+    """Fold arithmetic and comparisons on constants.
+
+      * LOAD_CONST a, LOAD_CONST b, op becomes LOAD_CONST (a op b)
+        for ADD, MINUS, TIMES and for DIV and MOD unless b is 0,
+      * LOAD_CONST a, LOAD_CONST b, op, POP_JUMP_IF_TRUE or
+        POP_JUMP_IF_FALSE becomes a JUMP_ABSOLUTE if the branch is
+        always taken, and nothing if it never is, for each comparison
+        op.
+
+    Instructions after the first of a pattern must not be jump
+    targets. A comparison which is not followed by a branch is left
+    alone, since there is no instruction which loads a bool.
+
+    Returns True if any instruction was folded.
+    """
+    ops, args, offsets = code.ops, code.args, code.offsets
+    targets = jump_targets(code)
+    new_ops, new_args, new_offsets = [], [], []
+    index = [0] * (len(ops) + 1)
+    changed = False
+    i = 0
+    while i < len(ops):
+        index[i] = len(new_ops)
+        size = _constant_pattern(ops, args, targets, i)
+        if size == 3:
+            new_ops.append(opcode('LOAD_CONST'))
+            new_args.append(_fold(ops[i + 2], args[i], args[i + 1]))
+            new_offsets.append(offsets[i])
+        elif size == 4:
+            branch = _compare(ops[i + 2], args[i], args[i + 1])
+            if branch == (ops[i + 3] == opcode('POP_JUMP_IF_TRUE')):
+                new_ops.append(opcode('JUMP_ABSOLUTE'))
+                new_args.append(args[i + 3])
+                new_offsets.append(offsets[i])
+        else:
+            new_ops.append(ops[i])
+            new_args.append(args[i])
+            new_offsets.append(offsets[i])
+            i += 1
+            continue
+        for j in range(i + 1, i + size):
+            index[j] = len(new_ops)
+        changed = True
+        i += size
+    if changed:
+        index[len(ops)] = len(new_ops)
+        _replace(code, new_ops, new_args, new_offsets, index)
+    return changed
+
+
+def remove_unreachable(code):
+    """Remove instructions which can not be reached from the first.
+
+    Returns True if any instruction was removed.
+    """
+    ops, args, offsets = code.ops, code.args, code.offsets
+    reachable = [False] * (len(ops) + 1)
+    pending = [0]
+    while len(pending) > 0:
+        pc = pending.pop()
+        if pc >= len(ops) or reachable[pc]:
+            continue
+        reachable[pc] = True
+        op = ops[pc]
+        if opcode_has_target_arg(op):
+            pending.append(args[pc])
+        if (op != opcode('RETURN') and op != opcode('JUMP_ABSOLUTE') and
+                op != opcode('JUMP_FORWARD')):
+            pending.append(pc + 1)
+    new_ops, new_args, new_offsets = [], [], []
+    index = [0] * (len(ops) + 1)
+    for pc in range(len(ops)):
+        index[pc] = len(new_ops)
+        if reachable[pc]:
+            new_ops.append(ops[pc])
+            new_args.append(args[pc])
+            new_offsets.append(offsets[pc])
+    if len(new_ops) == len(ops):
+        return False
+    index[len(ops)] = len(new_ops)
+    _replace(code, new_ops, new_args, new_offsets, index)
+    return True
+
+
+def thread_jumps(code):
+    """Make jumps to an unconditional jump go straight to its target.
+
+    Returns True if any jump was changed.
+    """
+    ops = code.ops
+    args = code.args[:]
+    changed = False
+    for pc in range(len(ops)):
+        if not opcode_has_target_arg(ops[pc]):
+            continue
+        target = args[pc]
+        steps = 0
+        while (target < len(ops) and _is_goto(ops[target]) and
+               steps <= len(ops)):
+            target = args[target]
+            steps += 1
+        # A loop of jumps which never leaves is left as it is.
+        if steps <= len(ops) and target != args[pc]:
+            args[pc] = target
+            changed = True
+    code.args = args[:]
+    return changed
+
+
+def fuse_branches(code):
+    """Remove unconditional jumps to the next instruction, and fuse
+    each comparison followed by POP_JUMP_IF_TRUE or POP_JUMP_IF_FALSE
+    into a single JUMP_IF_NOT_ instruction, unless the branch is a
+    jump target. A fused branch does not build a bool.
+
+    Returns True if any instruction was removed or fused.
+    """
+    ops, args, offsets = code.ops, code.args, code.offsets
+    targets = jump_targets(code)
+    new_ops, new_args, new_offsets = [], [], []
+    index = [0] * (len(ops) + 1)
+    changed = False
+    i = 0
+    while i < len(ops):
+        index[i] = len(new_ops)
+        op = ops[i]
+        if _is_goto(op) and args[i] == i + 1:
+            changed = True
+            i += 1
+            continue
+        if (i + 1 < len(ops) and not targets[i + 1] and
+                _is_compare(op) and _is_branch(ops[i + 1])):
+            new_ops.append(_fused_branch(op, ops[i + 1]))
+            new_args.append(args[i + 1])
+            new_offsets.append(offsets[i])
+            index[i + 1] = len(new_ops)
+            changed = True
+            i += 2
+            continue
+        new_ops.append(op)
+        new_args.append(args[i])
+        new_offsets.append(offsets[i])
+        i += 1
+    if changed:
+        index[len(ops)] = len(new_ops)
+        _replace(code, new_ops, new_args, new_offsets, index)
+    return changed
+
+
+def combine_superinstructions(code):
+    """Use superinstructions in linked and verified code.
+
+    The first instruction of each sequence which makes a
+    superinstruction is replaced by the superinstruction, which runs
+    the whole sequence with one dispatch and carries on after it. The
+    rest of the sequence is left in place, so that code.args and
+    code.stack_types still hold for every instruction and a jump into
+    the middle of the sequence still works. Sequences are matched
+    longest first and do not overlap.
+    """
+    ops = code.ops[:]
+    pc = 0
+    while pc < len(ops):
+        size = 1
+        for sequence, op in SEQUENCES:
+            if _matches(ops, pc, sequence):
+                ops[pc] = op
+                size = len(sequence)
+                break
+        pc += size
+    code.ops = ops[:]
+
+
+def jump_targets(code):
+    """Return a list of flags, True for each instruction index of
+    code which is the target of a jump.
+    """
+    targets = [False] * (len(code.ops) + 1)
+    for pc in range(len(code.ops)):
+        if opcode_has_target_arg(code.ops[pc]):
+            targets[code.args[pc]] = True
+    return targets
+
+
+def _replace(code, ops, args, offsets, index):
+    """Give code new instructions, whose jumps still hold old
+    instruction indices; index maps old indices to new ones.
+    """
+    for pc in range(len(ops)):
+        if opcode_has_target_arg(ops[pc]):
+            args[pc] = index[args[pc]]
+    code.ops = ops[:]
+    code.args = args[:]
+    code.offsets = offsets
+
+
+def _matches(ops, pc, sequence):
+    if pc + len(sequence) > len(ops):
+        return False
+    for i in range(len(sequence)):
+        if ops[pc + i] != sequence[i]:
+            return False
+    return True
+
+
+def _is_goto(op):
+    return op == opcode('JUMP_ABSOLUTE') or op == opcode('JUMP_FORWARD')
+
+
+def _is_branch(op):
+    return (op == opcode('POP_JUMP_IF_TRUE') or
+            op == opcode('POP_JUMP_IF_FALSE'))
+
+
+def _is_compare(op):
+    return op >= opcode('GT') and op <= opcode('LEQ')
+
+
+def _fused_branch(compare, branch):
+    """Return the JUMP_IF_NOT_ opcode for a comparison and a branch.
+
+    POP_JUMP_IF_TRUE jumps unless the opposite comparison holds.
+    """
+    name = opcode_mnemonic(compare)
+    if branch == opcode('POP_JUMP_IF_TRUE'):
+        name = NEGATED[name]
+    return opcode('JUMP_IF_NOT_' + name)
+
+
+def _constant_pattern(ops, args, targets, i):
+    """Return the number of instructions from i which fold_constants
+    can fold, or 0.
+    """
+    if (i + 2 >= len(ops) or ops[i] != opcode('LOAD_CONST') or
+            ops[i + 1] != opcode('LOAD_CONST') or
+            targets[i + 1] or targets[i + 2]):
+        return 0
+    op = ops[i + 2]
+    if op == opcode('ADD') or op == opcode('MINUS') or op == opcode('TIMES'):
+        return 3
+    if op == opcode('DIV') or op == opcode('MOD'):
+        if args[i + 1] == 0:
+            return 0
+        return 3
+    if (_is_compare(op) and i + 3 < len(ops) and not targets[i + 3] and
+            _is_branch(ops[i + 3])):
+        return 4
+    return 0
+
+
+def _fold(op, left, right):
+    if op == opcode('ADD'):
+        return left + right
+    elif op == opcode('MINUS'):
+        return left - right
+    elif op == opcode('TIMES'):
+        return left * right
+    elif op == opcode('DIV'):
+        return left / right
+    return left % right
+
+
+def _compare(op, left, right):
+    if op == opcode('GT'):
+        return left > right
+    elif op == opcode('LT'):
+        return left < right
+    elif op == opcode('EQ'):
+        return left == right
+    elif op == opcode('NEQ'):
+        return left != right
+    elif op == opcode('GEQ'):
+        return left >= right
+    return left <= right
@@ -0,0 +1,91 @@
+"""
+Buffered output for PRINT_ITEM and PRINT_NEWLINE.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+__date__ = 'August 2013'
+__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
+
+# Buffering modes.
+UNBUFFERED = 0
+LINE_BUFFERED = 1
+BLOCK_BUFFERED = 2
+
+MODES = {'unbuffered': UNBUFFERED,
+         'line': LINE_BUFFERED,
+         'block': BLOCK_BUFFERED}
+
+BUFFER_SIZE = 65536  # Bytes held before a block buffer is flushed.
+
+
+class Output(object):
+    """A write buffer on a file descriptor.
+
+    Strings are collected in a list which is reused after each flush,
+    and written out with a single os.write when the buffer holds size
+    bytes, at the end of a line in LINE_BUFFERED mode, after every
+    write in UNBUFFERED mode, or when flush is called.
+
+    Each item which a program prints is written on a line of its own.
+    """
+
+    def __init__(self, fd, mode, size):
+        self.fd = fd
+        self.mode = mode
+        self.size = size
+        self.pieces = []
+        self.length = 0  # Bytes in self.pieces.
+
+    def write(self, text):
+        self.pieces.append(text)
+        self.length += len(text)
+        if self.mode == UNBUFFERED or self.length >= self.size:
+            self.flush()
+
+    def write_item(self, text):
+        self.write(text)
+        self.write_newline()
+
+    def write_newline(self):
+        self.write('\n')
+        if self.mode == LINE_BUFFERED:
+            self.flush()
+
+    def flush(self):
+        if self.length == 0:
+            return
+        data = ''.join(self.pieces)
+        del self.pieces[:]
+        self.length = 0
+        while len(data) > 0:
+            written = os.write(self.fd, data)
+            data = data[written:]
+
+
+# Standard output of CSPC programs. Line buffered until entry_point
+# has seen what fd 1 is.
+stdout = Output(1, LINE_BUFFERED, BUFFER_SIZE)
+
+
+def default_mode(fd):
+    """Return LINE_BUFFERED for a terminal, otherwise BLOCK_BUFFERED.
+    """
+    if os.isatty(fd):
+        return LINE_BUFFERED
+    return BLOCK_BUFFERED
@@ -30,6 +30,8 @@ except ImportError:
     #         return func
     # specialize = specialize()
 
+from rcsp.superinstructions import SUPERINSTRUCTIONS
+
 __date__ = 'August 2013'
 __author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
 
@@ -39,6 +41,7 @@ __author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
 # root of the repository.
 DEBUG = False
 
+CHUNK_SIZE = 1 << 20  # Bytes of text which are split into lines at once.
 
 OPCODES = {
     # Integer arithmetic.
@@ -58,11 +61,120 @@ OPCODES = {
     # Future-proofing...
     'MAKE_FUNCTION': 23,
     'RETURN': 24,
+    # Processes and channels.
+    'PAR': 26,
+    'CHAN_NEW': 27, 'CHAN_SEND': 28, 'CHAN_RECV': 29,
+    'ALT': 30, 'PRI_ALT': 31,
+}
+
+
+# Instructions which are generated by rcsp.linker and rcsp.optimizer.
+# These can not appear in source files.
+LINKED_OPCODES = {
+    'STORE_GLOBAL': 25,
+    # A comparison fused with the branch which follows it. Each pops
+    # two ints and jumps if the comparison is false.
+    'JUMP_IF_NOT_GT': 32, 'JUMP_IF_NOT_LT': 33, 'JUMP_IF_NOT_EQ': 34,
+    'JUMP_IF_NOT_NEQ': 35, 'JUMP_IF_NOT_GEQ': 36, 'JUMP_IF_NOT_LEQ': 37,
 }
 
+# Superinstructions, chosen by rcsp.profiler. Each runs a sequence of
+# linked instructions with a single dispatch, and its mnemonic is the
+# mnemonics of the sequence joined by semicolons.
+FIRST_SUPERINSTRUCTION = max(LINKED_OPCODES.values()) + 1
+for _i in range(len(SUPERINSTRUCTIONS)):
+    _name = ';'.join(SUPERINSTRUCTIONS[_i])
+    LINKED_OPCODES[_name] = FIRST_SUPERINSTRUCTION + _i
+
+# Quickened instructions. rcsp.interpreter rewrites its own copy of
+# the code of a function (code.quick_ops and code.quick_args) to use
+# these as it runs, so they never appear in code.ops:
+#
+#   * LOAD_GLOBAL_BOUND loads a global which is known to be bound,
+#   * STORE_SLOT stores to the slot of the name last stored by this
+#     STORE, which its operand holds, if the name is the same,
+#   * GT_BRANCH and so on run a comparison and the POP_JUMP_IF_TRUE or
+#     POP_JUMP_IF_FALSE which follows it as one instruction. Each
+#     pops two ints and jumps to its operand if the comparison is
+#     false, or else skips the branch.
+QUICK_OPCODES = ['LOAD_GLOBAL_BOUND', 'STORE_SLOT',
+                 'GT_BRANCH', 'LT_BRANCH', 'EQ_BRANCH',
+                 'NEQ_BRANCH', 'GEQ_BRANCH', 'LEQ_BRANCH']
+FIRST_QUICK_OPCODE = FIRST_SUPERINSTRUCTION + len(SUPERINSTRUCTIONS)
+for _i in range(len(QUICK_OPCODES)):
+    LINKED_OPCODES[QUICK_OPCODES[_i]] = FIRST_QUICK_OPCODE + _i
+
+NUM_OPCODES = max(list(OPCODES.values()) +
+                  list(LINKED_OPCODES.values())) + 1
+
+# Opcodes which are followed by an operand in the bytecode. The
+# operands of NAME_ARG_OPCODES index the strings of a CodeBox, those
+# of TARGET_ARG_OPCODES index its jump targets, and all others index
+# its integers.
+NAME_ARG_OPCODES = ['LOAD_GLOBAL', 'LOAD_NAME',
+                    'CALL_FUNCTION', 'LOAD_ARG', 'PAR']
+TARGET_ARG_OPCODES = ['JUMP_FORWARD', 'POP_JUMP_IF_TRUE',
+                      'POP_JUMP_IF_FALSE', 'JUMP_ABSOLUTE']
+# Linked instructions whose operand is a jump target.
+LINKED_TARGET_OPCODES = ['JUMP_IF_NOT_GT', 'JUMP_IF_NOT_LT',
+                         'JUMP_IF_NOT_EQ', 'JUMP_IF_NOT_NEQ',
+                         'JUMP_IF_NOT_GEQ', 'JUMP_IF_NOT_LEQ']
+ARG_OPCODES = (NAME_ARG_OPCODES + TARGET_ARG_OPCODES +
+               ['LOAD_CONST', 'ALT', 'PRI_ALT'])
+
+# MNEMONICS[op] is the name of the numeric opcode op.
+MNEMONICS = [''] * NUM_OPCODES
+for _name in OPCODES:
+    MNEMONICS[OPCODES[_name]] = _name
+for _name in LINKED_OPCODES:
+    MNEMONICS[LINKED_OPCODES[_name]] = _name
+
+# HAS_ARG[op] is True if the numeric opcode op takes an operand.
+HAS_ARG = [False] * NUM_OPCODES
+for _name in ARG_OPCODES:
+    HAS_ARG[OPCODES[_name]] = True
+
+# HAS_NAME_ARG[op] is True if the operand of op is a string.
+HAS_NAME_ARG = [False] * NUM_OPCODES
+for _name in NAME_ARG_OPCODES:
+    HAS_NAME_ARG[OPCODES[_name]] = True
+
+# HAS_TARGET_ARG[op] is True if the operand of op is a jump target.
+HAS_TARGET_ARG = [False] * NUM_OPCODES
+for _name in TARGET_ARG_OPCODES:
+    HAS_TARGET_ARG[OPCODES[_name]] = True
+for _name in LINKED_TARGET_OPCODES:
+    HAS_TARGET_ARG[LINKED_OPCODES[_name]] = True
+
 
 def opcode(name):
-    return OPCODES[name]
+    if name in OPCODES:
+        return OPCODES[name]
+    return LINKED_OPCODES[name]
+
+
+def opcode_has_arg(value):
+    return HAS_ARG[value]
+
+
+def opcode_has_name_arg(value):
+    return HAS_NAME_ARG[value]
+
+
+def opcode_has_target_arg(value):
+    return HAS_TARGET_ARG[value]
+
+
+def opcode_mnemonic(value):
+    return MNEMONICS[value]
+
+
+def is_source_opcode(value):
+    """Return True if value is an opcode which may appear in a file.
+    """
+    if value < 0 or value >= NUM_OPCODES:
+        return False
+    return MNEMONICS[value] in OPCODES
 
 
 def opcode_mnemonics():
@@ -73,62 +185,335 @@ def opcode_values():
     return OPCODES.values()
 
 
-def parse_bytecode_file(bytecode_file):
+class Tokenizer(object):
+    """Split the text of a bytecode file into words, one line at a time.
+
+    text may be a str or, under CPython, an mmap of the file. It is
+    split into lines about CHUNK_SIZE bytes at a time, so the text is
+    never copied whole or split into one list of all its words. Lines
+    which start with # are comments.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0     # Start of the next chunk.
+        self.lines = []  # Lines of the current chunk.
+        self.line = 0    # Next line of the current chunk.
+
+    def next_line(self):
+        """Return the words of the next line which has any.
+
+        Returns an empty list at the end of the text.
+        """
+        while True:
+            if self.line >= len(self.lines):
+                if self.pos >= len(self.text):
+                    return []
+                self._next_chunk()
+            line_ = self.lines[self.line]
+            self.line += 1
+            if DEBUG:
+                line = line_.strip()
+            else:
+                line = rstring.strip_spaces(line_)
+            if line.startswith('#'):
+                continue
+            if DEBUG:
+                words = line.split()
+            else:
+                words = rstring.split(line)
+            if len(words) > 0:
+                return words
+
+    def _next_chunk(self):
+        """Split the next CHUNK_SIZE bytes or so of text into lines.
+
+        Chunks end at the end of a line.
+        """
+        text = self.text
+        end = self.pos + CHUNK_SIZE
+        if end >= len(text):
+            end = len(text)
+        else:
+            end = text.find('\n', end)
+            if end < 0:
+                end = len(text)
+        if DEBUG:
+            self.lines = text[self.pos:end].split('\n')
+        else:
+            self.lines = rstring.split(text[self.pos:end], '\n')
+        self.line = 0
+        self.pos = end + 1
+
+
+# States of parse_bytecode_file.
+_OUTSIDE = 0  # Between functions.
+_NAME = 1     # After DEF.
+_BODY = 2     # Between the name of a function and ENDDEF.
+
+
+def tokenize(text):
+    """Yield the words of the text of a bytecode file, one at a time.
+    """
+    tokenizer = Tokenizer(text)
+    words = tokenizer.next_line()
+    while len(words) > 0:
+        for word in words:
+            yield word
+        words = tokenizer.next_line()
+
+
+def parse_bytecode_file(bytecode_file, shared=False):
     """Parse a file of bytecode.
 
     The argument should be the text of the original file, with
-    mnemonic bytecodes. The result will be a rcsp.box.ProgramBox
-    object.
+    mnemonic bytecodes, as a str or an mmap. The result will be a
+    rcsp.box.ProgramBox object.
+
+    Functions are parsed lazily. index_bytecode_file finds the text of
+    each function, and ProgramBox.get parses a function the first time
+    it is asked for, so functions which are never used cost no more
+    than a search for their ENDDEF. A file which can not be indexed is
+    parsed whole, straight away.
+
+    Each CodeBox is built in a single pass over the words from
+    tokenize. Literals are interned, so each pool of a CodeBox holds a
+    literal once, at the index where it first appeared. The operands
+    of jumps go in the targets pool.
+
+    If shared is True every CodeBox shares the same pools, so that
+    each literal is held once in the whole program.
     """
-    from rcsp.box import CodeBox, ProgramBox
-    bytecode = []
-    # Split bytecode into individual strings.
-    # Throw away comments and whitespace.
-    for line_ in bytecode_file.split('\n'):
-        if DEBUG:
-            line = line_.strip()
+    from rcsp.box import ProgramBox
+    index = index_bytecode_file(bytecode_file)
+    if index is None:
+        program = ProgramBox(_parse_functions(bytecode_file, _Pools(),
+                                              shared))
+    else:
+        source = TextSource(bytecode_file, shared)
+        source.index = index
+        program = ProgramBox({}, source)
+    program.shared_pools = shared
+    return program
+
+
+def _parse_functions(bytecode_file, pools, shared):
+    """Parse every function in the text of a bytecode file.
+
+    Returns a dict of names -> CodeBox objects. If shared is True
+    every CodeBox uses the literal pools of pools.
+    """
+    from rcsp.box import CodeBox
+    functions = {}  # Dict of str names -> CodeBox objects
+    name = ''  # Name of each function which is parsed.
+    state = _OUTSIDE
+    jump = False  # True if the last word was a jump.
+    for code in tokenize(bytecode_file):
+        if state == _BODY:
+            # Parse bytecodes into numeric opcodes.
+            op = OPCODES.get(code, -1)
+            if op >= 0:
+                pools.opcodes.append(op)
+                jump = HAS_TARGET_ARG[op]
+                continue
+            # TODO: Enable nested functions.
+            if code == 'ENDDEF':
+                functions[name] = CodeBox(pools.opcodes, pools.strings,
+                                          pools.integers, pools.bools,
+                                          pools.targets)
+                state = _OUTSIDE
+            # Handle literals.
+            elif code.isdigit() and jump:
+                pools.opcodes.append(_intern_int(pools.targets,
+                                                 pools.target_index,
+                                                 int(code)))
+            elif code.isdigit():
+                pools.opcodes.append(_intern_int(pools.integers,
+                                                 pools.integer_index,
+                                                 int(code)))
+            elif code == 'True' or code == 'False':
+                pools.opcodes.append(_intern_bool(pools.bools,
+                                                  code == 'True'))
+            else:
+                pools.opcodes.append(_intern_string(pools.strings,
+                                                    pools.string_index,
+                                                    code))
+            jump = False
+        elif state == _NAME:
+            name = code
+            if shared:
+                pools.opcodes = []
+            else:
+                pools = _Pools()
+            state = _BODY
+        elif code == 'DEF':
+            state = _NAME
         else:
-            line = rstring.strip_spaces(line_)
-        if line.startswith('#'):
+            raise TypeError('Expected DEF, found: ' + code)
+    if state != _OUTSIDE:
+        raise TypeError('Missing ENDDEF in ' + name)
+    return functions
+
+
+def index_bytecode_file(bytecode_file):
+    """Find the text of each function in a file of bytecode.
+
+    Returns a dict which maps the name of each function to the start
+    and end of its text, from the start of the line holding its DEF to
+    the end of the line holding its ENDDEF. Only the lines between
+    functions are split into words; the body of each function is
+    skipped with a search for its ENDDEF.
+
+    Returns None if a function does not start a line with DEF and its
+    name, or does not end its last line with ENDDEF, since its text
+    could then not be parsed on its own. Raises TypeError like
+    parse_bytecode_file for text outside a function.
+    """
+    text = bytecode_file
+    index = {}
+    pos = 0
+    while pos < len(text):
+        end = _line_end(text, pos)
+        words = _split_line(text[pos:end])
+        if len(words) == 0:
+            pos = end + 1
             continue
+        if words[0] != 'DEF':
+            raise TypeError('Expected DEF, found: ' + words[0])
+        if len(words) < 2:
+            return None
+        name = words[1]
+        start = pos
+        if 'ENDDEF' in words[2:]:
+            if words[len(words) - 1] != 'ENDDEF':
+                return None
         else:
-            if DEBUG:
-                for code in line.split():
-                    bytecode.append(code)
-            else:
-                bytecode.extend(rstring.split(line))
-    # Parse bytecodes into numeric opcodes.
-    functions = {}  # Dict of str names -> CodeBox objects
-    counter = 0
-    while counter < len(bytecode):
-        opcodes, strings, integers, bools = [], [], [], []
-        name = ''  # Name of each function which is parsed.
-        code = bytecode[counter]
-        # Parse a list of functions.
-        if code == 'DEF':
-            counter += 1  # Skip DEF.
-            name = bytecode[counter]
-            counter += 1  # Skip name of function.
-            code = bytecode[counter]
-            # TODO: Enable nested functions.
-            while code != 'ENDDEF':
-                # Handle general instructions.
-                if code in opcode_mnemonics():
-                    opcodes.append(opcode(code))
-                # Handle literals.
-                else:
-                    if code.isdigit():
-                        integers.append(int(code))
-                        opcodes.append(len(integers) - 1)
-                    elif code == 'True' or code == 'False':
-                        bools.append(bool(code))
-                        opcodes.append(len(bools) - 1)
-                    else:
-                        strings.append(code)
-                        opcodes.append(len(strings) - 1)
-                counter += 1
-                code = bytecode[counter]
-            functions[name] = CodeBox(opcodes, strings, integers, bools)
-            # Ignore ENDDEF
-            counter += 1
-    return ProgramBox(functions)
+            end = _find_enddef(text, end)
+            if end < 0:
+                raise TypeError('Missing ENDDEF in ' + name)
+            if end == 0:
+                return None
+        index[name] = (start, end)
+        pos = end + 1
+    return index
+
+
+def _line_end(text, pos):
+    """Return the position of the end of the line holding pos.
+    """
+    end = text.find('\n', pos)
+    if end < 0:
+        return len(text)
+    return end
+
+
+def _split_line(line):
+    """Return the words of a line, or [] if it is a comment.
+    """
+    if DEBUG:
+        line = line.strip()
+    else:
+        line = rstring.strip_spaces(line)
+    if line.startswith('#'):
+        return []
+    if DEBUG:
+        return line.split()
+    return rstring.split(line)
+
+
+def _find_enddef(text, pos):
+    """Return the end of the first line after pos which holds ENDDEF.
+
+    Returns -1 if there is no such line, and 0 if ENDDEF does not end
+    its line.
+    """
+    while True:
+        found = text.find('ENDDEF', pos)
+        if found < 0:
+            return -1
+        start = text.rfind('\n', 0, found) + 1
+        assert start >= 0
+        end = _line_end(text, found)
+        words = _split_line(text[start:end])
+        if 'ENDDEF' in words:
+            if words[len(words) - 1] != 'ENDDEF':
+                return 0
+            return end
+        pos = end
+
+
+class FunctionSource(object):
+    """The functions of a program which have not been parsed yet.
+
+    index maps the name of each function to the start and end of its
+    text in some file. Subclasses parse that text into a CodeBox.
+    """
+
+    def __init__(self):
+        self.index = {}  # dict of names -> (start, end)
+
+    def load(self, name):
+        """Parse the function called name and remove it from index.
+        """
+        start, end = self.index[name]
+        del self.index[name]
+        return self.parse(start, end)
+
+    def parse(self, start, end):
+        raise NotImplementedError
+
+
+class TextSource(FunctionSource):
+    """Functions in the text of a bytecode file.
+    """
+
+    def __init__(self, text, shared):
+        FunctionSource.__init__(self)
+        self.text = text
+        self.shared = shared
+        self.pools = _Pools()  # Used by every function if shared.
+
+    def parse(self, start, end):
+        assert start >= 0
+        assert end >= 0
+        functions = _parse_functions(self.text[start:end], self.pools,
+                                     self.shared)
+        return functions.values()[0]
+
+
+class _Pools(object):
+    """Bytecode and literal pools under construction, with the index
+    of each literal in its pool.
+    """
+
+    def __init__(self):
+        self.opcodes = []
+        self.strings = []
+        self.integers = []
+        self.bools = []
+        self.targets = []
+        self.string_index = {}
+        self.integer_index = {}
+        self.target_index = {}
+
+
+def _intern_string(pool, index, value):
+    if value not in index:
+        index[value] = len(pool)
+        pool.append(value)
+    return index[value]
+
+
+def _intern_int(pool, index, value):
+    if value not in index:
+        index[value] = len(pool)
+        pool.append(value)
+    return index[value]
+
+
+def _intern_bool(pool, value):
+    for i in range(len(pool)):
+        if pool[i] == value:
+            return i
+    pool.append(value)
+    return len(pool) - 1
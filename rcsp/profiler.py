@@ -0,0 +1,248 @@
+"""
+Opcode sequence profiler, which chooses superinstructions.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+This is a development tool, which runs under CPython only:
+
+    python -m rcsp.profiler [--top=N] [--output=FILE] FILE...
+
+runs each program and counts how often each pair and triple of
+instructions is executed one straight after the other, then writes
+the N sequences which would save the most dispatches to FILE (by
+default to standard output) as a new rcsp/superinstructions.py.
+
+    python -m rcsp.profiler --benchmark FILE...
+
+compares the number of dispatches and the running time of each
+program at -O2 and with the current superinstructions at -O3.
+
+The ./superinstructions script in the root of the repository does
+both, as a build step.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+import rcsp.interpreter
+import rcsp.output
+import rcsp.parser
+from rcsp.interpreter import HANDLERS, UNBOXED_HANDLERS, mainloop
+from rcsp.interpreter import QUICK_HANDLERS, UNBOXED_QUICK_HANDLERS
+from rcsp.linker import link_program
+from rcsp.parser import NUM_OPCODES, opcode_mnemonic, parse_bytecode_file
+
+__date__ = 'August 2013'
+__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
+
+# Instructions which always carry on at the next instruction. Only
+# these can come before the last instruction of a superinstruction.
+STRAIGHT_LINE = frozenset([
+    'ADD', 'MINUS', 'TIMES', 'DIV', 'MOD',
+    'GT', 'LT', 'EQ', 'NEQ', 'GEQ', 'LEQ',
+    'PRINT_ITEM', 'PRINT_NEWLINE',
+    'STORE', 'STORE_GLOBAL', 'LOAD_GLOBAL', 'LOAD_CONST', 'LOAD_NAME',
+    'LOAD_ARG', 'MAKE_FUNCTION', 'CHAN_NEW',
+])
+
+MAX_LENGTH = 3  # Instructions in the longest superinstruction.
+TOP = 8         # Superinstructions chosen by default.
+LEVEL = 2       # Optimization level which programs are profiled at.
+
+
+class Profile(object):
+    """Dispatch counts for the programs run so far.
+
+    counts maps each sequence of mnemonics which ran one straight
+    after the other (without a jump or a call in between) to the
+    number of times it ran.
+    """
+
+    def __init__(self):
+        self.dispatches = 0
+        self.counts = {}
+        self.frame = None  # Frame and pc of the last dispatch.
+        self.pc = -1
+        self.window = []   # Straight-line mnemonics just before pc.
+
+    def dispatch(self, frame, pc, op):
+        self.dispatches += 1
+        name = opcode_mnemonic(op)
+        window = []
+        if frame is self.frame and pc == self.pc + 1:
+            window = self.window
+        for i in range(len(window)):
+            sequence = tuple(window[i:] + [name])
+            self.counts[sequence] = self.counts.get(sequence, 0) + 1
+        if name in STRAIGHT_LINE:
+            self.window = (window + [name])[1 - MAX_LENGTH:]
+        else:
+            self.window = []
+        self.frame = frame
+        self.pc = pc
+
+    def choose(self, top):
+        """Return the top sequences which save the most dispatches.
+
+        A sequence of n instructions saves n - 1 dispatches each time
+        it runs.
+        """
+        ranked = sorted(self.counts.items(),
+                        key=lambda item: (-item[1] * (len(item[0]) - 1),
+                                          item[0]))
+        return [sequence for sequence, _ in ranked[:top]]
+
+
+def run_quietly(program, profile=None):
+    """Run a program with its output thrown away, counting dispatches
+    in profile if it is not None.
+    """
+    tables = [HANDLERS, UNBOXED_HANDLERS,
+              QUICK_HANDLERS, UNBOXED_QUICK_HANDLERS]
+    saved = [table[:] for table in tables]
+    if profile is not None:
+        for table in [HANDLERS, UNBOXED_HANDLERS]:
+            for op in range(NUM_OPCODES):
+                table[op] = _counting(table[op], op, profile)
+        # Count the instructions of code.ops, with none quickened.
+        QUICK_HANDLERS[:] = HANDLERS
+        UNBOXED_QUICK_HANDLERS[:] = UNBOXED_HANDLERS
+    fd = rcsp.output.stdout.fd
+    rcsp.output.stdout.fd = os.open(os.devnull, os.O_WRONLY)
+    try:
+        mainloop(program)
+    finally:
+        os.close(rcsp.output.stdout.fd)
+        rcsp.output.stdout.fd = fd
+        for table, handlers in zip(tables, saved):
+            table[:] = handlers
+
+
+def _counting(handler, op, profile):
+    def counting_handler(frame, arg, pc):
+        profile.dispatch(frame, pc, op)
+        return handler(frame, arg, pc)
+    return counting_handler
+
+
+def load(filename, level):
+    with open(filename) as fn:
+        program = parse_bytecode_file(fn.read())
+    link_program(program, level)
+    return program
+
+
+def render(sequences, profile, filenames):
+    """Return the text of rcsp/superinstructions.py for sequences.
+    """
+    lines = ['"""',
+             'Superinstructions for rcsp.interpreter.',
+             '',
+             'This file is generated by rcsp.profiler; run '
+             './superinstructions to',
+             'regenerate it rather than editing it by hand. It was '
+             'generated from:',
+             '']
+    for filename in filenames:
+        lines.append('    ' + filename)
+    lines.extend(['',
+                  'Each sequence is followed by the number of times it '
+                  'ran.',
+                  '"""',
+                  '',
+                  "__date__ = 'August 2013'",
+                  "__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'",
+                  '',
+                  'SUPERINSTRUCTIONS = ['])
+    for sequence in sequences:
+        lines.append('    %r,  # %d' % (sequence, profile.counts[sequence]))
+    lines.append(']')
+    return '\n'.join(lines) + '\n'
+
+
+def benchmark(filenames):
+    """Print dispatches and times at -O2 and -O3 for each file.
+    """
+    print('%-28s %12s %12s %7s %9s %9s' %
+          ('program', 'dispatch -O2', 'dispatch -O3', 'saved',
+           'time -O2', 'time -O3'))
+    totals = [0, 0]
+    for filename in filenames:
+        row = []
+        for level in [2, 3]:
+            profile = Profile()
+            run_quietly(load(filename, level), profile)
+            row.append(profile.dispatches)
+        for level in [2, 3]:
+            program = load(filename, level)
+            start = time.time()
+            run_quietly(program)
+            row.append(time.time() - start)
+        totals[0] += row[0]
+        totals[1] += row[1]
+        print('%-28s %12d %12d %6.1f%% %8.3fs %8.3fs' %
+              (filename, row[0], row[1], _saved(row[0], row[1]),
+               row[2], row[3]))
+    print('%-28s %12d %12d %6.1f%%' % ('total', totals[0], totals[1],
+                                       _saved(totals[0], totals[1])))
+
+
+def _saved(before, after):
+    if before == 0:
+        return 0.0
+    return 100.0 * (before - after) / before
+
+
+def main(argv):
+    # Programs are parsed with CPython, but the interpreter should not
+    # trace every instruction.
+    rcsp.parser.DEBUG = True
+    rcsp.interpreter.DEBUG = False
+    top, output, filenames = TOP, '', []
+    bench = False
+    for arg in argv[1:]:
+        if arg.startswith('--top='):
+            top = int(arg[len('--top='):])
+        elif arg.startswith('--output='):
+            output = arg[len('--output='):]
+        elif arg == '--benchmark':
+            bench = True
+        else:
+            filenames.append(arg)
+    if len(filenames) == 0:
+        print('Usage: python -m rcsp.profiler [--top=N] [--output=FILE] '
+              '[--benchmark] FILE...')
+        return 1
+    if bench:
+        benchmark(filenames)
+        return 0
+    profile = Profile()
+    for filename in filenames:
+        run_quietly(load(filename, LEVEL), profile)
+    text = render(profile.choose(top), profile, filenames)
+    if output == '':
+        sys.stdout.write(text)
+    else:
+        with open(output, 'w') as fn:
+            fn.write(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
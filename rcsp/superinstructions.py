@@ -0,0 +1,34 @@
+"""
+Superinstructions for rcsp.interpreter.
+
+This file is generated by rcsp.profiler; run ./superinstructions to
+regenerate it rather than editing it by hand. It was generated from:
+
+    tests/example0.cspc
+    tests/example1.cspc
+    tests/example10.cspc
+    tests/example2.cspc
+    tests/example3.cspc
+    tests/example4.cspc
+    tests/example5.cspc
+    tests/example6.cspc
+    tests/example7.cspc
+    tests/example8.cspc
+    tests/example9.cspc
+
+Each sequence is followed by the number of times it ran.
+"""
+
+__date__ = 'August 2013'
+__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
+
+SUPERINSTRUCTIONS = [
+    ('LOAD_ARG', 'LOAD_CONST'),  # 18
+    ('LOAD_ARG', 'LOAD_ARG'),  # 13
+    ('LOAD_CONST', 'RETURN'),  # 13
+    ('LOAD_CONST', 'LOAD_GLOBAL', 'JUMP_IF_NOT_LT'),  # 6
+    ('LOAD_ARG', 'LOAD_CONST', 'JUMP_IF_NOT_LEQ'),  # 5
+    ('LOAD_ARG', 'LOAD_CONST', 'PAR'),  # 5
+    ('LOAD_CONST', 'LOAD_CONST', 'EQ'),  # 5
+    ('LOAD_CONST', 'MINUS', 'STORE_GLOBAL'),  # 5
+]
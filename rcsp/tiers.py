@@ -0,0 +1,160 @@
+"""
+Tiered execution: interpret functions until they are hot, then compile
+them.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+This runs under CPython only. Every function starts in the
+interpreter, which runs it on boxed values and tells a Tiers monitor
+(see rcsp.interpreter.execute) whenever it switches frames and
+whenever a frame jumps back to the head of a loop. Tiers counts the
+calls of each function and the loop iterations which the
+interpreter runs in it. Once either count reaches its threshold the
+function is hot, and from then on its frames are run by the blocks
+of rcsp.closures.
+
+Frames move between the tiers only at safe points, where the stack
+of the frame is held boxed in frame.stack: when a frame is entered,
+by a call, a return or a switch of process, and at loop heads. Both
+tiers use the same frames, heap and scheduler, so a call from
+compiled code to a cold function, and the return from it, simply
+move the running frame back to the interpreter. Cold functions are
+never compiled.
+"""
+
+from rcsp.closures import Compiler
+from rcsp.interpreter import CALL_THRESHOLD, LOOP_THRESHOLD, SWITCH
+
+__date__ = 'August 2013'
+__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
+
+
+class Tiers(object):
+    """Moves the hot functions of a running program from the
+    interpreter to rcsp.closures.
+
+    calls and loops map each code box which has run to its number of
+    calls and of interpreted loop iterations. hot maps each compiled
+    code box to the reason it was compiled, 'calls' or 'loops'.
+    """
+
+    def __init__(self, program, call_threshold=CALL_THRESHOLD,
+                 loop_threshold=LOOP_THRESHOLD):
+        self.program = program
+        self.call_threshold = call_threshold
+        self.loop_threshold = loop_threshold
+        self.calls = {}
+        self.loops = {}
+        self.hot = {}
+        self.compiler = None  # Made when the first function is hot.
+        self.transfers = 0    # Frames moved to compiled code.
+        self.loop_transfers = 0  # ... of which at a loop head.
+
+    def enter(self, frame):
+        """Called by the interpreter when it switches to frame.
+
+        Returns the frame for the interpreter to run next, or None if
+        no process can run.
+        """
+        self.count_call(frame)
+        if frame.code in self.hot:
+            self.transfers += 1
+            return self.run(frame)
+        return frame
+
+    def loop_head(self, frame, pc, unboxed):
+        """Called by the interpreter when frame jumps back to pc.
+
+        Returns pc, or SWITCH if the frame has been run on with
+        compiled code.
+        """
+        code = frame.code
+        self.loops[code] = self.loops.get(code, 0) + 1
+        if unboxed:
+            # Compiled code only runs frames with a boxed stack.
+            return pc
+        if (code not in self.hot and
+                self.loops[code] >= self.loop_threshold):
+            self.promote(frame, 'loops')
+        if code not in self.hot:
+            return pc
+        self.transfers += 1
+        self.loop_transfers += 1
+        frame.pc = pc
+        frame.next_frame = self.run(frame)
+        return SWITCH
+
+    def count_call(self, frame):
+        # A frame is entered at pc 0 only when it is first called.
+        if frame.pc != 0:
+            return
+        code = frame.code
+        self.calls[code] = self.calls.get(code, 0) + 1
+        if (code not in self.hot and
+                self.calls[code] >= self.call_threshold):
+            self.promote(frame, 'calls')
+
+    def promote(self, frame, reason):
+        if self.compiler is None:
+            self.compiler = Compiler(frame.heap)
+        self.hot[frame.code] = reason
+
+    def run(self, frame):
+        """Run frame with compiled code, from frame.pc, and then each
+        frame it switches to for as long as they are hot.
+
+        Returns the first frame which is not hot, or None if no
+        process can run.
+        """
+        compiler = self.compiler
+        while True:
+            blocks = compiler.blocks(frame.code)
+            pc = frame.pc
+            while pc != SWITCH:
+                block = blocks[pc]
+                if block is None:
+                    block = compiler.compile_block(frame.code, pc)
+                pc = block(frame)
+            frame = frame.next_frame
+            if frame is None:
+                return None
+            self.count_call(frame)
+            if frame.code not in self.hot:
+                return frame
+
+    def report(self, out):
+        """Write the calls, interpreted loop iterations and tier of
+        each function which ran to the file out.
+        """
+        names = {}
+        for name in self.program.function_index:
+            code = self.program.code_table[self.program.function_index[name]]
+            names[code] = name
+        out.write('%-20s %10s %10s  %s\n' %
+                  ('function', 'calls', 'loops', 'tier'))
+        rows = set(self.calls.keys()) | set(self.loops.keys())
+        for code in sorted(rows, key=lambda code: names.get(code, '?')):
+            if code in self.hot:
+                tier = 'closures (%s)' % self.hot[code]
+            else:
+                tier = 'interpreter'
+            out.write('%-20s %10d %10d  %s\n' %
+                      (names.get(code, '?'), self.calls.get(code, 0),
+                       self.loops.get(code, 0), tier))
+        out.write('%d of %d functions compiled, %d frames moved to '
+                  'compiled code (%d at loop heads)\n' %
+                  (len(self.hot), len(rows), self.transfers,
+                   self.loop_transfers))
@@ -0,0 +1,396 @@
+"""
+Tracing JIT for the loops of programs run by the interpreter.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+This runs under CPython only, where the interpreter has no
+rpython.rlib.jit to make its loops fast. rcsp.interpreter.mainloop
+calls Tracer.loop_head at every backward jump, and the Tracer counts
+how often each loop head is reached. Once a loop is hot, one
+iteration of it is run through the interpreter's handlers while the
+instructions which run are recorded, and the recorded trace is
+compiled into a Python function:
+
+  * stack slots, arguments and globals are Python local variables
+    holding plain ints and bools, loaded from the frame and the heap
+    when the trace is entered,
+  * constants are written into the code, and arithmetic on them is
+    folded,
+  * each branch becomes a guard that it goes the way it went while
+    recording. A guard which fails boxes the stack back into the
+    frame, writes the globals back to the heap and returns the pc at
+    which the interpreter carries on.
+
+A trace only holds instructions which stay in the frame, so a loop
+which calls a function, uses processes or channels, or contains an
+inner loop is left to the interpreter (the inner loop is traced on
+its own).
+"""
+
+import operator
+
+from rcsp.box import box_bool, box_int
+from rcsp.interpreter import HANDLERS, UNBOXED_HANDLERS
+from rcsp.output import stdout
+from rcsp.parser import opcode_mnemonic
+from rcsp.verifier import TYPE_BOOL, TYPE_INT
+
+__date__ = 'August 2013'
+__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
+
+THRESHOLD = 50    # Backward jumps to a loop head before it is traced.
+MAX_LENGTH = 500  # Most instructions in one trace.
+MAX_ABORTS = 3    # Failed recordings before a loop is left alone.
+
+# Python operators for the arithmetic and comparison instructions,
+# and the functions which fold them. Integer division rounds down, as
+# / does on ints in the interpreter.
+ARITHMETIC = {'ADD': ('+', operator.add), 'MINUS': ('-', operator.sub),
+              'TIMES': ('*', operator.mul), 'DIV': ('//', operator.floordiv),
+              'MOD': ('%', operator.mod)}
+COMPARISONS = {'GT': '>', 'LT': '<', 'EQ': '==', 'NEQ': '!=', 'GEQ': '>=',
+               'LEQ': '<='}
+
+# Instructions which a trace can hold, besides arithmetic and
+# comparisons.
+TRACEABLE = frozenset(['LOAD_CONST', 'LOAD_GLOBAL', 'STORE_GLOBAL',
+                       'LOAD_ARG', 'PRINT_ITEM', 'PRINT_NEWLINE',
+                       'MAKE_FUNCTION', 'JUMP_ABSOLUTE', 'JUMP_FORWARD',
+                       'POP_JUMP_IF_TRUE', 'POP_JUMP_IF_FALSE',
+                       'JUMP_IF_NOT_GT', 'JUMP_IF_NOT_LT', 'JUMP_IF_NOT_EQ',
+                       'JUMP_IF_NOT_NEQ', 'JUMP_IF_NOT_GEQ',
+                       'JUMP_IF_NOT_LEQ'])
+
+
+class Tracer(object):
+    """Finds the hot loops of a running program and runs them as
+    compiled traces.
+
+    Loops are keyed by their code box, the pc of their head and
+    whether the frame holds its values unboxed. traces maps each key
+    to its compiled trace, or to None for a loop which can not be
+    traced.
+    """
+
+    def __init__(self, threshold=THRESHOLD):
+        self.threshold = threshold
+        self.counts = {}  # dict of keys -> backward jumps seen
+        self.aborts = {}  # dict of keys -> failed recordings
+        self.traces = {}
+
+    def enter(self, frame):
+        """Called by the interpreter when it switches to frame. Traces
+        do not span calls, so frame is left to the interpreter.
+        """
+        return frame
+
+    def loop_head(self, frame, pc, unboxed):
+        """Called by the interpreter when frame jumps back to pc.
+
+        Returns the pc at which the interpreter carries on.
+        """
+        key = (frame.code, pc, unboxed)
+        if key in self.traces:
+            trace = self.traces[key]
+            if trace is None:
+                return pc
+            return trace(frame)
+        count = self.counts.get(key, 0) + 1
+        if count < self.threshold:
+            self.counts[key] = count
+            return pc
+        self.counts[key] = 0
+        return self.record(frame, pc, unboxed)
+
+    def record(self, frame, head, unboxed):
+        """Run one iteration of the loop at head, recording each
+        instruction, and compile the trace if the iteration gets back
+        to head.
+
+        Returns the pc at which the interpreter carries on.
+        """
+        key = (frame.code, head, unboxed)
+        code = frame.code
+        table = UNBOXED_HANDLERS if unboxed else HANDLERS
+        steps = []  # list of (pc, mnemonic, operand, next pc)
+        pc = head
+        while (pc < len(code.ops) and len(steps) < MAX_LENGTH and
+               _traceable(code, pc)):
+            # A superinstruction is recorded as the instructions which
+            # it runs.
+            names = opcode_mnemonic(code.ops[pc]).split(';')
+            following = table[code.ops[pc]](frame, code.args[pc], pc)
+            last = pc + len(names) - 1
+            for i in range(len(names) - 1):
+                steps.append((pc + i, names[i], code.args[pc + i], pc + i + 1))
+            steps.append((last, names[-1], code.args[last], following))
+            pc = following
+            if pc == head:
+                trace = compile_trace(code, head, steps, unboxed)
+                self.traces[key] = trace
+                if trace is None:
+                    return pc
+                return trace(frame)
+            if pc < last:
+                break  # An inner loop.
+        aborts = self.aborts.get(key, 0) + 1
+        self.aborts[key] = aborts
+        if aborts >= MAX_ABORTS:
+            self.traces[key] = None
+        return pc
+
+
+def _traceable(code, pc):
+    names = opcode_mnemonic(code.ops[pc]).split(';')
+    for i in range(len(names)):
+        name = names[i]
+        if name in ARITHMETIC or name in COMPARISONS:
+            continue
+        if name not in TRACEABLE:
+            return False
+        if (name == 'LOAD_ARG' and code.param_types[code.args[pc + i]]
+                not in [TYPE_INT, TYPE_BOOL]):
+            return False
+    return True
+
+
+def compile_trace(code, head, steps, unboxed):
+    """Return a function which runs the loop recorded in steps, or
+    None if the trace can not be compiled.
+
+    The function takes the frame, runs the loop until a guard fails,
+    and returns the pc at which the interpreter carries on.
+    """
+    writer = TraceWriter(code, head, unboxed)
+    source = writer.write(steps)
+    if source is None:
+        return None
+    namespace = {'box_int': box_int, 'box_bool': box_bool,
+                 'stdout': stdout}
+    exec(compile(source, '<trace %d>' % head, 'exec'), namespace)
+    return namespace['trace']
+
+
+class TraceWriter(object):
+    """Writes the Python source of the function for one trace.
+
+    The operand stack is simulated: each entry is a Python expression
+    over slot variables (s0, s1, ...), arguments (a0, ...), globals
+    (g0, ...) and constants. Expressions are pure, since division is
+    computed as soon as it is met, so they may be computed late.
+    """
+
+    def __init__(self, code, head, unboxed):
+        self.code = code
+        self.head = head
+        self.unboxed = unboxed
+        self.depth = len(code.stack_types[head])
+        self.low = self.depth  # Lowest stack slot which the trace uses.
+        self.stack = [_slot(i) for i in range(self.depth)]
+        self.body = []
+        self.args = set()
+        self.globals = set()
+        self.stores = set()
+
+    def write(self, steps):
+        """Return the source of the function, or None if a slot which
+        the trace uses holds neither an int nor a bool.
+        """
+        # A guard writes back every global which the loop stores,
+        # since it may fail after a previous iteration stored them.
+        for pc, name, arg, following in steps:
+            if name == 'STORE_GLOBAL':
+                self.stores.add(arg)
+        for pc, name, arg, following in steps:
+            self.instruction(pc, name, arg, following)
+        self.spill()
+        types = self.code.stack_types[self.head]
+        for i in range(self.low, self.depth):
+            if types[i] != TYPE_INT and types[i] != TYPE_BOOL:
+                return None
+        lines = ['def trace(frame):']
+        if len(self.globals) > 0:
+            slots = sorted(self.globals)
+            lines.append('    V = frame.heap.values')
+            lines.append('    bound = frame.heap.bound')
+            lines.append('    if not (%s):' %
+                         ' and '.join(['bound[%d]' % slot for slot in slots]))
+            lines.append('        return %d' % self.head)
+            for slot in slots:
+                lines.append('    g%d = V[%d]' % (slot, slot))
+        for i in sorted(self.args):
+            if self.unboxed:
+                lines.append('    a%d = frame.int_args[%d]' % (i, i))
+            else:
+                lines.append('    a%d = frame.args[%d].%s' %
+                             (i, i, _field(self.code.param_types[i])))
+        if self.unboxed:
+            lines.append('    stack = frame.ints')
+            for i in range(self.low, self.depth):
+                lines.append('    s%d = stack[%d]' % (i, i))
+        else:
+            lines.append('    stack = frame.stack')
+            for i in range(self.low, self.depth):
+                lines.append('    s%d = stack[%d].%s' % (i, i,
+                                                         _field(types[i])))
+        lines.append('    while True:')
+        lines.extend(self.body)
+        if len(self.body) == 0:
+            lines.append('        pass')
+        return '\n'.join(lines) + '\n'
+
+    def emit(self, line):
+        self.body.append('        ' + line)
+
+    def push(self, text, const=None):
+        self.stack.append(Expression(text, const))
+
+    def pop(self):
+        value = self.stack.pop()
+        if len(self.stack) < self.low:
+            self.low = len(self.stack)
+        return value
+
+    def instruction(self, pc, name, arg, following):
+        if name == 'LOAD_CONST':
+            self.stack.append(_const(arg))
+        elif name == 'LOAD_GLOBAL':
+            self.globals.add(arg)
+            self.push('g%d' % arg)
+        elif name == 'LOAD_ARG':
+            self.args.add(arg)
+            self.push('a%d' % arg)
+        elif name in ARITHMETIC:
+            right = self.pop()
+            left = self.pop()
+            symbol, fold = ARITHMETIC[name]
+            if left.const is not None and right.const is not None and (
+                    right.const != 0 or (name != 'DIV' and name != 'MOD')):
+                self.stack.append(_const(fold(left.const, right.const)))
+            elif name == 'DIV' or name == 'MOD':
+                # Division may fail, so it is done in order. Its slot
+                # variable may still be used by the values below it.
+                self.spill()
+                slot = len(self.stack)
+                self.emit('s%d = %s %s %s' % (slot, left.text, symbol,
+                                              right.text))
+                self.stack.append(_slot(slot))
+            else:
+                self.push('(%s %s %s)' % (left.text, symbol, right.text))
+        elif name in COMPARISONS:
+            right = self.pop()
+            left = self.pop()
+            self.push('(%s %s %s)' % (left.text, COMPARISONS[name],
+                                      right.text))
+        elif name == 'STORE_GLOBAL':
+            value = self.pop()
+            text = 'g%d' % arg
+            for entry in self.stack:
+                if text in entry.names():
+                    self.spill()
+                    break
+            self.globals.add(arg)
+            self.emit('%s = %s' % (text, value.text))
+        elif name == 'PRINT_ITEM':
+            value = self.pop()
+            if self.code.stack_types[pc][-1] == TYPE_BOOL:
+                text = "'True' if %s else 'False'" % value.text
+            else:
+                text = 'str(%s)' % value.text
+            self.emit('stdout.write_item(%s)' % text)
+        elif name == 'PRINT_NEWLINE':
+            self.emit('stdout.write_newline()')
+        elif name == 'POP_JUMP_IF_TRUE' or name == 'POP_JUMP_IF_FALSE':
+            condition = self.pop()
+            if arg != pc + 1:
+                taken = following == arg
+                self.guard(condition.text,
+                           taken == (name == 'POP_JUMP_IF_TRUE'),
+                           pc + 1 if taken else arg)
+        elif name.startswith('JUMP_IF_NOT_'):
+            right = self.pop()
+            left = self.pop()
+            if arg != pc + 1:
+                condition = '(%s %s %s)' % (
+                    left.text, COMPARISONS[name[len('JUMP_IF_NOT_'):]],
+                    right.text)
+                taken = following == arg
+                self.guard(condition, not taken, pc + 1 if taken else arg)
+        # Unconditional jumps and MAKE_FUNCTION leave no code behind.
+
+    def guard(self, condition, expected, exit_pc):
+        """Leave the trace at exit_pc unless condition is expected.
+        """
+        if expected:
+            self.emit('if not %s:' % condition)
+        else:
+            self.emit('if %s:' % condition)
+        for slot in sorted(self.stores):
+            self.emit('    V[%d] = g%d' % (slot, slot))
+        types = self.code.stack_types[exit_pc]
+        for i in range(self.low, len(self.stack)):
+            if self.unboxed:
+                self.emit('    stack[%d] = %s' % (i, self.stack[i].text))
+            elif types[i] == TYPE_BOOL:
+                self.emit('    stack[%d] = box_bool(%s)' %
+                          (i, self.stack[i].text))
+            else:
+                self.emit('    stack[%d] = box_int(%s)' %
+                          (i, self.stack[i].text))
+        self.emit('    frame.sp = %d' % len(self.stack))
+        self.emit('    return %d' % exit_pc)
+
+    def spill(self):
+        """Assign every value on the simulated stack to its slot
+        variable.
+        """
+        slots, values = [], []
+        for i in range(len(self.stack)):
+            if self.stack[i].text != 's%d' % i:
+                slots.append('s%d' % i)
+                values.append(self.stack[i].text)
+                self.stack[i] = _slot(i)
+        if len(slots) > 0:
+            self.emit('%s = %s' % (', '.join(slots), ', '.join(values)))
+
+
+class Expression(object):
+    """A pure Python expression on the simulated stack. const holds
+    the value of an int constant.
+    """
+
+    def __init__(self, text, const=None):
+        self.text = text
+        self.const = const
+
+    def names(self):
+        return self.text.replace('(', ' ').replace(')', ' ').split()
+
+
+def _slot(i):
+    return Expression('s%d' % i)
+
+
+def _const(value):
+    if value < 0:
+        return Expression('(%d)' % value, const=value)
+    return Expression('%d' % value, const=value)
+
+
+def _field(slot_type):
+    if slot_type == TYPE_BOOL:
+        return 'boolean'
+    return 'integer'
@@ -0,0 +1,623 @@
+"""
+Translate programs to Python, and cache the result.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+This backend runs under CPython only. transpile turns a linked
+ProgramBox into the source of a Python module, with one Python
+function for each function of the program:
+
+  * stack slots, arguments and the globals which a function uses are
+    Python local variables holding plain ints and bools. Globals are
+    written back to the shared list V around calls and returns,
+  * the basic blocks of a function become nested if/else statements
+    where a block has a single predecessor, inside a while loop
+    which dispatches on the others (loop heads and joins),
+  * arithmetic and comparisons become Python expressions, computed
+    in the same order as the interpreter computes them.
+
+Only programs which rcsp.verifier has proved can run unboxed (see
+ProgramBox.unboxed) are translated, since those never start other
+processes; others are run by rcsp.closures instead. Each call is a
+Python call, so programs with a function which can call itself,
+directly or through others, are run by rcsp.closures too: deep
+recursion would overflow the stack of the host, where the
+interpreter would carry on.
+
+The compiled module is cached in a .cspy file next to the source,
+keyed by the content hash of the source, the optimization level and
+the version of Python, so that later runs skip both parsing and code
+generation.
+"""
+
+import imp
+import marshal
+import operator
+import struct
+
+from rcsp import closures
+from rcsp.binary import source_key
+from rcsp.interpreter import box_value
+from rcsp.linker import link_program
+from rcsp.loader import load_file, read_file, write_cache
+from rcsp.optimizer import jump_targets
+from rcsp.output import stdout
+from rcsp.parser import opcode_mnemonic
+from rcsp.verifier import TYPE_BOOL
+
+__date__ = 'August 2013'
+__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
+
+MAGIC = 'CSPY\r\n\x1a\n'
+VERSION = 2  # Bump whenever the generated code changes.
+
+# Python operators for the arithmetic and comparison instructions,
+# and the functions which fold them. Integer division rounds down, as
+# / does on ints in the interpreter.
+ARITHMETIC = {'ADD': ('+', operator.add), 'MINUS': ('-', operator.sub),
+              'TIMES': ('*', operator.mul), 'DIV': ('//', operator.floordiv),
+              'MOD': ('%', operator.mod)}
+COMPARISONS = {'GT': '>', 'LT': '<', 'EQ': '==', 'NEQ': '!=', 'GEQ': '>=',
+               'LEQ': '<='}
+
+# Instructions after which a block ends.
+TERMINATORS = frozenset(['JUMP_ABSOLUTE', 'JUMP_FORWARD', 'POP_JUMP_IF_TRUE',
+                         'POP_JUMP_IF_FALSE', 'RETURN'])
+
+MAX_NESTING = 40  # Deepest if/else nesting before blocks are dispatched.
+
+
+def transpile(program):
+    """Return the source of a Python module which runs a linked
+    program, or None if the program can not be translated.
+
+    The module defines NAMES, the names of the global variables, and
+    run(write_item, write_newline), which runs main and returns the
+    values and types of the stack it leaves, and the list of global
+    values (None for those which were never set).
+    """
+    if not program.unboxed:
+        return None
+    main = program.get('main')
+    codes = [index for index in range(len(program.code_table))
+             if program.code_table[index].param_types is not None]
+    if _is_recursive(program, codes):
+        return None
+    uses = _global_users(program, codes)
+    lines = ['# Generated by rcsp.transpiler. Do not edit.', '',
+             'NAMES = %r' % (program.globals,), '', '',
+             'def run(write_item, write_newline):',
+             '    V = [None] * %d' % len(program.globals)]
+    for index in codes:
+        code = program.code_table[index]
+        if code is not main or _is_called(program, codes, index):
+            lines.append('')
+            FunctionWriter(program, code, 'f%d' % index, False,
+                           uses).write(lines)
+    lines.append('')
+    FunctionWriter(program, main, 'main', True, uses).write(lines)
+    lines.extend(['', '    stack, types = main()',
+                  '    return stack, types, V'])
+    return '\n'.join(lines) + '\n'
+
+
+class FunctionWriter(object):
+    """Writes the Python function for one code box.
+
+    top is True for the outermost call of main, which returns its
+    whole stack when it stops. uses maps the index of each function
+    to True if it, or anything it calls, reads or writes a global.
+    """
+
+    def __init__(self, program, code, name, top, uses):
+        self.program = program
+        self.code = code
+        self.name = name
+        self.top = top
+        self.uses = uses
+        self.lines = []
+        self.stack = []  # Expressions for the simulated stack.
+        self.loads, self.stores = _globals_of(code)
+        self.bound = _bound_globals(code)
+        self.blocks, self.successors = _basic_blocks(code)
+        self.dispatched = self._dispatched()
+
+    def write(self, lines):
+        code = self.code
+        params = ', '.join(['a%d' % i for i in range(len(code.params))])
+        self.lines = lines
+        self.emit(1, 'def %s(%s):' % (self.name, params))
+        for slot in sorted(self.loads | self.stores):
+            self.emit(2, 'g%d = V[%d]' % (slot, slot))
+        if 0 not in self.dispatched:
+            self.block(0, 2)
+        if len(self.dispatched) == 0:
+            return
+        if 0 in self.dispatched:
+            self.emit(2, 'b = 0')
+        self.emit(2, 'while True:')
+        if len(self.dispatched) == 1:
+            self.block(self.dispatched[0], 3)
+            return
+        keyword = 'if'
+        for start in self.dispatched:
+            self.emit(3, '%s b == %d:' % (keyword, start))
+            self.block(start, 4)
+            keyword = 'elif'
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def _dispatched(self):
+        """Return the starts of the blocks which the while loop
+        dispatches on, in order.
+
+        Every other reachable block is written inside the one block
+        which leads to it, unless that would nest too deeply.
+        """
+        predecessors = {}
+        for start in self.blocks:
+            for successor in self.successors[start]:
+                predecessors[successor] = predecessors.get(successor, 0) + 1
+        dispatched = set()
+        for start in self.blocks:
+            if predecessors.get(start, 0) > 1:
+                dispatched.add(start)
+        if predecessors.get(0, 0) > 0:
+            dispatched.add(0)
+        # Walk down the blocks which would be written inline.
+        pending = [(0, 0)] + [(start, 0) for start in dispatched]
+        seen = set()
+        while len(pending) > 0:
+            start, depth = pending.pop()
+            if start in seen:
+                continue
+            seen.add(start)
+            if depth > MAX_NESTING:
+                dispatched.add(start)
+                depth = 0
+            for successor in self.successors[start]:
+                if successor not in dispatched:
+                    pending.append((successor, depth + 1))
+        return sorted(dispatched)
+
+    def block(self, start, indent):
+        """Write the block starting at start, and any which follow it
+        inline.
+        """
+        code = self.code
+        types = code.stack_types[start]
+        self.stack = [_slot(i) for i in range(len(types))]
+        pc = start
+        while True:
+            if pc == len(code.ops):
+                self.finish(indent, types)
+                return
+            if pc > start and pc in self.blocks:
+                self.spill(indent, len(self.stack))
+                self.edge(pc, indent)
+                return
+            if self.instruction(pc, indent):
+                return
+            pc += 1
+            types = code.stack_types[pc]
+
+    def instruction(self, pc, indent):
+        """Write the instruction at pc. Returns True if it ended the
+        block.
+        """
+        code = self.code
+        name = opcode_mnemonic(code.ops[pc]).split(';')[0]
+        arg = code.args[pc]
+        if name == 'LOAD_CONST':
+            self.stack.append(_const(arg))
+        elif name == 'LOAD_GLOBAL':
+            if arg not in self.bound[pc]:
+                self.pop_effect(indent, 0)
+                self.emit(indent, 'if g%d is None:' % arg)
+                self.emit(indent + 1, 'raise KeyError(%r)' %
+                          ('Global not defined: ' + self.program.globals[arg]))
+            self.stack.append(Expression('g%d' % arg, safe=False))
+        elif name == 'LOAD_ARG':
+            self.stack.append(Expression('a%d' % arg))
+        elif name in ARITHMETIC:
+            right = self.stack.pop()
+            left = self.stack.pop()
+            symbol, fold = ARITHMETIC[name]
+            if name == 'DIV' or name == 'MOD':
+                fold = None  # Left for the program to fail at runtime.
+            self.stack.append(_binary(symbol, left, right, fold))
+        elif name in COMPARISONS:
+            right = self.stack.pop()
+            left = self.stack.pop()
+            self.stack.append(_binary(COMPARISONS[name], left, right))
+        elif name == 'STORE_GLOBAL':
+            value = self.pop_effect(indent, 1)[0]
+            self.emit(indent, 'g%d = %s' % (arg, value.text))
+        elif name == 'PRINT_ITEM':
+            value = self.pop_effect(indent, 1)[0]
+            if code.stack_types[pc][-1] == TYPE_BOOL:
+                text = "'True' if %s else 'False'" % value.text
+            else:
+                text = 'str(%s)' % value.text
+            self.emit(indent, 'write_item(%s)' % text)
+        elif name == 'PRINT_NEWLINE':
+            self.pop_effect(indent, 0)
+            self.emit(indent, 'write_newline()')
+        elif name == 'MAKE_FUNCTION':
+            pass
+        elif name == 'CALL_FUNCTION':
+            callee = self.program.code_table[arg]
+            values = self.pop_effect(indent, len(callee.params))
+            # The result goes in a slot which the values below may
+            # still refer to.
+            self.spill(indent, len(self.stack))
+            uses = self.uses[arg]
+            if uses:
+                self.write_back(indent)
+            self.emit(indent, 's%d = f%d(%s)' %
+                      (len(self.stack), arg,
+                       ', '.join([value.text for value in values])))
+            self.stack.append(_slot(len(self.stack)))
+            if uses:
+                for slot in sorted(self.loads | self.stores):
+                    self.emit(indent, 'g%d = V[%d]' % (slot, slot))
+        elif name == 'RETURN':
+            if self.top:
+                self.finish(indent, code.stack_types[pc])
+                return True
+            value = self.pop_effect(indent, 1)[0]
+            self.write_back(indent)
+            self.emit(indent, 'return ' + value.text)
+            return True
+        elif name == 'JUMP_ABSOLUTE' or name == 'JUMP_FORWARD':
+            self.spill(indent, len(self.stack))
+            self.edge(arg, indent)
+            return True
+        elif name == 'POP_JUMP_IF_TRUE' or name == 'POP_JUMP_IF_FALSE':
+            condition = self.pop_effect(indent, 1)[0]
+            self.spill(indent, len(self.stack))
+            if name == 'POP_JUMP_IF_TRUE':
+                self.branch(indent, condition.text, arg, pc + 1)
+            else:
+                self.branch(indent, condition.text, pc + 1, arg)
+            return True
+        elif name.startswith('JUMP_IF_NOT_'):
+            left, right = self.pop_effect(indent, 2)
+            compare = COMPARISONS[name[len('JUMP_IF_NOT_'):]]
+            condition = _binary(compare, left, right)
+            self.spill(indent, len(self.stack))
+            self.branch(indent, condition.text, pc + 1, arg)
+            return True
+        else:
+            raise TypeError('Can not translate ' + name)
+        return False
+
+    def pop_effect(self, indent, count):
+        """Pop the count operands of an instruction with side effects.
+
+        Anything below them which could fail or read a global is
+        computed first, as the interpreter would have done.
+        """
+        operands = self.stack[len(self.stack) - count:]
+        del self.stack[len(self.stack) - count:]
+        for value in self.stack:
+            if not value.safe:
+                self.spill(indent, len(self.stack))
+                break
+        return operands
+
+    def spill(self, indent, depth):
+        """Assign the first depth values of the simulated stack to
+        their slot variables.
+        """
+        slots, values = [], []
+        for i in range(depth):
+            if self.stack[i].slot != i:
+                slots.append('s%d' % i)
+                values.append(self.stack[i].text)
+                self.stack[i] = _slot(i)
+        if len(slots) > 0:
+            self.emit(indent, '%s = %s' % (', '.join(slots),
+                                           ', '.join(values)))
+
+    def write_back(self, indent):
+        for slot in sorted(self.stores):
+            self.emit(indent, 'V[%d] = g%d' % (slot, slot))
+
+    def finish(self, indent, types):
+        """Stop the outermost main, returning its whole stack.
+        """
+        self.write_back(indent)
+        self.emit(indent, 'return [%s], %r' %
+                  (', '.join([value.text for value in self.stack]),
+                   tuple(types)))
+
+    def branch(self, indent, condition, if_true, if_false):
+        self.emit(indent, 'if %s:' % condition)
+        self.edge(if_true, indent + 1)
+        self.emit(indent, 'else:')
+        self.edge(if_false, indent + 1)
+
+    def edge(self, start, indent):
+        if start in self.dispatched:
+            self.emit(indent, 'b = %d' % start)
+        else:
+            self.block(start, indent)
+
+
+class Expression(object):
+    """A Python expression on the simulated stack.
+
+    const holds the value of an int constant, and slot the number of
+    the stack slot variable which the expression is. safe is False if
+    computing it may fail or reads a global.
+    """
+
+    def __init__(self, text, const=None, slot=-1, safe=True):
+        self.text = text
+        self.const = const
+        self.slot = slot
+        self.safe = safe
+
+
+def _slot(i):
+    return Expression('s%d' % i, slot=i)
+
+
+def _const(value):
+    if value < 0:
+        return Expression('(%d)' % value, const=value)
+    return Expression('%d' % value, const=value)
+
+
+def _binary(symbol, left, right, fold=None):
+    """Return the Expression for an operator on two int Expressions.
+
+    Arithmetic on constants is folded with fold. Without fold the
+    operation may fail, so it is not safe.
+    """
+    if (fold is not None and left.const is not None and
+            right.const is not None):
+        return _const(fold(left.const, right.const))
+    safe = left.safe and right.safe and symbol not in ['//', '%']
+    return Expression('(%s %s %s)' % (left.text, symbol, right.text),
+                      safe=safe)
+
+
+def _basic_blocks(code):
+    """Return the starts of the reachable basic blocks of code, and a
+    dict of each start -> the starts of the blocks which follow it.
+
+    len(code.ops) is the start of a block if main can run off its end.
+    """
+    ops, args = code.ops, code.args
+    targets = jump_targets(code)
+    blocks = set()
+    successors = {len(ops): []}
+    pending = [0]
+    while len(pending) > 0:
+        start = pending.pop()
+        if start in blocks:
+            continue
+        blocks.add(start)
+        if start == len(ops):
+            continue
+        following = []
+        pc = start
+        while pc < len(ops):
+            name = opcode_mnemonic(ops[pc]).split(';')[0]
+            if name == 'RETURN':
+                break
+            if name == 'JUMP_ABSOLUTE' or name == 'JUMP_FORWARD':
+                following.append(args[pc])
+                break
+            if name in TERMINATORS or name.startswith('JUMP_IF_NOT_'):
+                following.extend([args[pc], pc + 1])
+                break
+            if targets[pc + 1]:
+                following.append(pc + 1)
+                break
+            pc += 1
+        if pc == len(ops):
+            following.append(pc)
+        successors[start] = following
+        pending.extend(following)
+    return blocks, successors
+
+
+def _globals_of(code):
+    """Return the sets of global slots which code loads and stores.
+    """
+    loads, stores = set(), set()
+    for pc in range(len(code.ops)):
+        name = opcode_mnemonic(code.ops[pc]).split(';')[0]
+        if name == 'LOAD_GLOBAL':
+            loads.add(code.args[pc])
+        elif name == 'STORE_GLOBAL':
+            stores.add(code.args[pc])
+    return loads, stores
+
+
+def _global_users(program, codes):
+    """Return a dict of the index of each function in codes -> True
+    if it, or anything it calls, reads or writes a global.
+    """
+    uses = {}
+    for index in codes:
+        loads, stores = _globals_of(program.code_table[index])
+        uses[index] = len(loads) + len(stores) > 0
+    changed = True
+    while changed:
+        changed = False
+        for index in codes:
+            if uses[index]:
+                continue
+            code = program.code_table[index]
+            for pc in range(len(code.ops)):
+                name = opcode_mnemonic(code.ops[pc]).split(';')[0]
+                if name == 'CALL_FUNCTION' and uses[code.args[pc]]:
+                    uses[index] = True
+                    changed = True
+                    break
+    return uses
+
+
+def _bound_globals(code):
+    """Return, for each pc of code, the set of global slots which are
+    certainly set when it runs, since code has loaded or stored them
+    on every path to pc.
+    """
+    ops, args = code.ops, code.args
+    bound = [None] * (len(ops) + 1)
+    bound[0] = frozenset()
+    pending = [0]
+    while len(pending) > 0:
+        pc = pending.pop()
+        if pc >= len(ops):
+            continue
+        name = opcode_mnemonic(ops[pc]).split(';')[0]
+        after = bound[pc]
+        if name == 'LOAD_GLOBAL' or name == 'STORE_GLOBAL':
+            after = after | frozenset([args[pc]])
+        if name == 'RETURN':
+            successors = []
+        elif name == 'JUMP_ABSOLUTE' or name == 'JUMP_FORWARD':
+            successors = [args[pc]]
+        elif name in TERMINATORS or name.startswith('JUMP_IF_NOT_'):
+            successors = [args[pc], pc + 1]
+        else:
+            successors = [pc + 1]
+        for successor in successors:
+            if bound[successor] is None:
+                bound[successor] = after
+                pending.append(successor)
+            elif not bound[successor] <= after:
+                bound[successor] = bound[successor] & after
+                pending.append(successor)
+    return bound
+
+
+def _is_called(program, codes, index):
+    for caller in codes:
+        code = program.code_table[caller]
+        for pc in range(len(code.ops)):
+            name = opcode_mnemonic(code.ops[pc]).split(';')[0]
+            if name == 'CALL_FUNCTION' and code.args[pc] == index:
+                return True
+    return False
+
+
+def _is_recursive(program, codes):
+    """Return True if any function in codes can call itself.
+    """
+    callees = {}
+    for index in codes:
+        code = program.code_table[index]
+        callees[index] = set()
+        for pc in range(len(code.ops)):
+            name = opcode_mnemonic(code.ops[pc]).split(';')[0]
+            if name == 'CALL_FUNCTION':
+                callees[index].add(code.args[pc])
+    # Remove functions which call nothing that is left, until only
+    # those on or leading to a cycle remain.
+    changed = True
+    while changed:
+        changed = False
+        for index in list(callees.keys()):
+            if len(callees[index] & set(callees.keys())) == 0:
+                del callees[index]
+                changed = True
+    return len(callees) > 0
+
+
+def compile_program(program, filename='<program>'):
+    """Return a code object for the module which runs a linked
+    program, or None if it can not be translated.
+    """
+    source = transpile(program)
+    if source is None:
+        return None
+    return compile(source, filename + ' (generated)', 'exec')
+
+
+def execute_module(module):
+    """Run a code object made by compile_program.
+
+    Returns the stack of main and a dict of the global variables, as
+    rcsp.interpreter.mainloop does.
+    """
+    namespace = {}
+    exec(module, namespace)
+    try:
+        values, types, heap = namespace['run'](stdout.write_item,
+                                               stdout.write_newline)
+    finally:
+        stdout.flush()
+    stack = [box_value(values[i], types[i]) for i in range(len(values))]
+    names = namespace['NAMES']
+    return stack, dict([(names[slot], heap[slot])
+                        for slot in range(len(names))
+                        if heap[slot] is not None])
+
+
+def mainloop(program):
+    """Run a linked program, translated to Python if it can be and
+    with rcsp.closures if not.
+    """
+    link_program(program)
+    module = compile_program(program)
+    if module is None:
+        return closures.mainloop(program)
+    return execute_module(module)
+
+
+def cache_name(filename):
+    """Return the name of the .cspy file which caches a source file.
+    """
+    if filename.endswith('.cspc'):
+        return filename[:-len('.cspc')] + '.cspy'
+    return filename + '.cspy'
+
+
+def _header(key, level):
+    return MAGIC + imp.get_magic() + struct.pack('<BB', VERSION, level) + key
+
+
+def run(filename, use_cache=True, level=0):
+    """Run a source file, from its .cspy file if that is up to date.
+    """
+    module = None
+    header = ''
+    if use_cache and not filename.endswith('.cspb'):
+        text = read_file(filename)
+        header = _header(source_key(text[:]), level)
+        try:
+            data = read_file(cache_name(filename))
+            if data[:len(header)] == header:
+                module = marshal.loads(data[len(header):])
+        except (OSError, EOFError, ValueError, TypeError):
+            module = None
+    if module is None:
+        program = load_file(filename, use_cache)
+        link_program(program, level)
+        module = compile_program(program, filename)
+        if module is None:
+            return closures.mainloop(program)
+        if header != '':
+            write_cache(cache_name(filename),
+                        header + marshal.dumps(module))
+    return execute_module(module)
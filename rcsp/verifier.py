@@ -0,0 +1,238 @@
+"""
+Static analysis of bytecode for a simple CSP language.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from rcsp.parser import opcode, opcode_has_target_arg
+
+
+__date__ = 'August 2013'
+__author__ = 'Sarah Mount <s.mount@wlv.ac.uk>'
+
+# Types of stack slots.
+TYPE_INT = 0
+TYPE_BOOL = 1
+TYPE_STRING = 2
+TYPE_CHANNEL = 3
+
+
+# Return type of a function which has not been seen to return yet.
+TYPE_UNKNOWN = -1
+
+
+def verify_program(program):
+    """Verify every function of a linked rcsp.box.ProgramBox which can
+    be reached from main.
+
+    The parameter types of a function are taken from the first call
+    to it which is found, and its return type from the first RETURN.
+    Every other call and RETURN must agree. A call to a function whose
+    return type is not known yet (because it is recursive) cuts that
+    path short, so functions are verified repeatedly until none of
+    their signatures change.
+
+    program.unboxed is set to True if every reachable function can be
+    run by the unboxed interpreter. Raises TypeError if any reachable
+    function is malformed.
+    """
+    main = program.get('main')
+    if len(main.params) > 0:
+        raise TypeError('main can not take arguments')
+    main.param_types = []
+    changed = True
+    while changed:
+        changed = False
+        for code in program.code_table:
+            if code.param_types is None:
+                continue
+            if verify_code(code, program):
+                changed = True
+    program.unboxed = True
+    for code in program.code_table:
+        if code.param_types is None:
+            continue
+        if code is not main and code.stack_types[len(code.ops)] is not None:
+            raise TypeError('Function can end without RETURN')
+        if not code.unboxed:
+            program.unboxed = False
+
+
+def verify_code(code, program):
+    """Verify a linked rcsp.box.CodeBox and infer its stack types.
+
+    Every path through the code is followed to check that no
+    instruction underflows the stack or is given an operand of the
+    wrong type, and that the stack has the same shape whichever way
+    an instruction is reached. Raises TypeError if the code is
+    malformed. Operand indices and jump targets have already been
+    checked by rcsp.decoder and rcsp.linker.
+
+    code.stack_types[pc] is set to the list of slot types (bottom
+    first) on entry to instruction pc, or None if pc is unreachable.
+    The final entry, code.stack_types[len(code.ops)], describes the
+    stack when the code runs off its end. code.max_depth is set to
+    the deepest the stack can ever be.
+
+    code.unboxed is set to True if every reachable slot holds an int
+    or a bool and every instruction can be run by the unboxed
+    interpreter.
+
+    Returns True if the signature of this or any other function in
+    the program was changed.
+    """
+    ops, args = code.ops, code.args
+    stack_types = [None] * (len(ops) + 1)
+    stack_types[0] = []
+    max_depth = 0
+    unboxed = True
+    changed = False
+    worklist = [0]
+    while len(worklist) > 0:
+        pc = worklist.pop()
+        if pc == len(ops):
+            continue
+        types = stack_types[pc][:]
+        op = ops[pc]
+        where = code.offsets[pc]  # For error messages.
+        successors = [pc + 1]
+        if (op == opcode('ADD') or op == opcode('MINUS') or
+                op == opcode('TIMES') or op == opcode('DIV') or
+                op == opcode('MOD')):
+            _pop(types, TYPE_INT, where)
+            _pop(types, TYPE_INT, where)
+            types.append(TYPE_INT)
+        elif (op == opcode('GT') or op == opcode('LT') or
+              op == opcode('GEQ') or op == opcode('LEQ') or
+              op == opcode('EQ') or op == opcode('NEQ')):
+            _pop(types, TYPE_INT, where)
+            _pop(types, TYPE_INT, where)
+            types.append(TYPE_BOOL)
+        elif op == opcode('PRINT_ITEM'):
+            _pop_any(types, where)
+        elif op == opcode('PRINT_NEWLINE'):
+            pass
+        elif op == opcode('STORE'):
+            _pop(types, TYPE_STRING, where)
+            _pop(types, TYPE_INT, where)
+            unboxed = False
+        elif op == opcode('STORE_GLOBAL'):
+            _pop(types, TYPE_INT, where)
+        elif op == opcode('LOAD_GLOBAL') or op == opcode('LOAD_CONST'):
+            types.append(TYPE_INT)
+        elif op == opcode('LOAD_NAME'):
+            types.append(TYPE_STRING)
+            unboxed = False
+        elif op == opcode('JUMP_FORWARD') or op == opcode('JUMP_ABSOLUTE'):
+            successors = [args[pc]]
+        elif (op == opcode('POP_JUMP_IF_TRUE') or
+              op == opcode('POP_JUMP_IF_FALSE')):
+            _pop(types, TYPE_BOOL, where)
+            successors.append(args[pc])
+        elif opcode_has_target_arg(op):
+            # A comparison fused with a branch by rcsp.optimizer.
+            _pop(types, TYPE_INT, where)
+            _pop(types, TYPE_INT, where)
+            successors.append(args[pc])
+        elif op == opcode('CALL_FUNCTION') or op == opcode('PAR'):
+            callee = program.code_table[args[pc]]
+            arg_types = []
+            for _ in callee.params:
+                arg_types.insert(0, _pop_any(types, where))
+            if callee.param_types is None:
+                callee.param_types = arg_types
+                changed = True
+            elif callee.param_types != arg_types:
+                raise TypeError('Wrong argument types at ' + str(where))
+            # The return value of a process is thrown away.
+            if op == opcode('PAR'):
+                unboxed = False
+            elif callee.return_type == TYPE_UNKNOWN:
+                successors = []
+            else:
+                types.append(callee.return_type)
+        elif op == opcode('LOAD_ARG'):
+            types.append(code.param_types[args[pc]])
+        elif op == opcode('MAKE_FUNCTION'):
+            pass
+        elif op == opcode('CHAN_NEW'):
+            types.append(TYPE_CHANNEL)
+        elif op == opcode('CHAN_SEND'):
+            # Channels carry ints.
+            _pop(types, TYPE_INT, where)
+            _pop(types, TYPE_CHANNEL, where)
+        elif op == opcode('CHAN_RECV'):
+            _pop(types, TYPE_CHANNEL, where)
+            types.append(TYPE_INT)
+        elif op == opcode('ALT') or op == opcode('PRI_ALT'):
+            # Each guard is a bool and a channel. The value received
+            # is pushed first, then the number of the chosen guard.
+            for _ in range(args[pc]):
+                _pop(types, TYPE_CHANNEL, where)
+                _pop(types, TYPE_BOOL, where)
+            types.append(TYPE_INT)
+            types.append(TYPE_INT)
+        elif op == opcode('RETURN'):
+            return_type = _pop_any(types, where)
+            if code.return_type == TYPE_UNKNOWN:
+                code.return_type = return_type
+                changed = True
+            elif code.return_type != return_type:
+                raise TypeError('Wrong return type at ' + str(where))
+            # The stack of main is left as it is when main returns.
+            types.append(return_type)
+            successors = []
+        if len(types) > max_depth:
+            max_depth = len(types)
+        for succ in successors:
+            if stack_types[succ] is None:
+                stack_types[succ] = types
+                worklist.append(succ)
+            elif stack_types[succ] != types:
+                raise TypeError('Inconsistent stack at ' +
+                                str(_offset(code, succ)))
+    for types in stack_types:
+        if types is None:
+            continue
+        if TYPE_STRING in types or TYPE_CHANNEL in types:
+            unboxed = False
+    code.stack_types = stack_types[:]
+    code.max_depth = max_depth
+    code.unboxed = unboxed
+    return changed
+
+
+def _offset(code, pc):
+    """Return the bytecode offset of instruction pc, for error messages.
+    """
+    if pc < len(code.offsets):
+        return code.offsets[pc]
+    return len(code.bytecode)
+
+
+def _pop_any(types, where):
+    """Pop one slot type from types, checking for underflow.
+    """
+    if len(types) == 0:
+        raise TypeError('Stack underflow at ' + str(where))
+    return types.pop()
+
+
+def _pop(types, expected, where):
+    """Pop one slot type from types and check it is expected.
+    """
+    if _pop_any(types, where) != expected:
+        raise TypeError('Wrong operand type at ' + str(where))
@@ -0,0 +1,95 @@
+"""
+Test precompiled bytecode files.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from glob import glob
+import os
+import pytest
+
+import rcsp.binary
+from rcsp.binary import dump_program, load_program, source_key
+from rcsp.loader import cache_name, load_file
+from rcsp.parser import parse_bytecode_file
+
+from tests.test_parser import assert_programs_equal
+
+
+@pytest.mark.parametrize(("filename",),
+                         [(foo,) for foo in glob('tests/example*.cspc')])
+def test_round_trip(filename):
+    """Loading a dumped program should give back the parser output.
+    """
+    with open(filename) as fn:
+        text = fn.read()
+    program = parse_bytecode_file(text)
+    data = dump_program(program, source_key(text))
+    assert_programs_equal(load_program(data, source_key(text)), program)
+    assert load_program(data, source_key(text + ' ')) is None
+    return
+
+
+def test_round_trip_shared():
+    """Shared pools should stay shared.
+    """
+    with open('tests/example8.cspc') as fn:
+        text = fn.read()
+    program = parse_bytecode_file(text, shared=True)
+    loaded = load_program(dump_program(program, source_key(text)), '')
+    assert loaded.shared_pools
+    assert loaded.get('main').strings is loaded.get('network').strings
+    assert_programs_equal(loaded, program)
+    return
+
+
+def test_portable_words(monkeypatch):
+    """Words should be encoded the same way without struct.
+    """
+    words = [0, 1, -1, 255, 256, -(2 ** 63), 2 ** 63 - 1]
+    packed = rcsp.binary._pack(words)
+    monkeypatch.setattr(rcsp.binary, 'DEBUG', False)
+    assert rcsp.binary._pack(words) == packed
+    assert rcsp.binary._unpack(packed, 0, len(words)) == words
+    return
+
+
+def test_cache(tmpdir):
+    """A source file should be cached, and the cache used until the
+    source changes.
+    """
+    source = str(tmpdir.join('prog.cspc'))
+    with open(source, 'w') as fn:
+        fn.write('DEF main\nLOAD_CONST 1\nRETURN\nENDDEF\n')
+    assert load_file(source).get('main').integers == [1]
+    assert os.path.exists(cache_name(source))
+    assert load_file(cache_name(source)).get('main').integers == [1]
+    with open(source, 'w') as fn:
+        fn.write('DEF main\nLOAD_CONST 2\nRETURN\nENDDEF\n')
+    assert load_file(source).get('main').integers == [2]
+    return
+
+
+def test_lazy_load():
+    """Functions in a .cspb file should only be read when first got.
+    """
+    with open('tests/example5.cspc') as fn:
+        text = fn.read()
+    expected = parse_bytecode_file(text)
+    program = load_program(dump_program(expected, source_key(text)), '')
+    assert program.functions == {}
+    assert_programs_equal(program, expected)
+    return
@@ -0,0 +1,64 @@
+"""
+Test the box types used by the interpreter.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from rcsp.box import IntBox, BoolBox, ChannelBox, Waiter, TRUE, FALSE
+from rcsp.box import SMALL_INT_MIN, SMALL_INT_MAX, box_int
+
+
+def test_small_ints_shared():
+    """Small integers should always be boxed by the same object.
+    """
+    assert box_int(SMALL_INT_MIN) is box_int(SMALL_INT_MIN)
+    assert box_int(SMALL_INT_MAX) is box_int(SMALL_INT_MAX)
+    assert IntBox(2).add(IntBox(3)) is box_int(5)
+    return
+
+
+def test_large_ints_equal():
+    """Integers outside the cache should still compare equal.
+    """
+    big = SMALL_INT_MAX + 1
+    assert box_int(big) is not box_int(big)
+    assert box_int(big) == IntBox(big)
+    assert IntBox(big).minus(IntBox(1)) == IntBox(SMALL_INT_MAX)
+    return
+
+
+def test_bools_shared():
+    """Comparisons should only ever return TRUE or FALSE.
+    """
+    assert IntBox(1).lt(IntBox(2)) is TRUE
+    assert IntBox(1).gt(IntBox(2)) is FALSE
+    assert IntBox(1).eq(IntBox(1)) == BoolBox(True)
+    return
+
+
+def test_channel_remove():
+    """A waiter can leave the middle of a channel queue.
+    """
+    channel = ChannelBox()
+    first, middle, last = Waiter(None, 0), Waiter(None, 1), Waiter(None, 2)
+    for waiter in (first, middle, last):
+        channel.wait(waiter, False)
+    channel.remove(middle)
+    assert middle.channel is None
+    assert channel.release() is first
+    assert channel.release() is last
+    assert not channel.has_receivers()
+    return
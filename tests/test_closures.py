@@ -0,0 +1,100 @@
+"""
+Test the closure-compiling execution engine.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from glob import glob
+import pytest
+
+import rcsp.interpreter
+from rcsp import closures
+from rcsp.box import IntBox
+from rcsp.interpreter import entry_point, mainloop
+from rcsp.linker import link_program
+from rcsp.optimizer import MAX_LEVEL
+from rcsp.parser import parse_bytecode_file
+
+from tests.test_interpreter import assert_runtime_correct
+from tests.test_parser import get_expected_results
+
+# Sums 1..10 into total, keeping 7 below the loop on the stack.
+LOOP = ('DEF main\nLOAD_CONST 7\nLOAD_CONST 0\nLOAD_NAME total\nSTORE\n'
+        'LOAD_CONST 10\nLOAD_NAME n\nSTORE\nLOAD_GLOBAL n\nLOAD_CONST 0\n'
+        'GT\nPOP_JUMP_IF_FALSE 37\nLOAD_GLOBAL total\nLOAD_GLOBAL n\nADD\n'
+        'LOAD_NAME total\nSTORE\nLOAD_GLOBAL n\nLOAD_CONST 1\nMINUS\n'
+        'LOAD_NAME n\nSTORE\nJUMP_ABSOLUTE 12\nRETURN\nENDDEF\n')
+
+
+@pytest.mark.parametrize(("filename", "level"),
+                         [(foo, bar)
+                          for foo in glob('tests/example*.cspc')
+                          for bar in range(MAX_LEVEL + 1)])
+def test_all_files(filename, level):
+    """Compiled programs should give the same results as interpreted
+    ones.
+    """
+    with open(filename) as fn:
+        bytecode = fn.read()
+    program = parse_bytecode_file(bytecode)
+    link_program(program, level)
+    actual_stack, actual_heap = closures.mainloop(program)
+    _, expected_stack, expected_heap = get_expected_results(bytecode)
+    assert_runtime_correct(actual_stack, actual_heap,
+                           expected_stack, expected_heap)
+    return
+
+
+@pytest.mark.parametrize(("level",), [(bar,) for bar in range(MAX_LEVEL + 1)])
+def test_loop(level):
+    """A value left below a loop should survive it.
+    """
+    program = parse_bytecode_file(LOOP)
+    link_program(program, level)
+    stack, heap = closures.mainloop(program)
+    assert stack == [IntBox(7)]
+    assert heap == {'total': 55, 'n': 0}
+    program = parse_bytecode_file(LOOP)
+    link_program(program, level)
+    assert mainloop(program) == (stack, heap)
+    return
+
+
+def test_undefined_global():
+    """Reading a global which was never stored should fail.
+    """
+    program = parse_bytecode_file('DEF main\nLOAD_GLOBAL missing\n'
+                                  'RETURN\nENDDEF\n')
+    with pytest.raises(KeyError):
+        closures.mainloop(program)
+    return
+
+
+def test_entry_point(capfd, monkeypatch):
+    """The engine can be chosen on the command line, and prints the
+    same as the interpreter.
+    """
+    monkeypatch.setattr(rcsp.interpreter, 'DEBUG', False)
+    filename = 'tests/example2.cspc'
+    assert entry_point(['rcsp', '--no-cache', filename]) == 0
+    expected, _ = capfd.readouterr()
+    assert entry_point(['rcsp', '--no-cache', '--engine=closures',
+                        filename]) == 0
+    actual, _ = capfd.readouterr()
+    assert actual == expected
+    assert len(actual) > 0
+    assert entry_point(['rcsp', '--engine=fast', filename]) == 1
+    return
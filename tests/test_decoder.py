@@ -0,0 +1,62 @@
+"""
+Test the decoder on example files in the tests/ directory.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import pytest
+
+from rcsp.decoder import decode_code
+from rcsp.parser import OPCODES, parse_bytecode_file
+
+
+def decode_file(filename):
+    """Parse and decode the main function of a test file.
+    """
+    with open(filename) as fn:
+        code = parse_bytecode_file(fn.read()).get('main')
+    decode_code(code)
+    return code
+
+
+def test_decode_jumps():
+    """Jump operands should be resolved to instruction indices.
+    """
+    code = decode_file('tests/example3.cspc')
+    assert code.ops[3] == OPCODES['POP_JUMP_IF_FALSE']
+    assert code.offsets[code.args[3]] == 12
+    assert code.ops[6] == OPCODES['JUMP_FORWARD']
+    assert code.offsets[code.args[6]] == 15
+    return
+
+
+def test_decode_constants():
+    """LOAD_CONST operands should be resolved to their values.
+    """
+    code = decode_file('tests/example4.cspc')
+    assert code.ops[0] == OPCODES['LOAD_CONST']
+    assert code.args[0] == 5
+    assert code.offsets[code.args[-3]] == 5
+    return
+
+
+def test_decode_bad_jump():
+    """Jumping into the middle of an instruction should be rejected.
+    """
+    code = parse_bytecode_file('DEF main\nJUMP_ABSOLUTE 1\nENDDEF\n')
+    with pytest.raises(TypeError):
+        decode_code(code.get('main'))
+    return
@@ -32,7 +32,8 @@ import pytest
 
 from rcsp.box import IntBox
 from rcsp.parser import parse_bytecode_file
-from rcsp.interpreter import mainloop
+from rcsp.interpreter import get_printable_location, mainloop, parse_count
+from rcsp.linker import link_program
 
 from tests.test_parser import get_expected_results
 
@@ -47,7 +48,7 @@ def assert_runtime_correct(actual_stack, actual_heap,
     return
 
 
-def process_one_file(filename):
+def process_one_file(filename, unboxed=True):
     """Process one test file.
 
     Parse and interpret the file, get the expected interpreter output
@@ -57,7 +58,7 @@ def process_one_file(filename):
     with open(filename) as fn:
         bytecode = fn.read()
     prog_box = parse_bytecode_file(bytecode)
-    actual_stack, actual_heap = mainloop(prog_box)
+    actual_stack, actual_heap = mainloop(prog_box, unboxed=unboxed)
     _, expected_stack, expected_heap = get_expected_results(bytecode)
     assert_runtime_correct(actual_stack, actual_heap,
                            expected_stack, expected_heap)
@@ -72,3 +73,31 @@ def test_all_files(filename):
     process_one_file(filename)
     return
 
+
+@pytest.mark.parametrize(("filename",),
+                         [(foo,) for foo in glob('tests/example*.cspc')])
+def test_all_files_boxed(filename):
+    """Test all example files without the unboxed interpreter.
+    """
+    process_one_file(filename, unboxed=False)
+    return
+
+
+def test_printable_location():
+    """Trace positions are shown as the pc and mnemonic.
+    """
+    program = parse_bytecode_file('DEF main\nLOAD_CONST 1\nRETURN\nENDDEF\n')
+    link_program(program)
+    code = program.get('main')
+    assert get_printable_location(0, code) == '0: LOAD_CONST'
+    assert get_printable_location(2, code) == '2: <end>'
+
+
+def test_parse_count():
+    """Counts on the command line are non-empty decimal digits.
+    """
+    assert parse_count('0') == 0
+    assert parse_count('120') == 120
+    for text in ['', '-1', '1x', ' 1']:
+        assert parse_count(text) == -1
+    return
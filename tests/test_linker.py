@@ -0,0 +1,83 @@
+"""
+Test the linker on example files in the tests/ directory.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from rcsp.box import IntBox
+from rcsp.interpreter import mainloop
+from rcsp.linker import link_program
+from rcsp.parser import opcode, parse_bytecode_file
+
+
+def link_file(filename):
+    """Parse and link a test file.
+    """
+    with open(filename) as fn:
+        program = parse_bytecode_file(fn.read())
+    link_program(program)
+    return program
+
+
+def test_link_slots():
+    """Each global name should be given exactly one slot.
+    """
+    program = link_file('tests/example4.cspc')
+    assert program.globals == ['counter']
+    assert program.slots == {'counter': 0}
+    code = program.get('main')
+    assert opcode('LOAD_NAME') not in code.ops
+    assert opcode('STORE') not in code.ops
+    assert code.ops.count(opcode('STORE_GLOBAL')) == 2
+    assert code.ops[-3] == opcode('JUMP_ABSOLUTE')
+    assert code.ops[code.args[-3]] == opcode('LOAD_CONST')
+    assert code.offsets[code.args[-3]] == 5
+    return
+
+
+def test_link_jump_to_store():
+    """A STORE which is a jump target should not be merged.
+    """
+    program = parse_bytecode_file('DEF main\n'
+                                  'LOAD_CONST 1\n'
+                                  'LOAD_NAME x\n'
+                                  'JUMP_ABSOLUTE 8\n'
+                                  'LOAD_NAME y\n'
+                                  'STORE\n'
+                                  'ENDDEF\n')
+    link_program(program)
+    code = program.get('main')
+    assert code.ops[-1] == opcode('STORE')
+    assert code.args[2] == 4
+    _, heap = mainloop(program)
+    assert heap == {'x': 1}
+    return
+
+
+def test_link_reachable():
+    """Only functions which can be called from main should be parsed
+    and linked.
+    """
+    program = parse_bytecode_file('DEF main\nCALL_FUNCTION f\nRETURN\n'
+                                  'ENDDEF\n'
+                                  'DEF f\nLOAD_CONST 1\nRETURN\nENDDEF\n'
+                                  'DEF unused\nCALL_FUNCTION missing\n'
+                                  'RETURN\nENDDEF\n')
+    link_program(program)
+    assert sorted(program.function_index.keys()) == ['f', 'main']
+    assert 'unused' not in program.functions
+    assert mainloop(program)[0] == [IntBox(1)]
+    return
@@ -0,0 +1,51 @@
+"""
+Test reading program files.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+from rcsp.loader import read_fd
+from rcsp.parser import parse_bytecode_file
+
+from tests.test_parser import assert_programs_equal
+
+
+def test_read_file():
+    """A file should parse the same whether or not it is mapped.
+    """
+    filename = 'tests/example4.cspc'
+    with open(filename) as fn:
+        expected = parse_bytecode_file(fn.read())
+    fd = os.open(filename, os.O_RDONLY)
+    text = read_fd(fd)
+    os.close(fd)
+    assert_programs_equal(parse_bytecode_file(text), expected)
+    return
+
+
+def test_read_pipe():
+    """Files without a size should be read to the end.
+    """
+    read_fd_, write_fd = os.pipe()
+    os.write(write_fd, 'DEF main\nLOAD_CONST 1\nRETURN\nENDDEF')
+    os.close(write_fd)
+    text = read_fd(read_fd_)
+    os.close(read_fd_)
+    assert text == 'DEF main\nLOAD_CONST 1\nRETURN\nENDDEF'
+    assert parse_bytecode_file(text).get('main').integers == [1]
+    return
@@ -0,0 +1,103 @@
+"""
+Test running process networks on a pool of workers.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import pytest
+
+from rcsp import interpreter
+from rcsp.interpreter import DeadlockError, entry_point
+from rcsp.multicore import mainloop
+from rcsp.parser import parse_bytecode_file
+
+from tests.test_interpreter import assert_runtime_correct
+from tests.test_parser import get_expected_results
+
+# main starts a process which counts y up to 99, and returns at once.
+COUNTER = ('DEF main\nPAR count\nLOAD_CONST 0\nRETURN\nENDDEF\n'
+           'DEF count\nLOAD_CONST 99\nLOAD_NAME x\nSTORE\nLOAD_CONST 0\n'
+           'LOAD_NAME y\nSTORE\nLOAD_GLOBAL x\nLOAD_CONST 0\nGT\n'
+           'POP_JUMP_IF_FALSE 35\nLOAD_GLOBAL y\nLOAD_CONST 1\nADD\n'
+           'LOAD_NAME y\nSTORE\nLOAD_GLOBAL x\nLOAD_CONST 1\nMINUS\n'
+           'LOAD_NAME x\nSTORE\nJUMP_ABSOLUTE 10\nLOAD_CONST 0\nRETURN\n'
+           'ENDDEF\n')
+
+
+# Examples whose result does not depend on how processes interleave.
+@pytest.mark.parametrize(("filename", "workers"),
+                         [(foo, bar)
+                          for foo in ['tests/example7.cspc',
+                                      'tests/example8.cspc',
+                                      'tests/example10.cspc']
+                          for bar in [1, 2, 4]])
+def test_pool(filename, workers):
+    """Results should not depend on the number of workers.
+    """
+    with open(filename) as fn:
+        bytecode = fn.read()
+    actual_stack, actual_heap = mainloop(parse_bytecode_file(bytecode),
+                                         workers)
+    _, expected_stack, expected_heap = get_expected_results(bytecode)
+    assert_runtime_correct(actual_stack, actual_heap,
+                           expected_stack, expected_heap)
+    return
+
+
+def test_pool_deadlock():
+    """main waiting on a process on another worker which never sends
+    should be a deadlock.
+    """
+    program = parse_bytecode_file('DEF main\nCHAN_NEW\n'
+                                  'CALL_FUNCTION network\nRETURN\nENDDEF\n'
+                                  'DEF network\nLOAD_ARG c\nPAR idle\n'
+                                  'LOAD_ARG c\nCHAN_RECV\nRETURN\nENDDEF\n'
+                                  'DEF idle\nLOAD_ARG c\nRETURN\nENDDEF\n')
+    with pytest.raises(DeadlockError):
+        mainloop(program, 2)
+    return
+
+
+@pytest.mark.parametrize("workers", [1, 2, 4])
+def test_pool_outlives_main(workers):
+    """Processes on other workers should run to the end after main
+    has returned.
+    """
+    expected = interpreter.mainloop(parse_bytecode_file(COUNTER))
+    assert expected[1] == {'x': 0, 'y': 99}
+    assert mainloop(parse_bytecode_file(COUNTER), workers) == expected
+    return
+
+
+def test_entry_point(tmpdir, capfd, monkeypatch):
+    """A process placed on another worker prints as it would in the
+    interpreter.
+    """
+    monkeypatch.setattr(interpreter, 'DEBUG', False)
+    filename = str(tmpdir.join('hello.cspc'))
+    with open(filename, 'w') as fn:
+        fn.write('DEF main\nPAR hello\nLOAD_CONST 0\nRETURN\nENDDEF\n'
+                 'DEF hello\nLOAD_CONST 7\nPRINT_ITEM\nLOAD_CONST 0\n'
+                 'RETURN\nENDDEF\n')
+    assert entry_point(['rcsp', '--no-cache', filename]) == 0
+    expected, _ = capfd.readouterr()
+    assert expected == '7\n'
+    assert entry_point(['rcsp', '--no-cache', '--engine=multicore',
+                        '--workers=2', filename]) == 0
+    actual, _ = capfd.readouterr()
+    assert actual == expected
+    assert entry_point(['rcsp', '--workers=0', filename]) == 1
+    return
@@ -0,0 +1,155 @@
+"""
+Test the bytecode optimizer.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from glob import glob
+import pytest
+
+from rcsp.box import IntBox
+from rcsp.interpreter import mainloop
+from rcsp.linker import link_program
+from rcsp.optimizer import MAX_LEVEL
+from rcsp.parser import opcode, parse_bytecode_file
+
+from tests.test_interpreter import assert_runtime_correct
+from tests.test_parser import get_expected_results
+
+
+def optimize_main(text, level=1):
+    """Parse, optimize and link a program and return main.
+    """
+    program = parse_bytecode_file(text)
+    link_program(program, level)
+    return program.get('main')
+
+
+@pytest.mark.parametrize(("filename", "level"),
+                         [(foo, bar)
+                          for foo in glob('tests/example*.cspc')
+                          for bar in range(1, MAX_LEVEL + 1)])
+def test_all_files(filename, level):
+    """Optimized programs should give the same results.
+    """
+    with open(filename) as fn:
+        bytecode = fn.read()
+    program = parse_bytecode_file(bytecode)
+    link_program(program, level)
+    actual_stack, actual_heap = mainloop(program)
+    _, expected_stack, expected_heap = get_expected_results(bytecode)
+    assert_runtime_correct(actual_stack, actual_heap,
+                           expected_stack, expected_heap)
+    return
+
+
+def test_constant_branch():
+    """A branch on a constant comparison should be resolved, and the
+    branch which is never taken removed.
+    """
+    with open('tests/example3.cspc') as fn:
+        main = optimize_main(fn.read())
+    assert main.ops == [opcode('LOAD_CONST'), opcode('PRINT_ITEM'),
+                        opcode('JUMP_FORWARD'), opcode('LOAD_CONST'),
+                        opcode('RETURN')]
+    assert main.args[0] == 100
+    return
+
+
+def test_fold_arithmetic():
+    """Chains of constant arithmetic should fold to one constant.
+    """
+    main = optimize_main('DEF main\nLOAD_CONST 2\nLOAD_CONST 3\nTIMES\n'
+                         'LOAD_CONST 4\nMINUS\nLOAD_CONST 7\nLOAD_CONST 0\n'
+                         'DIV\nRETURN\nENDDEF\n')
+    assert main.ops[0] == opcode('LOAD_CONST')
+    assert main.args[0] == 2
+    assert main.ops[1:] == [opcode('LOAD_CONST'), opcode('LOAD_CONST'),
+                            opcode('DIV'), opcode('RETURN')]
+    return
+
+
+def test_no_fold_jump_target():
+    """Constants should not be folded across a jump target.
+    """
+    main = optimize_main('DEF main\nLOAD_CONST 1\nLOAD_CONST 2\nADD\n'
+                         'JUMP_ABSOLUTE 2\nENDDEF\n')
+    assert main.ops == [opcode('LOAD_CONST'), opcode('LOAD_CONST'),
+                        opcode('ADD'), opcode('JUMP_ABSOLUTE')]
+    return
+
+
+def test_fuse_branches():
+    """The comparison and branch of a loop should be fused.
+    """
+    with open('tests/example4.cspc') as fn:
+        main = optimize_main(fn.read(), 2)
+    assert main.ops[4] == opcode('JUMP_IF_NOT_LT')
+    assert opcode('LT') not in main.ops
+    assert opcode('POP_JUMP_IF_FALSE') not in main.ops
+    assert main.ops[main.args[4]:] == [opcode('LOAD_CONST'),
+                                       opcode('RETURN')]
+    assert main.ops[-3] == opcode('JUMP_ABSOLUTE')
+    assert main.args[-3] == 2
+    return
+
+
+def test_fuse_negated_branch():
+    """POP_JUMP_IF_TRUE should fuse with the opposite comparison.
+    """
+    program = parse_bytecode_file('DEF main\nLOAD_CONST 3\n'
+                                  'CALL_FUNCTION f\nRETURN\nENDDEF\n'
+                                  'DEF f\nLOAD_ARG x\nLOAD_CONST 1\nGT\n'
+                                  'POP_JUMP_IF_TRUE 10\nLOAD_CONST 2\n'
+                                  'RETURN\nLOAD_CONST 4\nRETURN\nENDDEF\n')
+    link_program(program, 2)
+    assert program.get('f').ops[2] == opcode('JUMP_IF_NOT_LEQ')
+    stack, _ = mainloop(program)
+    assert stack == [IntBox(4)]
+    return
+
+
+def test_thread_jumps():
+    """Jumps to jumps should be threaded, and jumps to the next
+    instruction removed.
+    """
+    with open('tests/example3.cspc') as fn:
+        main = optimize_main(fn.read(), 2)
+    assert main.ops == [opcode('LOAD_CONST'), opcode('PRINT_ITEM'),
+                        opcode('LOAD_CONST'), opcode('RETURN')]
+    main = optimize_main('DEF main\nLOAD_CONST 1\nJUMP_ABSOLUTE 6\n'
+                         'JUMP_ABSOLUTE 8\nJUMP_ABSOLUTE 4\nRETURN\n'
+                         'ENDDEF\n', 2)
+    assert main.ops == [opcode('LOAD_CONST'), opcode('RETURN')]
+    main = optimize_main('DEF main\nJUMP_ABSOLUTE 2\nJUMP_ABSOLUTE 0\n'
+                         'ENDDEF\n', 2)
+    assert main.ops == [opcode('JUMP_ABSOLUTE')]
+    assert main.args == [0]
+    return
+
+
+@pytest.mark.parametrize("level", range(MAX_LEVEL + 1))
+def test_verify_before_optimizing(level):
+    """A program which is rejected without optimization should be
+    rejected at every level, even if its error would be optimized away.
+    """
+    with open('tests/example3.cspc') as fn:
+        text = fn.read().replace('LOAD_CONST 200\nPRINT_ITEM',
+                                 'LOAD_CONST 200\nADD')
+    program = parse_bytecode_file(text)
+    with pytest.raises(TypeError):
+        link_program(program, level)
+    return
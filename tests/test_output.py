@@ -0,0 +1,78 @@
+"""
+Test buffered output.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+from rcsp.output import Output, BLOCK_BUFFERED, LINE_BUFFERED, UNBUFFERED
+
+
+def written(out, read_fd):
+    """Return everything written to the pipe so far.
+    """
+    os.close(out.fd)
+    data = ''
+    while True:
+        chunk = os.read(read_fd, 4096)
+        if len(chunk) == 0:
+            break
+        data += chunk
+    os.close(read_fd)
+    return data
+
+
+def test_block_buffered():
+    """Nothing is written until the buffer is full or flushed.
+    """
+    read_fd, write_fd = os.pipe()
+    out = Output(write_fd, BLOCK_BUFFERED, 8)
+    out.write_item('1')
+    out.write_item('True')
+    assert out.length == 7
+    out.write_newline()
+    assert out.length == 0
+    out.write('3')
+    out.flush()
+    assert written(out, read_fd) == '1\nTrue\n\n3'
+    return
+
+
+def test_line_buffered():
+    """Each line is written when it ends.
+    """
+    read_fd, write_fd = os.pipe()
+    out = Output(write_fd, LINE_BUFFERED, 8)
+    out.write('1')
+    assert out.length == 1
+    out.write_newline()
+    assert out.length == 0
+    out.write_item('2')
+    assert out.length == 0
+    assert written(out, read_fd) == '1\n2\n'
+    return
+
+
+def test_unbuffered():
+    """Every write goes straight out.
+    """
+    read_fd, write_fd = os.pipe()
+    out = Output(write_fd, UNBUFFERED, 8)
+    out.write_item('42')
+    assert out.length == 0
+    assert written(out, read_fd) == '42\n'
+    return
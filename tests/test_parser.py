@@ -32,7 +32,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import pytest
 from glob import glob
-from rcsp.parser import parse_bytecode_file
+from rcsp.parser import parse_bytecode_file, tokenize
 
 from rcsp.box import IntBox              # Needed by exec()
 from rcsp.parser import OPCODES          # Needed by exec()
@@ -48,6 +48,7 @@ def assert_programs_equal(actual, expected):
         assert expected.get(fn).strings == actual.get(fn).strings
         assert expected.get(fn).integers == actual.get(fn).integers
         assert expected.get(fn).bools == actual.get(fn).bools
+        assert expected.get(fn).targets == actual.get(fn).targets
     return
 
 
@@ -102,3 +103,73 @@ def test_all_files(filename):
     process_one_file(filename)
     return
 
+
+def test_tokenize():
+    """Comments and blank lines should be skipped, and words may be
+    split over lines in any way.
+    """
+    text = '# A comment.\nDEF main\n\n  LOAD_CONST   1\n# DEF\nRETURN ENDDEF'
+    assert list(tokenize(text)) == ['DEF', 'main', 'LOAD_CONST', '1',
+                                    'RETURN', 'ENDDEF']
+    return
+
+
+def test_bool_literals():
+    """True and False should be parsed as different literals.
+    """
+    code = parse_bytecode_file('DEF main\nTrue\nFalse\nENDDEF\n')
+    assert code.get('main').bools == [True, False]
+    return
+
+
+def test_missing_enddef():
+    """A function without ENDDEF is an error.
+    """
+    with pytest.raises(TypeError):
+        parse_bytecode_file('DEF main\nLOAD_CONST 1\n')
+    return
+
+
+def test_shared_pools():
+    """With shared pools each literal is held once in the program.
+    """
+    program = parse_bytecode_file('DEF main\nLOAD_CONST 7\n'
+                                  'CALL_FUNCTION f\nRETURN\nENDDEF\n'
+                                  'DEF f\nLOAD_CONST 7\nLOAD_CONST 8\n'
+                                  'RETURN\nENDDEF\n', shared=True)
+    main, f = program.get('main'), program.get('f')
+    assert main.integers is f.integers
+    assert main.integers == [7, 8]
+    assert main.strings == ['f']
+    assert f.bytecode[1] == main.bytecode[1]
+    return
+
+
+def test_lazy_functions():
+    """Functions should only be parsed when they are first got.
+    """
+    program = parse_bytecode_file('# Comment\nDEF main\nLOAD_CONST 1\n'
+                                  'RETURN\nENDDEF\n\n'
+                                  'DEF f\n# ENDDEF\nLOAD_NAME ENDDEFS\n'
+                                  'RETURN ENDDEF\n'
+                                  'DEF g LOAD_CONST 2 RETURN ENDDEF\n')
+    assert program.functions == {}
+    assert sorted(program.get_functions()) == ['f', 'g', 'main']
+    f = program.get('f')
+    assert f.strings == ['ENDDEFS']
+    assert program.functions == {'f': f}
+    assert program.get('g').integers == [2]
+    assert program.has('main') and not program.has('h')
+    return
+
+
+def test_unindexed_functions():
+    """Functions which do not start and end their own lines should
+    still be parsed.
+    """
+    program = parse_bytecode_file('DEF main\nLOAD_CONST 1\n'
+                                  'RETURN ENDDEF DEF f\nRETURN\nENDDEF\n')
+    assert sorted(program.functions.keys()) == ['f', 'main']
+    with pytest.raises(TypeError):
+        parse_bytecode_file('DEF main\nRETURN\nENDDEF\nRETURN\n')
+    return
@@ -0,0 +1,70 @@
+"""
+Test the opcode sequence profiler.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from rcsp.linker import link_program
+from rcsp.parser import opcode, parse_bytecode_file
+from rcsp.profiler import Profile, render, run_quietly
+
+
+def profile_file(filename):
+    with open(filename) as fn:
+        program = parse_bytecode_file(fn.read())
+    link_program(program, 2)
+    profile = Profile()
+    run_quietly(program, profile)
+    return profile
+
+
+def test_profile_loop():
+    """Sequences should only be counted within straight-line code.
+    """
+    profile = profile_file('tests/example4.cspc')
+    # Five times round the loop, and once more to leave it.
+    assert profile.counts[('LOAD_CONST', 'LOAD_GLOBAL',
+                           'JUMP_IF_NOT_LT')] == 6
+    assert profile.counts[('LOAD_CONST', 'MINUS', 'STORE_GLOBAL')] == 5
+    assert ('STORE_GLOBAL', 'JUMP_ABSOLUTE') in profile.counts
+    assert ('JUMP_ABSOLUTE', 'LOAD_CONST') not in profile.counts
+    assert profile.dispatches == 57
+    return
+
+
+def test_choose_and_render():
+    """The chosen sequences should save the most dispatches, and the
+    generated module should hold them.
+    """
+    profile = profile_file('tests/example4.cspc')
+    chosen = profile.choose(2)
+    assert chosen == [('LOAD_CONST', 'LOAD_GLOBAL', 'JUMP_IF_NOT_LT'),
+                      ('LOAD_CONST', 'MINUS', 'STORE_GLOBAL')]
+    namespace = {}
+    exec(render(chosen, profile, ['tests/example4.cspc']), namespace)
+    assert namespace['SUPERINSTRUCTIONS'] == chosen
+    return
+
+
+def test_handlers_restored():
+    """Profiling should leave the handler tables as they were.
+    """
+    from rcsp.interpreter import HANDLERS
+    before = HANDLERS[:]
+    profile_file('tests/example0.cspc')
+    assert HANDLERS == before
+    assert HANDLERS[opcode('ADD')].__name__ == 'op_add'
+    return
@@ -0,0 +1,106 @@
+"""
+Test the quickening of instructions by the interpreter.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from glob import glob
+import pytest
+
+from rcsp.interpreter import NO_QUICKENING, mainloop
+from rcsp.linker import link_program
+from rcsp.optimizer import MAX_LEVEL
+from rcsp.parser import opcode, opcode_mnemonic, parse_bytecode_file
+
+from tests.test_closures import LOOP
+from tests.test_interpreter import assert_runtime_correct
+from tests.test_parser import get_expected_results
+
+# Counts i down from 4, storing i to EVEN when it is even and to ODD
+# when it is odd, with a STORE which can not be linked to a slot.
+ALTERNATING = ('DEF main\nLOAD_CONST 4\nLOAD_NAME i\nSTORE\n'
+               'LOAD_GLOBAL i\nLOAD_CONST 0\nGT\nPOP_JUMP_IF_FALSE 41\n'
+               'LOAD_GLOBAL i\nLOAD_GLOBAL i\nLOAD_CONST 2\nMOD\n'
+               'LOAD_CONST 0\nEQ\nPOP_JUMP_IF_FALSE 28\nLOAD_NAME EVEN\n'
+               'JUMP_ABSOLUTE 30\nLOAD_NAME ODD\nSTORE\n'
+               'LOAD_GLOBAL i\nLOAD_CONST 1\nMINUS\nLOAD_NAME i\nSTORE\n'
+               'JUMP_ABSOLUTE 5\nLOAD_CONST 0\nRETURN\nENDDEF\n')
+
+
+def quick_mnemonics(program, name='main'):
+    code = program.get(name)
+    return [opcode_mnemonic(op) for op in code.quick_ops]
+
+
+@pytest.mark.parametrize(("filename", "level"),
+                         [(foo, bar)
+                          for foo in glob('tests/example*.cspc')
+                          for bar in range(MAX_LEVEL + 1)])
+def test_run_twice(filename, level):
+    """Running a program again starts from unquickened code, and
+    gives the same results.
+    """
+    with open(filename) as fn:
+        bytecode = fn.read()
+    _, expected_stack, expected_heap = get_expected_results(bytecode)
+    program = parse_bytecode_file(bytecode)
+    link_program(program, level)
+    for unboxed in [True, False, True]:
+        actual_stack, actual_heap = mainloop(program, unboxed)
+        assert_runtime_correct(actual_stack, actual_heap,
+                               expected_stack, expected_heap)
+    return
+
+
+@pytest.mark.parametrize("unboxed", [True, False])
+def test_quickened(unboxed):
+    """Global loads and unfused comparisons are quickened, and the
+    linked code is left as it was.
+    """
+    program = parse_bytecode_file(LOOP)
+    link_program(program, 0)
+    ops = program.get('main').ops[:]
+    assert mainloop(program, unboxed)[1] == {'total': 55, 'n': 0}
+    quickened = quick_mnemonics(program)
+    assert 'LOAD_GLOBAL' not in quickened
+    assert 'LOAD_GLOBAL_BOUND' in quickened
+    assert 'GT_BRANCH' in quickened
+    assert program.get('main').ops == ops
+    return
+
+
+@pytest.mark.parametrize(("even", "odd", "expected", "quickened"),
+                         [('evens', 'odds', {'evens': 2, 'odds': 1},
+                           False),
+                          ('last', 'last', {'last': 1}, True)])
+def test_store(even, odd, expected, quickened):
+    """A STORE keeps the slot of the name it stores, until it is
+    given another name.
+    """
+    text = ALTERNATING.replace('EVEN', even).replace('ODD', odd)
+    program = parse_bytecode_file(text)
+    link_program(program, 0)
+    expected['i'] = 0
+    assert mainloop(program)[1] == expected
+    code = program.get('main')
+    store = code.ops.index(opcode('STORE'))
+    if quickened:
+        assert code.quick_ops[store] == opcode('STORE_SLOT')
+        assert code.quick_args[store] == program.slots[even]
+    else:
+        assert code.quick_ops[store] == opcode('STORE')
+        assert code.quick_args[store] == NO_QUICKENING
+    return
@@ -0,0 +1,129 @@
+"""
+Test tiered execution.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from glob import glob
+import pytest
+
+import rcsp.interpreter
+from rcsp.interpreter import entry_point, mainloop
+from rcsp.linker import link_program
+from rcsp.optimizer import MAX_LEVEL
+from rcsp.parser import parse_bytecode_file
+from rcsp.tiers import Tiers
+
+from tests.test_closures import LOOP
+from tests.test_interpreter import assert_runtime_correct
+from tests.test_parser import get_expected_results
+from tests.test_tracer import CALLS, EVENS, run
+from tests.test_transpiler import RECURSIVE
+
+# Pairs of call and loop thresholds.
+THRESHOLDS = [(0, 0), (1, 1), (2, 3), (3, 2), (20, 100)]
+
+
+def run_tiered(text, level, call_threshold, loop_threshold):
+    program = parse_bytecode_file(text)
+    link_program(program, level)
+    tiers = Tiers(program, call_threshold, loop_threshold)
+    return tiers, mainloop(program, False, tiers)
+
+
+@pytest.mark.parametrize(("filename", "level"),
+                         [(foo, bar)
+                          for foo in glob('tests/example*.cspc')
+                          for bar in range(MAX_LEVEL + 1)])
+def test_all_files(filename, level):
+    """Programs should give the same results whichever tier runs
+    each function.
+    """
+    with open(filename) as fn:
+        bytecode = fn.read()
+    _, expected_stack, expected_heap = get_expected_results(bytecode)
+    for call_threshold, loop_threshold in THRESHOLDS:
+        _, (actual_stack, actual_heap) = run_tiered(
+            bytecode, level, call_threshold, loop_threshold)
+        assert_runtime_correct(actual_stack, actual_heap,
+                               expected_stack, expected_heap)
+    return
+
+
+@pytest.mark.parametrize(("text", "level"),
+                         [(foo, bar)
+                          for foo in [LOOP, EVENS, CALLS, RECURSIVE]
+                          for bar in range(MAX_LEVEL + 1)])
+def test_same_as_interpreter(text, level, capfd, monkeypatch):
+    """Moving frames between the tiers in the middle of a loop or a
+    call should leave the stack and globals as the interpreter
+    would, and print the same.
+    """
+    monkeypatch.setattr(rcsp.interpreter, 'DEBUG', False)
+    expected = run(text, level, False, None)
+    expected_output, _ = capfd.readouterr()
+    for call_threshold, loop_threshold in THRESHOLDS:
+        _, actual = run_tiered(text, level, call_threshold, loop_threshold)
+        assert actual == expected
+        assert capfd.readouterr()[0].strip() == expected_output.strip()
+    return
+
+
+def test_hot_calls():
+    """A recursive function is compiled once it has been called
+    often enough, and main, which is called once, is not.
+    """
+    tiers, (stack, heap) = run_tiered(RECURSIVE, 0, 5, 100)
+    assert heap == {'calls': 21}
+    names = tiers.program.function_index
+    table = tiers.program.code_table
+    main = table[names['main']]
+    total = table[names['sum']]
+    assert tiers.calls == {main: 1, total: 21}
+    assert tiers.hot == {total: 'calls'}
+    assert tiers.transfers == 1
+    return
+
+
+def test_hot_loop():
+    """A loop is moved to compiled code at its head, once it has run
+    often enough in the interpreter.
+    """
+    tiers, (stack, heap) = run_tiered(LOOP, 0, 20, 3)
+    assert heap == {'total': 55, 'n': 0}
+    assert tiers.loops.values() == [3]
+    assert tiers.hot.values() == ['loops']
+    assert tiers.loop_transfers == 1
+    return
+
+
+def test_entry_point(capfd, monkeypatch):
+    """The engine prints the same as the interpreter, and reports
+    its statistics on stderr.
+    """
+    monkeypatch.setattr(rcsp.interpreter, 'DEBUG', False)
+    filename = 'tests/example4.cspc'
+    assert entry_point(['rcsp', '--no-cache', filename]) == 0
+    expected, _ = capfd.readouterr()
+    assert entry_point(['rcsp', '--no-cache', '--engine=tiered',
+                        '--call-threshold=1', '--loop-threshold=2',
+                        filename]) == 0
+    actual, report = capfd.readouterr()
+    assert actual == expected
+    assert report.split('\n')[1].split() == ['main', '1', '0',
+                                             'closures', '(calls)']
+    assert entry_point(['rcsp', '--loop-threshold=x', filename]) == 1
+    return
@@ -0,0 +1,126 @@
+"""
+Test the tracing JIT.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from glob import glob
+import pytest
+
+import rcsp.interpreter
+from rcsp.interpreter import entry_point, mainloop
+from rcsp.linker import link_program
+from rcsp.optimizer import MAX_LEVEL
+from rcsp.parser import parse_bytecode_file
+from rcsp.tracer import Tracer
+
+from tests.test_closures import LOOP
+from tests.test_interpreter import assert_runtime_correct
+from tests.test_parser import get_expected_results
+from tests.test_transpiler import RECURSIVE
+
+# Adds i / 2 to total for each even i from 12 down to 1, so that the
+# branch inside the loop goes both ways.
+EVENS = ('DEF main\nLOAD_CONST 0\nLOAD_NAME total\nSTORE\nLOAD_CONST 12\n'
+         'LOAD_NAME i\nSTORE\nLOAD_GLOBAL i\nLOAD_CONST 0\nGT\n'
+         'POP_JUMP_IF_FALSE 48\nLOAD_GLOBAL i\nLOAD_CONST 2\nMOD\n'
+         'LOAD_CONST 0\nEQ\nPOP_JUMP_IF_FALSE 38\nLOAD_GLOBAL total\n'
+         'LOAD_GLOBAL i\nLOAD_CONST 2\nDIV\nADD\nLOAD_NAME total\nSTORE\n'
+         'LOAD_GLOBAL i\nLOAD_CONST 1\nMINUS\nLOAD_NAME i\nSTORE\n'
+         'JUMP_ABSOLUTE 10\nLOAD_GLOBAL total\nRETURN\nENDDEF\n')
+
+# Calls a function from inside a loop.
+CALLS = ('DEF main\nLOAD_CONST 0\nLOAD_NAME calls\nSTORE\nLOAD_CONST 5\n'
+         'LOAD_NAME n\nSTORE\nLOAD_GLOBAL n\nLOAD_CONST 0\nGT\n'
+         'POP_JUMP_IF_FALSE 32\nLOAD_GLOBAL n\nCALL_FUNCTION sum\nPRINT_ITEM\n'
+         'LOAD_GLOBAL n\nLOAD_CONST 1\nMINUS\nLOAD_NAME n\nSTORE\n'
+         'JUMP_ABSOLUTE 10\nLOAD_CONST 0\nRETURN\nENDDEF\n' +
+         RECURSIVE[RECURSIVE.index('DEF sum'):])
+
+PROGRAMS = [LOOP, EVENS, CALLS]
+
+
+def run(text, level, unboxed, tracer):
+    program = parse_bytecode_file(text)
+    link_program(program, level)
+    return mainloop(program, unboxed, tracer)
+
+
+@pytest.mark.parametrize(("filename", "level"),
+                         [(foo, bar)
+                          for foo in glob('tests/example*.cspc')
+                          for bar in range(MAX_LEVEL + 1)])
+def test_all_files(filename, level):
+    """Traced programs should give the same results as interpreted
+    ones.
+    """
+    with open(filename) as fn:
+        bytecode = fn.read()
+    _, expected_stack, expected_heap = get_expected_results(bytecode)
+    for unboxed in [True, False]:
+        actual_stack, actual_heap = run(bytecode, level, unboxed, Tracer(1))
+        assert_runtime_correct(actual_stack, actual_heap,
+                               expected_stack, expected_heap)
+    return
+
+
+@pytest.mark.parametrize(("text", "level", "unboxed"),
+                         [(foo, bar, baz)
+                          for foo in PROGRAMS
+                          for bar in range(MAX_LEVEL + 1)
+                          for baz in [True, False]])
+def test_same_as_interpreter(text, level, unboxed, capfd, monkeypatch):
+    """Leaving a trace through any guard should leave the stack and
+    globals as the interpreter would, and print the same.
+    """
+    monkeypatch.setattr(rcsp.interpreter, 'DEBUG', False)
+    expected = run(text, level, unboxed, None)
+    expected_output, _ = capfd.readouterr()
+    for threshold in [1, 2, 3]:
+        assert run(text, level, unboxed, Tracer(threshold)) == expected
+        actual_output, _ = capfd.readouterr()
+        assert actual_output == expected_output
+    return
+
+
+@pytest.mark.parametrize(("level", "unboxed"),
+                         [(bar, baz)
+                          for bar in range(MAX_LEVEL + 1)
+                          for baz in [True, False]])
+def test_traces(level, unboxed):
+    """Loops which stay in their frame are compiled, and loops which
+    call functions are given up on.
+    """
+    tracer = Tracer(2)
+    run(EVENS, level, unboxed, tracer)
+    traces = tracer.traces.values()
+    assert len(traces) == 1 and traces[0] is not None
+    tracer = Tracer(1)
+    run(CALLS, level, unboxed, tracer)
+    assert tracer.traces.values() == [None]
+    return
+
+
+def test_entry_point(capfd, monkeypatch):
+    monkeypatch.setattr(rcsp.interpreter, 'DEBUG', False)
+    filename = 'tests/example4.cspc'
+    assert entry_point(['rcsp', '--no-cache', filename]) == 0
+    expected, _ = capfd.readouterr()
+    assert entry_point(['rcsp', '--no-cache', '--engine=tracing',
+                        filename]) == 0
+    actual, _ = capfd.readouterr()
+    assert actual == expected
+    return
@@ -0,0 +1,149 @@
+"""
+Test the translation of programs to Python.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from glob import glob
+import os
+import pytest
+
+from rcsp import transpiler
+from rcsp.box import IntBox
+from rcsp.interpreter import mainloop
+from rcsp.linker import link_program
+from rcsp.optimizer import MAX_LEVEL
+from rcsp.parser import parse_bytecode_file
+
+from tests.test_closures import LOOP
+from tests.test_interpreter import assert_runtime_correct
+from tests.test_parser import get_expected_results
+
+# Sums 1..n with a recursive function which counts its calls.
+RECURSIVE = ('DEF main\nLOAD_CONST 0\nLOAD_NAME calls\nSTORE\n'
+             'LOAD_CONST 20\nCALL_FUNCTION sum\nRETURN\nENDDEF\n'
+             'DEF sum\nLOAD_GLOBAL calls\nLOAD_CONST 1\nADD\n'
+             'LOAD_NAME calls\nSTORE\nLOAD_ARG n\nLOAD_CONST 0\nEQ\n'
+             'POP_JUMP_IF_FALSE 18\nLOAD_CONST 0\nRETURN\nLOAD_ARG n\n'
+             'LOAD_ARG n\nLOAD_CONST 1\nMINUS\nCALL_FUNCTION sum\nADD\n'
+             'RETURN\nENDDEF\n')
+
+# Doubles 3 twice, with a function which counts its calls.
+CALLS = ('DEF main\nLOAD_CONST 0\nLOAD_NAME calls\nSTORE\n'
+         'LOAD_CONST 3\nCALL_FUNCTION double\nCALL_FUNCTION double\n'
+         'RETURN\nENDDEF\n'
+         'DEF double\nLOAD_GLOBAL calls\nLOAD_CONST 1\nADD\n'
+         'LOAD_NAME calls\nSTORE\nLOAD_ARG n\nLOAD_ARG n\nADD\n'
+         'RETURN\nENDDEF\n')
+
+
+@pytest.mark.parametrize(("filename", "level"),
+                         [(foo, bar)
+                          for foo in glob('tests/example*.cspc')
+                          for bar in range(MAX_LEVEL + 1)])
+def test_all_files(filename, level):
+    """Translated programs should give the same results as interpreted
+    ones. Programs which can not be translated run with closures.
+    """
+    with open(filename) as fn:
+        bytecode = fn.read()
+    program = parse_bytecode_file(bytecode)
+    link_program(program, level)
+    actual_stack, actual_heap = transpiler.mainloop(program)
+    _, expected_stack, expected_heap = get_expected_results(bytecode)
+    assert_runtime_correct(actual_stack, actual_heap,
+                           expected_stack, expected_heap)
+    return
+
+
+@pytest.mark.parametrize(("text", "level"),
+                         [(foo, bar)
+                          for foo in [LOOP, CALLS]
+                          for bar in range(MAX_LEVEL + 1)])
+def test_same_as_interpreter(text, level):
+    """Loops, calls and globals shared between functions should give
+    the same results as the interpreter.
+    """
+    program = parse_bytecode_file(text)
+    link_program(program, level)
+    assert transpiler.compile_program(program) is not None
+    expected = mainloop(program)
+    program = parse_bytecode_file(text)
+    link_program(program, level)
+    assert transpiler.mainloop(program) == expected
+    return
+
+
+def test_recursive():
+    """Recursive programs are left to rcsp.closures.
+    """
+    program = parse_bytecode_file(RECURSIVE)
+    link_program(program)
+    assert program.unboxed
+    assert transpiler.transpile(program) is None
+    stack, heap = transpiler.mainloop(program)
+    assert stack == [IntBox(210)]
+    assert heap == {'calls': 21}
+    return
+
+
+def test_deep_recursion():
+    """Recursion deeper than the stack of the host gives the same
+    results as the interpreter.
+    """
+    text = RECURSIVE.replace('LOAD_CONST 20\n', 'LOAD_CONST 5000\n')
+    expected = mainloop(parse_bytecode_file(text))
+    assert expected == ([IntBox(12502500)], {'calls': 5001})
+    assert transpiler.mainloop(parse_bytecode_file(text)) == expected
+    return
+
+
+def test_not_translated():
+    """Programs with processes are left to rcsp.closures.
+    """
+    with open('tests/example8.cspc') as fn:
+        program = parse_bytecode_file(fn.read())
+    link_program(program)
+    assert transpiler.transpile(program) is None
+    return
+
+
+def test_undefined_global():
+    program = parse_bytecode_file('DEF main\nLOAD_GLOBAL missing\n'
+                                  'RETURN\nENDDEF\n')
+    with pytest.raises(KeyError):
+        transpiler.mainloop(program)
+    return
+
+
+def test_cache(tmpdir, monkeypatch):
+    """The compiled module is cached next to the source, and used
+    for as long as the source and level are unchanged.
+    """
+    source = str(tmpdir.join('loop.cspc'))
+    with open(source, 'w') as fn:
+        fn.write(LOOP)
+    stack, heap = transpiler.run(source, True, 2)
+    assert heap == {'total': 55, 'n': 0}
+    assert os.path.exists(transpiler.cache_name(source))
+
+    def no_parsing(filename, use_cache):
+        raise AssertionError('Parsed ' + filename)
+    monkeypatch.setattr(transpiler, 'load_file', no_parsing)
+    assert transpiler.run(source, True, 2) == (stack, heap)
+    with pytest.raises(AssertionError):
+        transpiler.run(source, True, 1)
+    return
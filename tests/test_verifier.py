@@ -0,0 +1,91 @@
+"""
+Test the bytecode verifier.
+
+Copyright (C) Sarah Mount, 2013.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import pytest
+
+from rcsp.linker import link_program
+from rcsp.parser import parse_bytecode_file
+from rcsp.verifier import TYPE_INT, TYPE_BOOL
+
+
+def link_main(source):
+    """Parse and link a program, returning its main function.
+    """
+    program = parse_bytecode_file('DEF main\n' + source + 'ENDDEF\n')
+    link_program(program)
+    return program.get('main')
+
+
+def test_verify_example():
+    """The stack types and depth of a loop should be inferred.
+    """
+    with open('tests/example4.cspc') as fn:
+        program = parse_bytecode_file(fn.read())
+    link_program(program)
+    code = program.get('main')
+    assert code.max_depth == 2
+    assert code.unboxed
+    assert code.stack_types[4] == [TYPE_INT, TYPE_INT]
+    assert code.stack_types[5] == [TYPE_BOOL]
+    assert code.stack_types[len(code.ops) - 1] == [TYPE_INT]
+    assert code.stack_types[len(code.ops)] is None
+    return
+
+
+def test_verify_strings():
+    """Code which leaves a name on the stack can not be unboxed.
+    """
+    code = link_main('LOAD_CONST 1\nLOAD_NAME x\nPRINT_ITEM\n')
+    assert not code.unboxed
+    assert code.max_depth == 2
+    return
+
+
+def test_verify_underflow():
+    """Popping from an empty stack should be rejected.
+    """
+    with pytest.raises(TypeError):
+        link_main('LOAD_CONST 1\nADD\n')
+    return
+
+
+def test_verify_wrong_type():
+    """Branching on an int should be rejected.
+    """
+    with pytest.raises(TypeError):
+        link_main('LOAD_CONST 1\nPOP_JUMP_IF_TRUE 0\n')
+    return
+
+
+def test_verify_inconsistent_stack():
+    """A loop which grows the stack should be rejected.
+    """
+    with pytest.raises(TypeError):
+        link_main('LOAD_CONST 1\nJUMP_ABSOLUTE 0\n')
+    return
+
+
+def test_verify_bad_operand():
+    """A reference to a missing literal should be rejected.
+    """
+    code = parse_bytecode_file('DEF main\nLOAD_CONST 1\nENDDEF\n')
+    code.get('main').bytecode[1] = 5
+    with pytest.raises(TypeError):
+        link_program(code)
+    return